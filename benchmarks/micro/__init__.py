@@ -0,0 +1,21 @@
+"""
+Microbenchmarks of the numerical kernels of the custom steps.
+
+Each benchmark class times one kernel on synthetic images (see common.py),
+parameterized by image size and source density:
+
+    bench_fnoise.py      collapse_image, masksources, fit_sky (remstriping_update_parallel)
+    bench_background.py  SubtractBackground.tier_mask, clipped_ring_median_filter and
+                         estimate_background, ScaledVariance.correct_the_variance,
+                         fit_sky (bkg_sub_parallel)
+    bench_wisp.py        make_segmap and the wisp scale factor loop (subtract_wisp)
+
+The classes follow the asv conventions (params, param_names, setup, time_*),
+so the suite runs with asv from benchmarks/, which keeps the history of every
+commit in benchmarks/results (see asv.conf.json):
+
+    >>> asv run --python=same --set-commit-hash $(git rev-parse HEAD)
+
+or without asv, with benchmarks/run_micro.py, which appends to
+benchmarks/micro_history.jsonl and flags the kernels that got slower.
+"""
@@ -0,0 +1,99 @@
+"""Kernels of the background subtraction, background_subtraction.py, compute_cal_sky_variance.py and bkg_sub_parallel.py."""
+import numpy as np
+
+from . import common
+
+import background_subtraction
+import bkg_sub_parallel
+import compute_cal_sky_variance
+
+
+def subtract_background(image):
+    """SubtractBackground with the settings of config.yaml, and the inputs of its kernels for a cal image:
+    the image with the masked pixels (NaN or DQ-flagged) set to 0, and the mask."""
+    bs = background_subtraction.SubtractBackground()
+    bkg_sub_parallel.configure(bs)
+    mask = ~np.isfinite(image['sci']) | ((image['dq'] & common.DO_NOT_USE) != 0)
+    sci = np.where(mask, 0., image['sci']).astype(np.float32)
+    return bs, sci, mask
+
+
+class ClippedRingMedianFilter:
+    """Clipped ring median filter of a cal image (the ring_median_method of config.yaml)."""
+    params = common.PARAMS
+    param_names = common.PARAM_NAMES
+    timeout = 600
+
+    def setup(self, size, source_density):
+        self.bs, self.sci, self.mask = subtract_background(common.make_image(size, source_density))
+
+    def time_clipped_ring_median_filter(self, size, source_density):
+        self.bs.clipped_ring_median_filter(self.sci, self.mask)
+
+
+class TierMask:
+    """Source detection tiers on the ring-median-filtered image: the statistics and smoothed images
+    they share, and the masks of the widest and narrowest tier."""
+    params = common.PARAMS
+    param_names = common.PARAM_NAMES
+    timeout = 600
+
+    def setup(self, size, source_density):
+        self.bs, sci, self.mask = subtract_background(common.make_image(size, source_density))
+        self.img = self.bs.clipped_ring_median_filter(sci, self.mask)
+        self.tier_detector = self.bs.tier_detector(self.img, self.mask)
+
+    def time_tier_detector(self, size, source_density):
+        self.bs.tier_detector(self.img, self.mask)
+
+    def time_tier_mask_first(self, size, source_density):
+        self.bs.tier_mask(self.img, self.mask, tiernum=0, tier_detector=self.tier_detector)
+
+    def time_tier_mask_last(self, size, source_density):
+        self.bs.tier_mask(self.img, self.mask, tiernum=len(self.bs.tier_nsigma) - 1, tier_detector=self.tier_detector)
+
+
+class EstimateBackground:
+    """Background2D of the source-masked image."""
+    params = common.PARAMS
+    param_names = common.PARAM_NAMES
+    timeout = 600
+
+    def setup(self, size, source_density):
+        image = common.make_image(size, source_density)
+        self.bs, self.sci, mask = subtract_background(image)
+        self.mask = mask | common.source_mask(image)
+
+    def time_estimate_background(self, size, source_density):
+        self.bs.estimate_background(self.sci, self.mask).background
+
+
+class CorrectTheVariance:
+    """Rescaling of the readnoise variance to the measured sky variance."""
+    params = common.PARAMS
+    param_names = common.PARAM_NAMES
+
+    def setup(self, size, source_density):
+        image = common.make_image(size, source_density)
+        self.sci = np.nan_to_num(image['sci'])
+        self.var_rnoise = image['var_rnoise']
+        self.mask = common.source_mask(image).astype(int)
+
+    def time_correct_the_variance(self, size, source_density):
+        sv = compute_cal_sky_variance.ScaledVariance()
+        sv.set_arrays('bench_cal.fits', self.sci, self.var_rnoise, self.mask)
+        sv.correct_the_variance()
+
+
+class FitSky:
+    """Gaussian fit of the histogram of the unmasked sky pixels."""
+    params = common.PARAMS
+    param_names = common.PARAM_NAMES
+
+    def setup(self, size, source_density):
+        image = common.make_image(size, source_density)
+        mask = common.source_mask(image)
+        self.data = image['sci'][~mask]
+
+    def time_fit_sky(self, size, source_density):
+        bkg_sub_parallel.fit_sky(self.data)
@@ -0,0 +1,53 @@
+"""Kernels of the 1/f noise correction, remstriping_update_parallel.py."""
+from types import SimpleNamespace
+
+import numpy as np
+
+from . import common
+
+import remstriping_update_parallel as remstriping
+
+
+class CollapseImage:
+    """Sigma-clipped median of every row and column of a masked rate image (STATS_ENGINE of config.yaml)."""
+    params = common.PARAMS
+    param_names = common.PARAM_NAMES
+
+    def setup(self, size, source_density):
+        image = common.make_image(size, source_density, cal=False)
+        self.sci = image['sci']
+        self.mask = common.source_mask(image)
+
+    def time_rows(self, size, source_density):
+        remstriping.collapse_image(self.sci, self.mask, dimension='y')
+
+    def time_columns(self, size, source_density):
+        remstriping.collapse_image(self.sci, self.mask, dimension='x')
+
+
+class MaskSources:
+    """Tiered source mask of a rate image: ring median filter and four detection tiers."""
+    params = common.PARAMS
+    param_names = common.PARAM_NAMES
+    timeout = 600
+
+    def setup(self, size, source_density):
+        image = common.make_image(size, source_density, cal=False)
+        self.model = SimpleNamespace(data=image['sci'], err=image['err'], wht=image['wht'], dq=image['dq'])
+
+    def time_masksources(self, size, source_density):
+        remstriping.masksources('bench_rate.fits', common.WORKDIR, model=self.model, save_mask=False)
+
+
+class FitSky:
+    """Gaussian fit of the histogram of the unmasked sky pixels."""
+    params = common.PARAMS
+    param_names = common.PARAM_NAMES
+
+    def setup(self, size, source_density):
+        image = common.make_image(size, source_density, cal=False)
+        mask = common.source_mask(image)
+        self.data = image['sci'][~mask].astype(np.float64)
+
+    def time_fit_sky(self, size, source_density):
+        remstriping.fit_sky(self.data)
@@ -0,0 +1,55 @@
+"""Kernels of the wisp subtraction, subtract_wisp.py."""
+from types import SimpleNamespace
+
+import numpy as np
+
+from . import common
+
+import source_mask
+import subtract_wisp
+
+
+def wisp_template(size):
+    """Smooth wisp-like structure, peak 1, in one corner of the image."""
+    y, x = np.mgrid[0:size, 0:size] / size
+    u = (x - 0.7) * np.cos(0.6) + (y - 0.3) * np.sin(0.6)
+    v = -(x - 0.7) * np.sin(0.6) + (y - 0.3) * np.cos(0.6)
+    return np.exp(-0.5 * ((u / 0.15)**2 + (v / 0.04)**2)).astype(np.float32)
+
+
+class MakeSegmap:
+    """Segmentation map of a shortwave cal image, detected on the image itself."""
+    params = common.PARAMS
+    param_names = common.PARAM_NAMES
+    timeout = 600
+
+    def setup(self, size, source_density):
+        image = common.make_image(size, source_density)
+        self.model = SimpleNamespace(data=image['sci'], dq=image['dq'])
+
+    def time_make_segmap(self, size, source_density):
+        subtract_wisp.make_segmap('jw09999001001_02101_00001_nrca3_cal.fits', seg_from_lw=False, model=self.model)
+
+
+class FactorLoop:
+    """Residuals of the wisp scale factors in the wisp region, all of them and the coarse-to-fine search."""
+    params = common.PARAMS
+    param_names = common.PARAM_NAMES
+
+    def setup(self, size, source_density):
+        image = common.make_image(size, source_density)
+        wisp = wisp_template(size)
+        data = image['sci'] + 0.08 * wisp
+        segmap = source_mask.wisp_segmap(data, image['dq'])
+        bad = ((image['dq'] & 1) != 0) | (segmap != 0)
+        wisp_mask = subtract_wisp.wisp_region(wisp)
+        self.data_masked = np.where(bad | (wisp_mask == 0), np.nan, data)
+        self.wisp_data_masked = np.where(bad | (wisp_mask == 0), np.nan, wisp)
+        self.med = np.nanmedian(np.where(bad | (wisp_mask != 0), np.nan, data))
+        self.factors = np.arange(0.0, 2.0, 0.01)
+
+    def time_grid(self, size, source_density):
+        subtract_wisp.wisp_residuals(self.data_masked, self.wisp_data_masked, self.factors, 'mad', self.med)
+
+    def time_coarse(self, size, source_density):
+        subtract_wisp.coarse_wisp_residuals(self.data_masked, self.wisp_data_masked, self.factors, 'mad', self.med)
@@ -0,0 +1,118 @@
+"""
+Shared setup of the microbenchmarks: the pipeline modules and synthetic images.
+
+The pipeline modules read config.yaml (and write pipeline.log) in the working
+directory when they are imported, so importing this module moves to a
+temporary directory holding the repository config.yaml, with the shared source
+mask and the run report switched off, and puts utils/ on the path. The kernels
+then run with the repository settings (ring median method, statistics and
+precision modes, ...).
+"""
+import atexit
+import os
+import sys
+import tempfile
+
+import numpy as np
+import yaml
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+UTILS_DIR = os.path.join(REPO_DIR, 'utils')
+
+# Image sizes (pixels on a side) and source densities (sources per million pixels) of every benchmark
+SIZES = [512, 2048]
+DENSITIES = [100, 1000]
+PARAMS = [SIZES, DENSITIES]
+PARAM_NAMES = ['size', 'source_density']
+
+# DQ flags
+DO_NOT_USE, REFERENCE_PIXEL = 1, 2**31
+
+
+def setup_workdir():
+    """Move to a temporary directory with the benchmark config.yaml and put utils/ on the path.
+
+    Returns the tempfile.TemporaryDirectory, which is removed at exit, after moving back to the
+    starting directory.
+    """
+    workdir = tempfile.TemporaryDirectory(prefix='young_micro_')
+    with open(os.path.join(REPO_DIR, 'config.yaml')) as f:
+        config = yaml.safe_load(f)
+    config.update(source_mask_dir='', source_mask_refine=[], plot_sky=False, run_report='')
+    with open(os.path.join(workdir.name, 'config.yaml'), 'w') as f:
+        yaml.safe_dump(config, f)
+    start_dir = os.getcwd()
+    os.chdir(workdir.name)
+    if UTILS_DIR not in sys.path:
+        sys.path.insert(0, UTILS_DIR)
+
+    def cleanup():
+        os.chdir(start_dir)
+        workdir.cleanup()
+
+    atexit.register(cleanup)
+    return workdir
+
+
+_workdir = setup_workdir()
+WORKDIR = _workdir.name
+
+
+def striping(rng, size, amplitude=0.02):
+    """Row offsets with a 1/f spectrum, different in each quarter of the columns (the amplifiers)."""
+    frequencies = np.fft.rfftfreq(size)
+    pattern = np.zeros((size, size), dtype=np.float32)
+    for start in range(0, size, size // 4):
+        spectrum = np.zeros(frequencies.size, dtype=complex)
+        spectrum[1:] = (rng.normal(size=frequencies.size - 1) + 1j * rng.normal(size=frequencies.size - 1)) / np.sqrt(frequencies[1:])
+        noise = np.fft.irfft(spectrum, size)
+        pattern[:, start:start + size // 4] = (amplitude * noise / noise.std())[:, None]
+    return pattern
+
+
+def sources(rng, size, density):
+    """Image of exponential disks, density per million pixels, with many faint and a few bright ones."""
+    image = np.zeros((size, size), dtype=np.float32)
+    for _ in range(int(density * size**2 / 1e6)):
+        yc, xc = rng.uniform(0, size, 2)
+        flux = 20 * rng.pareto(1.5) + 1
+        radius = max(rng.lognormal(np.log(3), 0.7), 0.7)
+        half = int(min(8 * radius, 150))
+        y0, y1 = int(max(yc - half, 0)), int(min(yc + half + 1, size))
+        x0, x1 = int(max(xc - half, 0)), int(min(xc + half + 1, size))
+        if y1 <= y0 or x1 <= x0:
+            continue
+        y, x = np.mgrid[y0:y1, x0:x1]
+        r = np.hypot(y - yc, x - xc)
+        image[y0:y1, x0:x1] += (flux / (2 * np.pi * radius**2) * np.exp(-r / radius)).astype(np.float32)
+    return image
+
+
+def make_image(size, density, cal=True, seed=0):
+    """Synthetic NIRCam-like image of size x size pixels, as a dict of float32 sci, err, wht,
+    var_rnoise and uint32 dq. Rate images (cal=False) have the full 1/f striping, cal images a tenth
+    of it and NaN in the DO_NOT_USE pixels. The same for the same arguments."""
+    rng = np.random.default_rng([seed, size, density])
+    sky = 0.15
+    sci = sky + rng.normal(0, 0.01, (size, size)).astype(np.float32)
+    sci += sources(rng, size, density)
+    sci += striping(rng, size) / (10 if cal else 1)
+    dq = np.zeros((size, size), dtype=np.uint32)
+    dq[:4, :] = dq[-4:, :] = dq[:, :4] = dq[:, -4:] = DO_NOT_USE | REFERENCE_PIXEL
+    dq[rng.random((size, size)) < 0.002] |= DO_NOT_USE
+    var_rnoise = np.full((size, size), 0.012**2, dtype=np.float32)
+    err = np.sqrt(var_rnoise + np.maximum(sci, 0) * 0.002).astype(np.float32)
+    sci[(dq & REFERENCE_PIXEL) != 0] = 0.
+    if cal:
+        sci[(dq & DO_NOT_USE) != 0] = np.nan
+        err[(dq & DO_NOT_USE) != 0] = np.nan
+    return {'sci': sci, 'err': err, 'wht': (1 / err**2).astype(np.float32), 'var_rnoise': var_rnoise, 'dq': dq}
+
+
+def source_mask(image, nsigma=3.):
+    """Simple mask of the bad pixels and of the pixels nsigma above the median, for the kernels that take a mask."""
+    sci = image['sci']
+    finite = np.isfinite(sci)
+    median = np.median(sci[finite])
+    rms = 1.4826 * np.median(np.abs(sci[finite] - median))
+    return ~finite | ((image['dq'] & DO_NOT_USE) != 0) | (np.nan_to_num(sci, nan=median) > median + nsigma * rms)
@@ -0,0 +1,178 @@
+"""
+End-to-end benchmarks of the custom steps on synthetic data, without CRDS.
+
+Times, at 1, N and many exposures,
+
+    measure_striping   remstriping_update_parallel.measure_striping() on rate files, with the stub flats
+    subtract_wisp      subtract_wisp.process_file() on the wisp-affected cal files, with the stub templates
+    bkgsub             bkg_sub_parallel.bkgsub() on cal files
+
+on the files of synthetic_data.py. One exposure runs in this process; more run
+in a pool of --nproc workers, as in the pipeline. The inputs of every run are
+fresh copies (the steps modify and rename their files), and the copying is
+not timed.
+
+The steps run with the settings of the repository config.yaml (or --config),
+except that the shared source mask is switched off and the run report goes to
+the work directory; they read it from <workdir>/config.yaml, which is written
+here. Only the jwst package (for its datamodels and flat fielding) is needed,
+not a CRDS cache or network access.
+
+Results are printed and appended to <workdir>/benchmark_results.jsonl, one line
+per step and number of exposures; the phases of every exposure are in
+<workdir>/run_report.jsonl (see utils/run_report.py).
+
+Use
+---
+    >>> python benchmarks/run_benchmarks.py --workdir /scratch/bench --counts 1 4 16 --nproc 4
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from multiprocessing import Pool
+
+import yaml
+
+import synthetic_data
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+UTILS_DIR = os.path.join(REPO_DIR, 'utils')
+STEPS = ['measure_striping', 'subtract_wisp', 'bkgsub']
+
+# Settings of the benchmark run, set by setup() in the parent and in every worker
+settings = {}
+
+
+def setup(workdir, flats, wisp_dir):
+    """Work in workdir, where the pipeline modules find their config.yaml, with flats and wisp_dir as references."""
+    os.chdir(workdir)
+    if UTILS_DIR not in sys.path:
+        sys.path.insert(0, UTILS_DIR)
+    settings.update(flats=flats, wisp_dir=wisp_dir)
+
+
+def write_config(workdir, config_path):
+    """<workdir>/config.yaml: config_path without the shared source mask and with the run report in workdir."""
+    with open(config_path) as f:
+        config = yaml.safe_load(f)
+    config.update(source_mask_dir='', source_mask_refine=[], plot_sky=False,
+                  run_report=os.path.join(workdir, 'run_report.jsonl'))
+    with open(os.path.join(workdir, 'config.yaml'), 'w') as f:
+        yaml.safe_dump(config, f)
+    return config
+
+
+def detector_of(path):
+    return os.path.basename(path).split('_')[3]
+
+
+def inputs(dataset, step, count):
+    """The count input files of step, and the other files it reads."""
+    if step == 'subtract_wisp':
+        files = [cal for cal in dataset['cal'] if detector_of(cal) in synthetic_data.WISP_DETECTORS][:count]
+        # The segmaps come from the long-wavelength exposures of the same visits
+        roots = {os.path.basename(cal).split('_')[2] for cal in files}
+        extra = [cal for cal in dataset['cal'] if detector_of(cal) in synthetic_data.LW_DETECTORS
+                 and os.path.basename(cal).split('_')[2] in roots]
+        return files, extra
+    return dataset['rate' if step == 'measure_striping' else 'cal'][:count], []
+
+
+def run_one(args):
+    """Run step on one file of run_dir, returns its wall time."""
+    step, path, run_dir = args
+    t0 = time.perf_counter()
+    if step == 'measure_striping':
+        import remstriping_update_parallel
+        remstriping_update_parallel.measure_striping(path, path.replace('rate.fits', 'rate_pre1f.fits'), run_dir,
+                                                     flat_file=settings['flats'][detector_of(path)])
+    elif step == 'subtract_wisp':
+        import subtract_wisp
+        import robust_stats
+        config = yaml.safe_load(open('config.yaml'))
+        subtract_wisp.process_file(path, wisp_dir=settings['wisp_dir'], suffix='_final', plot=False,
+                                   stats_mode=robust_stats.step_mode(config, 'wisp_subtraction'),
+                                   compute_precision=config.get('compute_precision', 'float64'))
+    elif step == 'bkgsub':
+        import bkg_sub_parallel
+        bkg_sub_parallel.bkgsub(run_dir, os.path.basename(path), run_dir, plot_sky=False)
+    return time.perf_counter() - t0
+
+
+def benchmark(dataset, step, count, nproc, workdir):
+    """Time step on count fresh copies of its inputs. Returns the result record."""
+    run_dir = os.path.join(workdir, 'run')
+    shutil.rmtree(run_dir, ignore_errors=True)
+    os.makedirs(run_dir)
+    files, extra = inputs(dataset, step, count)
+    if len(files) < count:
+        raise ValueError(f'Only {len(files)} inputs for {step}, generate more exposures')
+    for path in files + extra:
+        shutil.copy(path, run_dir)
+    tasks = [(step, os.path.join(run_dir, os.path.basename(path)), run_dir) for path in files]
+
+    t0 = time.perf_counter()
+    if count == 1:
+        times = [run_one(tasks[0])]
+    else:
+        with Pool(processes=nproc, initializer=setup, initargs=(workdir, settings['flats'], settings['wisp_dir'])) as pool:
+            times = list(pool.imap_unordered(run_one, tasks))
+    wall = time.perf_counter() - t0
+    return {'step': step, 'exposures': count, 'nproc': 1 if count == 1 else nproc, 'wall': wall,
+            'mean_exposure': sum(times) / len(times), 'max_exposure': max(times),
+            'exposures_per_hour': 3600 * count / wall}
+
+
+def metadata():
+    """Where and on what the benchmarks ran."""
+    try:
+        commit = subprocess.run(['git', '-C', REPO_DIR, 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'time': time.time(), 'host': socket.gethostname(), 'cpus': os.cpu_count(), 'commit': commit}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the 1/f, wisp and background steps on synthetic data.')
+    parser.add_argument('--workdir', type=str, default=os.path.join(tempfile.gettempdir(), 'young_benchmarks'),
+                        help='Directory for the synthetic data (kept between runs) and the results')
+    parser.add_argument('--counts', type=int, nargs='+', default=[1, 4, 16], help='Numbers of exposures to time')
+    parser.add_argument('--nproc', type=int, default=4, help='Workers for more than one exposure')
+    parser.add_argument('--steps', type=str, nargs='+', default=STEPS, choices=STEPS, help='Steps to time')
+    parser.add_argument('--config', type=str, default=os.path.join(REPO_DIR, 'config.yaml'), help='Pipeline settings to use')
+    args = parser.parse_args()
+
+    workdir = os.path.abspath(args.workdir)
+    data_dir = os.path.join(workdir, 'data')
+    os.makedirs(workdir, exist_ok=True)
+    config = write_config(workdir, os.path.abspath(args.config))
+
+    # Four wisp-affected exposures per visit
+    nvisits = -(-max(args.counts) // len(synthetic_data.WISP_DETECTORS))
+    dataset_file = os.path.join(data_dir, 'dataset.json')
+    dataset = json.load(open(dataset_file)) if os.path.exists(dataset_file) else None
+    if dataset is None or len(dataset['cal']) < nvisits * 6:
+        print(f'Writing {nvisits} synthetic visits to {data_dir}')
+        dataset = synthetic_data.make_dataset(data_dir, nvisits)
+        json.dump(dataset, open(dataset_file, 'w'))
+
+    setup(workdir, dataset['flats'], dataset['wisp_dir'])
+    run_info = metadata()
+    results = []
+    for step in args.steps:
+        for count in args.counts:
+            result = benchmark(dataset, step, count, args.nproc, workdir)
+            result.update(run_info)
+            results.append(result)
+            print(f'{step:<18}{count:>4} exposures, {result["nproc"]:>3} workers: {result["wall"]:8.1f} s, '
+                  f'{result["mean_exposure"]:6.1f} s per exposure, {result["exposures_per_hour"]:7.0f} exposures/h')
+            with open(os.path.join(workdir, 'benchmark_results.jsonl'), 'a') as f:
+                f.write(json.dumps(result) + '\n')
+    shutil.rmtree(os.path.join(workdir, 'run'), ignore_errors=True)
@@ -0,0 +1,140 @@
+"""
+Run the microbenchmarks of the numerical kernels (micro/) without asv, and keep their history.
+
+Every time_* method of the benchmark classes runs for every combination of
+their parameters (image size, source density): setup() once, then --repeat
+timed calls. The best and median times are printed and appended to the history
+file, one JSON line per benchmark and parameters:
+
+    {"benchmark": "bench_fnoise.CollapseImage.time_rows", "params": {"size": 2048, "source_density": 100},
+     "min": 0.41, "median": 0.42, "repeat": 5, "time": 1760000000.0, "host": "node042", "cpus": 32,
+     "commit": "27d4062"}
+
+Each result is compared with the latest one of the same benchmark and
+parameters on the same host; those more than --threshold times slower are
+flagged, and the exit status is 1 if there are any.
+
+Use
+---
+    >>> python benchmarks/run_micro.py [--filter FactorLoop] [--quick] [--repeat 5]
+"""
+import argparse
+import importlib
+import itertools
+import json
+import os
+import pkgutil
+import re
+import statistics
+import sys
+import time
+
+from run_benchmarks import metadata
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+MICRO_DIR = os.path.join(BENCHMARK_DIR, 'micro')
+
+
+def discover(pattern=''):
+    """(name, class, method) of the benchmarks in micro/ whose name module.Class.method matches pattern."""
+    benchmarks = []
+    for module_info in pkgutil.iter_modules([MICRO_DIR]):
+        if not module_info.name.startswith('bench_'):
+            continue
+        module = importlib.import_module(f'micro.{module_info.name}')
+        for class_name, cls in vars(module).items():
+            if not isinstance(cls, type) or cls.__module__ != module.__name__:
+                continue
+            for method in sorted(name for name in vars(cls) if name.startswith('time_')):
+                name = f'{module_info.name}.{class_name}.{method}'
+                if re.search(pattern, name):
+                    benchmarks.append((name, cls, method))
+    return benchmarks
+
+
+def parameter_sets(cls, quick=False):
+    """Dicts of the parameter combinations of a benchmark class, only the first one of each with quick."""
+    params = getattr(cls, 'params', [])
+    names = getattr(cls, 'param_names', [])
+    if quick:
+        params = [values[:1] for values in params]
+    return [dict(zip(names, values)) for values in itertools.product(*params)]
+
+
+def run(cls, method, params, repeat):
+    """Times (s) of repeat calls of cls().method with params, after setup()."""
+    benchmark = cls()
+    args = list(params.values())
+    if hasattr(benchmark, 'setup'):
+        benchmark.setup(*args)
+    times = []
+    try:
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            getattr(benchmark, method)(*args)
+            times.append(time.perf_counter() - t0)
+    finally:
+        if hasattr(benchmark, 'teardown'):
+            benchmark.teardown(*args)
+    return times
+
+
+def load_history(path):
+    """Records of the history file, oldest first."""
+    if not os.path.exists(path):
+        return []
+    with open(path) as history:
+        return [json.loads(line) for line in history if line.strip()]
+
+
+def previous(history, record):
+    """The latest record of history for the benchmark, parameters and host of record, None if there is none."""
+    for old in reversed(history):
+        if (old['benchmark'], old['params'], old['host']) == (record['benchmark'], record['params'], record['host']):
+            return old
+    return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Microbenchmarks of the numerical kernels.')
+    parser.add_argument('--filter', type=str, default='', help='Only the benchmarks whose module.Class.method matches this regular expression')
+    parser.add_argument('--repeat', type=int, default=5, help='Timed calls of each benchmark')
+    parser.add_argument('--quick', action='store_true', help='Only the first value of every parameter (the smallest image)')
+    parser.add_argument('--history', type=str, default=os.path.join(BENCHMARK_DIR, 'micro_history.jsonl'),
+                        help='History file the results are compared with and appended to')
+    parser.add_argument('--threshold', type=float, default=1.2, help='Flag the benchmarks this many times slower than their previous result')
+    args = parser.parse_args()
+
+    # The benchmark modules change the working directory when imported (see micro/common.py)
+    history_path = os.path.abspath(args.history)
+    history = load_history(history_path)
+    run_info = metadata()
+    regressions = []
+    benchmarks = [(name, cls, method, parameter_sets(cls, quick=args.quick)) for name, cls, method in discover(args.filter)]
+    labels = {name: [', '.join(f'{key}={value}' for key, value in params.items()) for params in param_sets]
+              for name, cls, method, param_sets in benchmarks}
+    name_width = max((len(name) for name in labels), default=0) + 2
+    label_width = max((len(label) for name in labels for label in labels[name]), default=0) + 2
+    for name, cls, method, param_sets in benchmarks:
+        for params, label in zip(param_sets, labels[name]):
+            times = run(cls, method, params, args.repeat)
+            record = {'benchmark': name, 'params': params, 'min': min(times), 'median': statistics.median(times),
+                      'repeat': args.repeat}
+            record.update(run_info)
+            old = previous(history, record)
+            change = ''
+            if old is not None:
+                ratio = record['min'] / old['min']
+                change = f'{ratio:6.2f}x of {old["commit"]}'
+                if ratio > args.threshold:
+                    change += '  SLOWER'
+                    regressions.append((name, params, ratio))
+            print(f'{name:<{name_width}}{label:<{label_width}}{record["min"]:10.4f} s {record["median"]:10.4f} s  {change}')
+            with open(history_path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+    if regressions:
+        print(f'\n{len(regressions)} benchmarks more than {args.threshold}x slower than before:')
+        for name, params, ratio in regressions:
+            print(f'  {name} {params}: {ratio:.2f}x')
+        sys.exit(1)
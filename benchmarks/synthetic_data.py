@@ -0,0 +1,249 @@
+"""
+Synthetic NIRCam-like exposures for benchmarking the custom steps without JWST data or CRDS.
+
+For each exposure number a "visit" of six detectors is made: the four
+wisp-affected short-wavelength detectors (nrca3, nrca4, nrcb3, nrcb4) and the
+two long-wavelength ones (nrcalong, nrcblong), each as a _rate.fits and a
+_cal.fits file with
+
+    - the primary header keywords the steps and the jwst datamodels read
+      (DETECTOR, FILTER, PUPIL, EXP_TYPE, SUBARRAY, DATE-OBS, ...), and a
+      TAN WCS in the SCI header placing the short-wavelength detectors on
+      the long-wavelength field of their module,
+    - SCI: sky, sources (exponential disks and point-like sources), a wisp on
+      the wisp-affected detectors, and, in the rate files, 1/f noise: row
+      offsets with a 1/f spectrum, different for each amplifier, plus a
+      smaller common pattern; the cal files keep a tenth of it,
+    - ERR, DQ (reference pixels and random bad pixels), VAR_POISSON,
+      VAR_RNOISE, VAR_FLAT (and AREA in the cal files).
+
+Alongside them go the stub reference files the steps need offline: a unit
+flat per detector and filter (flat_<detector>_<filter>.fits, a FlatModel)
+and a wisp template per wisp-affected detector
+(WISP_<DETECTOR>_<FILTER>_<PUPIL>.fits, CAL and RATE extensions) holding the
+injected wisp shape.
+
+Everything is seeded from the exposure number, so the files are the same on
+every run. A visit takes about 1.7 GB.
+
+Use
+---
+    >>> python benchmarks/synthetic_data.py --output_dir /scratch/bench --nexposures 2
+"""
+import argparse
+import os
+import numpy as np
+from astropy.io import fits
+
+SHAPE = (2048, 2048)
+PROGRAM = '09999'
+SW_FILTER, LW_FILTER = 'F200W', 'F444W'
+WISP_DETECTORS = ['nrca3', 'nrca4', 'nrcb3', 'nrcb4']
+LW_DETECTORS = ['nrcalong', 'nrcblong']
+# Pixel scales (arcsec) and position of each short-wavelength detector in its module, in detector widths
+SW_SCALE, LW_SCALE = 0.031, 0.063
+SW_OFFSETS = {'1': (-0.49, 0.49), '2': (-0.49, -0.49), '3': (0.49, 0.49), '4': (0.49, -0.49)}
+MODULE_RA = {'a': 150.10, 'b': 150.00}
+DEC = 2.20
+# Amplifier column ranges
+AMPLIFIERS = [(0, 512), (512, 1024), (1024, 1536), (1536, 2048)]
+# DQ flags
+DO_NOT_USE, HOT, REFERENCE_PIXEL = 1, 2048, 2**31
+
+
+def exposure_name(exposure, detector, suffix):
+    """jw09999001001_02101_0000<exposure>_<detector>_<suffix>.fits"""
+    return f'jw{PROGRAM}001001_02101_{exposure:05d}_{detector}_{suffix}.fits'
+
+
+def detector_wcs(detector):
+    """FITS WCS keywords of detector: the long-wavelength detector covers the field of its module."""
+    module = detector[3]
+    scale = LW_SCALE if detector.endswith('long') else SW_SCALE
+    if detector.endswith('long'):
+        dx = dy = 0.
+    else:
+        dx, dy = (offset * SHAPE[0] * SW_SCALE / 3600. for offset in SW_OFFSETS[detector[4]])
+    return {'CTYPE1': 'RA---TAN', 'CTYPE2': 'DEC--TAN', 'CUNIT1': 'deg', 'CUNIT2': 'deg',
+            'CRPIX1': (SHAPE[1] + 1) / 2, 'CRPIX2': (SHAPE[0] + 1) / 2,
+            'CRVAL1': MODULE_RA[module] + dx / np.cos(np.radians(DEC)), 'CRVAL2': DEC + dy,
+            'CD1_1': -scale / 3600., 'CD1_2': 0., 'CD2_1': 0., 'CD2_2': scale / 3600.}
+
+
+def primary_header(detector, exposure):
+    """Primary header keywords of a full-frame NIRCam image of detector."""
+    channel = 'LONG' if detector.endswith('long') else 'SHORT'
+    return {'TELESCOP': 'JWST', 'INSTRUME': 'NIRCAM', 'DETECTOR': detector.upper(), 'MODULE': detector[3].upper(),
+            'CHANNEL': channel, 'FILTER': LW_FILTER if channel == 'LONG' else SW_FILTER, 'PUPIL': 'CLEAR',
+            'EXP_TYPE': 'NRC_IMAGE', 'SUBARRAY': 'FULL', 'SUBSTRT1': 1, 'SUBSTRT2': 1,
+            'SUBSIZE1': SHAPE[1], 'SUBSIZE2': SHAPE[0], 'FASTAXIS': 1, 'SLOWAXIS': 2,
+            'DATE-OBS': '2024-01-01', 'TIME-OBS': f'00:{exposure % 60:02d}:00.000', 'EFFEXPTM': 1000.,
+            'PROGRAM': PROGRAM, 'OBSERVTN': '001', 'VISIT': '001', 'EXPOSURE': str(exposure),
+            'DATAMODL': 'ImageModel'}
+
+
+def wisp_shape(detector, seed=0):
+    """Smooth wisp structure of a wisp-affected detector (peak ~1), the same for every exposure."""
+    rng = np.random.default_rng([seed, WISP_DETECTORS.index(detector)])
+    y, x = np.mgrid[0:SHAPE[0]:8, 0:SHAPE[1]:8] / SHAPE[0]
+    wisp = np.zeros(y.shape)
+    # A few elongated, rotated Gaussians along an arc near one corner
+    for _ in range(4):
+        x0, y0 = rng.uniform(0.55, 0.9), rng.uniform(0.1, 0.45)
+        angle = rng.uniform(0, np.pi)
+        u = (x - x0) * np.cos(angle) + (y - y0) * np.sin(angle)
+        v = -(x - x0) * np.sin(angle) + (y - y0) * np.cos(angle)
+        wisp += rng.uniform(0.5, 1.0) * np.exp(-0.5 * ((u / rng.uniform(0.08, 0.2))**2 + (v / rng.uniform(0.02, 0.05))**2))
+    wisp = np.kron(wisp, np.ones((8, 8)))  # the wisp is smooth, build it on a coarse grid
+    return (wisp / wisp.max()).astype(np.float32)
+
+
+def one_over_f(rng, n, amplitude):
+    """n values of noise with a 1/f power spectrum and rms amplitude."""
+    frequencies = np.fft.rfftfreq(n)
+    spectrum = np.zeros(frequencies.size, dtype=complex)
+    spectrum[1:] = (rng.normal(size=frequencies.size - 1) + 1j * rng.normal(size=frequencies.size - 1)) / np.sqrt(frequencies[1:])
+    noise = np.fft.irfft(spectrum, n)
+    return amplitude * noise / noise.std()
+
+
+def striping(rng, amplitude):
+    """1/f row pattern of a rate image: one per amplifier plus a common one."""
+    pattern = np.zeros(SHAPE, dtype=np.float32)
+    common = one_over_f(rng, SHAPE[0], amplitude / 2)
+    for start, stop in AMPLIFIERS:
+        pattern[:, start:stop] = (common + one_over_f(rng, SHAPE[0], amplitude))[:, None]
+    return pattern
+
+
+def sources(rng, nsources, scale):
+    """Image of nsources exponential disks and point-like sources; sizes in pixels scale with 1/scale."""
+    image = np.zeros(SHAPE, dtype=np.float32)
+    size = SW_SCALE / scale
+    for _ in range(nsources):
+        yc, xc = rng.uniform(0, SHAPE[0]), rng.uniform(0, SHAPE[1])
+        flux = 20 * rng.pareto(1.5) + 1  # many faint, a few bright
+        radius = max(rng.lognormal(np.log(3 * size), 0.7), 0.7)
+        half = int(min(8 * radius, 150))
+        y0, y1 = int(max(yc - half, 0)), int(min(yc + half + 1, SHAPE[0]))
+        x0, x1 = int(max(xc - half, 0)), int(min(xc + half + 1, SHAPE[1]))
+        if y1 <= y0 or x1 <= x0:
+            continue
+        y, x = np.mgrid[y0:y1, x0:x1]
+        r = np.hypot(y - yc, x - xc)
+        image[y0:y1, x0:x1] += (flux / (2 * np.pi * radius**2) * np.exp(-r / radius)).astype(np.float32)
+    return image
+
+
+def dq_array(rng, bad_fraction=0.002):
+    """DQ with the 4-pixel reference border and random hot pixels flagged."""
+    dq = np.zeros(SHAPE, dtype=np.uint32)
+    dq[:4, :] = dq[-4:, :] = dq[:, :4] = dq[:, -4:] = DO_NOT_USE | REFERENCE_PIXEL
+    bad = rng.random(SHAPE) < bad_fraction
+    dq[bad] |= DO_NOT_USE | HOT
+    return dq
+
+
+def write_image(path, detector, exposure, sci, dq, sky, cal):
+    """Write an ImageModel-like rate or cal file."""
+    rnoise = np.full(SHAPE, (0.012 if cal else 0.005)**2, dtype=np.float32)
+    poisson = (np.maximum(sci, 0) * (0.002 if cal else 0.001) + sky * 1e-3).astype(np.float32)
+    flat = np.full(SHAPE, 1e-6, dtype=np.float32)
+    err = np.sqrt(rnoise + poisson + flat)
+    sci = sci.copy()
+    sci[(dq & REFERENCE_PIXEL) != 0] = 0.
+    if cal:
+        # Stage 2 sets the DO_NOT_USE pixels to NaN
+        sci[(dq & DO_NOT_USE) != 0] = np.nan
+        err[(dq & DO_NOT_USE) != 0] = np.nan
+    header = fits.Header(primary_header(detector, exposure))
+    header['FILENAME'] = os.path.basename(path)
+    sci_header = fits.Header(detector_wcs(detector))
+    sci_header['BUNIT'] = 'MJy/sr' if cal else 'DN/s'
+    hdus = [fits.PrimaryHDU(header=header),
+            fits.ImageHDU(sci, header=sci_header, name='SCI'),
+            fits.ImageHDU(err, name='ERR'),
+            fits.ImageHDU(dq, name='DQ'),
+            fits.ImageHDU(poisson, name='VAR_POISSON'),
+            fits.ImageHDU(rnoise, name='VAR_RNOISE'),
+            fits.ImageHDU(flat, name='VAR_FLAT')]
+    if cal:
+        hdus.append(fits.ImageHDU(np.ones(SHAPE, dtype=np.float32), name='AREA'))
+    fits.HDUList(hdus).writeto(path, overwrite=True)
+
+
+def make_exposure(output_dir, exposure, detector, wisp_scale=0.8, stripe_rms=0.02, nsources=1500):
+    """Write the rate and cal files of exposure on detector. Returns their paths."""
+    rng = np.random.default_rng([exposure, (WISP_DETECTORS + LW_DETECTORS).index(detector)])
+    long = detector.endswith('long')
+    sky = 0.25 if long else 0.15
+    sci = sky + rng.normal(0, 0.01, SHAPE).astype(np.float32)
+    sci += sources(rng, nsources, LW_SCALE if long else SW_SCALE)
+    if detector in WISP_DETECTORS:
+        sci += wisp_scale * 0.1 * wisp_shape(detector)
+    dq = dq_array(rng)
+    pattern = striping(rng, stripe_rms)
+
+    rate = os.path.join(output_dir, exposure_name(exposure, detector, 'rate'))
+    cal = os.path.join(output_dir, exposure_name(exposure, detector, 'cal'))
+    write_image(rate, detector, exposure, sci + pattern, dq, sky, cal=False)
+    write_image(cal, detector, exposure, sci + pattern / 10, dq, sky, cal=True)
+    return rate, cal
+
+
+def make_flat(output_dir, detector):
+    """Unit FlatModel for detector, flat_<detector>_<filter>.fits."""
+    header = fits.Header(primary_header(detector, 0))
+    header.update({'DATAMODL': 'FlatModel', 'REFTYPE': 'FLAT', 'USEAFTER': '2022-01-01T00:00:00'})
+    path = os.path.join(output_dir, f'flat_{detector}_{header["FILTER"].lower()}.fits')
+    dq = np.zeros(SHAPE, dtype=np.uint32)
+    dq[:4, :] = dq[-4:, :] = dq[:, :4] = dq[:, -4:] = REFERENCE_PIXEL
+    fits.HDUList([fits.PrimaryHDU(header=header),
+                  fits.ImageHDU(np.ones(SHAPE, dtype=np.float32), name='SCI'),
+                  fits.ImageHDU(np.zeros(SHAPE, dtype=np.float32), name='ERR'),
+                  fits.ImageHDU(dq, name='DQ')]).writeto(path, overwrite=True)
+    return path
+
+
+def make_wisp_template(wisp_dir, detector):
+    """WISP_<DETECTOR>_<FILTER>_CLEAR.fits with the injected wisp shape in the CAL and RATE extensions."""
+    template = 0.1 * wisp_shape(detector)
+    path = os.path.join(wisp_dir, f'WISP_{detector.upper()}_{SW_FILTER}_CLEAR.fits')
+    fits.HDUList([fits.PrimaryHDU(),
+                  fits.ImageHDU(template, name='CAL'),
+                  fits.ImageHDU(template, name='RATE')]).writeto(path, overwrite=True)
+    return path
+
+
+def make_dataset(output_dir, nexposures, wisp_dir=None, **kwargs):
+    """Write nexposures visits, the flats and the wisp templates to output_dir.
+
+    Returns {'rate': [...], 'cal': [...], 'flats': {detector: path}, 'wisp_dir': wisp_dir}, with the files
+    of each list ordered by exposure and then by detector (wisp-affected detectors first).
+    """
+    wisp_dir = wisp_dir or os.path.join(output_dir, 'wisp-templates')
+    os.makedirs(output_dir, exist_ok=True)
+    os.makedirs(wisp_dir, exist_ok=True)
+    dataset = {'rate': [], 'cal': [], 'flats': {}, 'wisp_dir': wisp_dir}
+    for detector in WISP_DETECTORS + LW_DETECTORS:
+        dataset['flats'][detector] = make_flat(output_dir, detector)
+    for detector in WISP_DETECTORS:
+        make_wisp_template(wisp_dir, detector)
+    for exposure in range(1, nexposures + 1):
+        for detector in WISP_DETECTORS + LW_DETECTORS:
+            rate, cal = make_exposure(output_dir, exposure, detector, **kwargs)
+            dataset['rate'].append(rate)
+            dataset['cal'].append(cal)
+    return dataset
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write synthetic NIRCam rate/cal files, flats and wisp templates.')
+    parser.add_argument('--output_dir', type=str, required=True, help='Directory to write the files to')
+    parser.add_argument('--nexposures', type=int, default=1, help='Number of visits (six detectors each)')
+    parser.add_argument('--wisp_dir', type=str, default=None, help='Directory of the wisp templates (default: <output_dir>/wisp-templates)')
+    args = parser.parse_args()
+
+    dataset = make_dataset(args.output_dir, args.nexposures, wisp_dir=args.wisp_dir)
+    print(f'Wrote {len(dataset["rate"])} rate and {len(dataset["cal"])} cal files, '
+          f'{len(dataset["flats"])} flats to {args.output_dir}, wisp templates to {dataset["wisp_dir"]}')
@@ -0,0 +1,162 @@
+"""
+Prefetching of inputs and writing of outputs in background threads.
+
+The pool workers of the 1/f, wisp and background steps read an exposure,
+compute, and write the result, so the CPU idles while the file system works.
+With async_io_depth > 0 in config.yaml every worker takes a batch of exposures
+(async_io_batch) and
+
+    - a Prefetcher reads the next exposure(s) while the current one is computed,
+    - a WriteBehind writes the finished one(s) while the next one is computed.
+
+Both use a queue of depth items, which bounds the memory: a worker holds at
+most depth prefetched inputs plus the one being read, the one being computed,
+and depth outputs waiting to be written plus the one being written. Reading
+and writing release the GIL, so one thread each is enough.
+
+A WriteBehind runs the writes in the order they were submitted. Exceptions
+are not lost: a failed load is raised when its item is reached, and a failed
+write when the next write is submitted or the WriteBehind is closed.
+
+Use
+---
+    >>> with async_io.WriteBehind(depth=1) as writer, async_io.Prefetcher(files, ImageModel, depth=1) as inputs:
+    ...     for f, model in inputs:
+    ...         compute(model)
+    ...         writer.submit(model.save, f.replace('.fits', '_out.fits'))
+"""
+import logging
+import queue
+import threading
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+log_file_path = 'pipeline.log'
+file_handler = logging.FileHandler(log_file_path, mode='a')
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+log.addHandler(file_handler)
+
+
+def batches(items, size):
+    """items in lists of size (the last one may be shorter)."""
+    items = list(items)
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+
+def read_ahead(path, blocksize=2**23):
+    """Read path once so that the following reads come from the page cache. Returns None."""
+    with open(path, 'rb') as f:
+        while f.read(blocksize):
+            pass
+
+
+class Prefetcher:
+    """Iterate over (item, load(item)) for items, loading up to depth items ahead in a background thread.
+
+    Parameters
+    ----------
+    items : list
+        The items to load, e.g. file names, in the order they are needed.
+
+    load : callable
+        Function reading one item.
+
+    depth : int
+        Number of loaded items that may wait to be used.
+    """
+
+    def __init__(self, items, load, depth=1):
+        self.items = list(items)
+        self.load = load
+        self.queue = queue.Queue(maxsize=max(depth, 1))
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        for item in self.items:
+            if self.stopped.is_set():
+                return
+            try:
+                result = (item, self.load(item), None)
+            except Exception as e:
+                result = (item, None, e)
+            # Wait for room, unless the consumer has given up
+            while not self.stopped.is_set():
+                try:
+                    self.queue.put(result, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+    def __iter__(self):
+        for _ in self.items:
+            item, loaded, error = self.queue.get()
+            if error is not None:
+                raise error
+            yield item, loaded
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class WriteBehind:
+    """Run write functions in a background thread, in order, with up to depth of them waiting.
+
+    Parameters
+    ----------
+    depth : int
+        Number of submitted writes that may wait; submit() blocks when they are all taken.
+    """
+
+    def __init__(self, depth=1):
+        self.queue = queue.Queue(maxsize=max(depth, 1))
+        self.errors = []
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            write, args, kwargs = job
+            try:
+                write(*args, **kwargs)
+            except Exception as e:
+                log.exception(f'Background write {getattr(write, "__name__", write)} failed')
+                self.errors.append(e)
+
+    def _raise_errors(self):
+        if self.errors:
+            raise self.errors[0]
+
+    def submit(self, write, *args, **kwargs):
+        """Call write(*args, **kwargs) in the background thread, after the writes submitted before."""
+        self._raise_errors()
+        self.queue.put((write, args, kwargs))
+
+    def close(self):
+        """Wait for all submitted writes and raise the first error, if any."""
+        self.queue.put(None)
+        self.thread.join()
+        self._raise_errors()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Finish the writes, but let the original exception through
+            self.queue.put(None)
+            self.thread.join()
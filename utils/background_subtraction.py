@@ -2,7 +2,7 @@
 #
 
 __author__ = "Henry C. Ferguson, STScI"
-__version__ = "1.4.0"
+__version__ = "1.13.0"
 __license__ = "BSD3"
 
 # History
@@ -14,6 +14,15 @@ __license__ = "BSD3"
 # 1.3.0 -- Optionally mask bits that are set in the DQ array, if it is there
 # 1.3.1 -- Only pass tier_mask the mask for bad pixels and off-detector (not previous_mask)
 # 1.4.0 -- Added clipped_ring_median to try to have the ring-median have less suppression in the outskirts of galaxies
+# 1.5.0 -- Split the array processing out of do_background_subtraction so it can run on an in-memory datamodel
+# 1.6.0 -- Smooth the image for all tiers from a single FFT and compute the tier background statistics once
+# 1.7.0 -- Selectable ring median filter (ring_median.py) in clipped_ring_median_filter
+# 1.8.0 -- Optionally take the tier masks from the shared per-exposure source mask (source_mask.py)
+# 1.9.0 -- do_background_subtraction returns its arrays and only optionally writes them; the background is kept in self.background
+# 1.10.0 -- Background2D meshes from TiledBackground2D (tiled_background.py), optionally in background_threads threads
+# 1.11.0 -- Global robust statistics through robust_stats.py, optionally from a subsample (robust_stats_mode)
+# 1.12.0 -- Optionally smooth the tier images in single precision (compute_precision)
+# 1.13.0 -- Ring median, tier masks and Background2D are timed in the run report (run_report.py)
 
 import numpy as np
 from astropy.io import fits
@@ -25,17 +34,19 @@ import logging
 
 # Imports for background estimation
 from photutils.background import (
-    Background2D,  # For estimating the background
-    MedianBackground, BiweightLocationBackground, SExtractorBackground, # Not all are used
+    BiweightLocationBackground,  # For estimating the background
     BkgIDWInterpolator, BkgZoomInterpolator)  # For interpolating background
-from photutils.segmentation import SegmentationImage, detect_sources
 from photutils.utils import circular_footprint
-from photutils.utils import ShepardIDWInterpolator as idw
-from astropy.convolution import (
-    convolve, convolve_fft, Box2DKernel, Tophat2DKernel,
-    Ring2DKernel, Gaussian2DKernel)
+from astropy.convolution import convolve, Ring2DKernel, Gaussian2DKernel
 from scipy.ndimage import median_filter
 from astropy.wcs import WCS
+from multiscale_detection import MultiScaleDetector
+from ring_median import ring_median
+from tiled_background import TiledBackground2D
+import source_mask
+import robust_stats
+import precision
+import run_report
 
 #import dill # Just for debugging
 
@@ -63,6 +74,15 @@ class SubtractBackground:
     ring_clip_max_sigma: float = 5.
     ring_clip_box_size: int = 100  
     ring_clip_filter_size: int = 3
+    ring_median_method: str = 'blocked' # 'scipy', 'blocked' or 'subsampled', see ring_median.py
+    ring_median_threads: int = 1
+    ring_median_validate: bool = False
+    background_threads: int = 1 # Threads for the Background2D box statistics, see tiled_background.py
+    fft_threads: int = 1 # Threads for the scipy.fft transforms of the tier detection, see multiscale_detection.py
+    robust_stats_mode: str = 'exact' # 'exact' or 'fast' (subsampled) global statistics, see robust_stats.py
+    compute_precision: str = 'float64' # 'float64' or 'float32' smoothing of the tier images, see precision.py
+    source_mask_dir: str = '' # Directory of the shared source masks (source_mask.py), '' to detect the tiers here
+    refine_source_mask: bool = False # Also detect the tiers here and add them to the shared ones
     bg_box_size: int = 5
     bg_filter_size: int = 3
     bg_exclude_percentile: int = 90
@@ -124,7 +144,7 @@ class SubtractBackground:
     
     def replace_masked(self, sci, mask):
         sci_nan = np.choose(mask,(sci,np.nan))
-        robust_mean_background = astrostats.biweight_location(sci_nan,c=6.,ignore_nan=True)
+        robust_mean_background = robust_stats.biweight_location(sci_nan,c=6.,ignore_nan=True,mode=self.robust_stats_mode)
         sci_filled = np.choose(mask,(sci,robust_mean_background))
         return sci_filled
     
@@ -146,7 +166,8 @@ class SubtractBackground:
 
     def clipped_ring_median_filter(self, sci, mask):
         # First make a smooth background (clip_box_size should be big)
-        bkg = Background2D(sci,
+        bkg = TiledBackground2D(sci,
+              nthreads = self.background_threads,
               box_size = self.ring_clip_box_size,
               sigma_clip = astrostats.SigmaClip(sigma=self.bg_sigma),
               filter_size = self.ring_clip_filter_size,
@@ -155,40 +176,47 @@ class SubtractBackground:
               mask = mask,
               interpolator = BkgZoomInterpolator())
         # Estimate the rms after subtracting this
-        background_rms = astrostats.biweight_scale((sci-bkg.background)[~mask]) 
+        background_rms = robust_stats.biweight_scale(sci-bkg.background,mask=mask,mode=self.robust_stats_mode)
         # Apply a floating ceiling to the original image
         ceiling = self.ring_clip_max_sigma * background_rms + bkg.background
         # Pixels above the ceiling are masked before doing the ring-median filtering
         ceiling_mask = sci > ceiling
         log.info(f"Ring median filtering with radius, width = {self.ring_radius_in}, {self.ring_width}")
         sci_filled = self.replace_masked(sci,mask | ceiling_mask)
-        ring = Ring2DKernel(self.ring_radius_in, self.ring_width)
-        filtered = median_filter(sci_filled, footprint=ring.array)
+        filtered = ring_median(sci_filled, self.ring_radius_in, self.ring_width,
+                               method=self.ring_median_method, nthreads=self.ring_median_threads,
+                               validate=self.ring_median_validate)
         return sci-filtered
     
-    def tier_mask(self, img, mask, tiernum = 0):
-        background_rms = astrostats.biweight_scale(img[~mask]) # Already has been ring-median subtracted
+    def tier_detector(self, img, mask):
+        ''' Background statistics and smoothed images shared by all the tiers, which use the same mask '''
+        background_rms = robust_stats.biweight_scale(img,mask=mask,mode=self.robust_stats_mode) # Already has been ring-median subtracted
         # Replace the masked pixels by the robust background level so the convolution doesn't smear them
-        background_level = astrostats.biweight_location(img[~mask]) # Already has been ring-median subtracted
+        background_level = robust_stats.biweight_location(img,mask=mask,mode=self.robust_stats_mode) # Already has been ring-median subtracted
         replaced_img = np.choose(mask,(img,background_level))
-        convolved_difference = convolve_fft(replaced_img,Gaussian2DKernel(self.tier_kernel_size[tiernum]),allow_huge=True)
+        detector = MultiScaleDetector(replaced_img, self.tier_kernel_size, workers=self.fft_threads,
+                                      dtype=precision.compute_dtype(self.compute_precision))
+        return detector, background_rms, robust_stats.median(img,mode=self.robust_stats_mode)
+
+    def tier_mask(self, img, mask, tiernum = 0, tier_detector = None):
+        if tier_detector is None:
+            tier_detector = self.tier_detector(img, mask)
+        detector, background_rms, img_median = tier_detector
         # First detect the sources, then make masks from the SegmentationImage
-        seg_detect = detect_sources(convolved_difference, 
-                    threshold=self.tier_nsigma[tiernum] * background_rms,
-                    npixels=self.tier_npixels[tiernum], 
-                     mask=mask)
-        segm = SegmentationImage(seg_detect.data.astype(int))
         if self.tier_dilate_size[tiernum] == 0:
-            mask = segm.make_source_mask()
+            footprint = None
         else:
             footprint = circular_footprint(radius=self.tier_dilate_size[tiernum])
-            mask = segm.make_source_mask(footprint=footprint)
+        mask = detector.source_mask(self.tier_kernel_size[tiernum],
+                    threshold=self.tier_nsigma[tiernum] * background_rms,
+                    npixels=self.tier_npixels[tiernum],
+                    mask=mask, footprint=footprint)
         log.info(f"Tier #{tiernum}:")
         log.info(f"  kernel_size = {self.tier_kernel_size[tiernum]}")
         log.info(f"  tier_nsigma = {self.tier_nsigma[tiernum]}")
         log.info(f"  tier_npixels = {self.tier_npixels[tiernum]}")
         log.info(f"  tier_dilate_size = {self.tier_dilate_size[tiernum]}")
-        log.info(f"  median of ring-median-filtered image = {np.nanmedian(img)}")
+        log.info(f"  median of ring-median-filtered image = {img_median}")
         log.info(f"  biweight rms of ring-median-filtered image  = {background_rms}")
         # For debugging #####################################################################
         # dill.dump(convolved_difference,open(f"convolved_difference{tiernum}.pkl","wb"))
@@ -201,15 +229,17 @@ class SubtractBackground:
         ''' Iteratively mask sources 
             Wtarting_bit lets you add bits for these masks to an existing bitmask
         '''
-        log.info(f"ring-filtered background median: {np.nanmedian(img)}")
         first_mask = bitmask != 0
+        tier_detector = self.tier_detector(img, first_mask)
+        log.info(f"ring-filtered background median: {tier_detector[2]}")
         for tiernum in range(len(self.tier_nsigma)):
-            mask = self.tier_mask(img, first_mask, tiernum=tiernum)
+            mask = self.tier_mask(img, first_mask, tiernum=tiernum, tier_detector=tier_detector)
             bitmask = np.bitwise_or(bitmask,np.left_shift(mask,tiernum+starting_bit))
         return bitmask
     
     def estimate_background(self, img, mask):
-        bkg = Background2D(img, 
+        bkg = TiledBackground2D(img, 
+                    nthreads = self.background_threads,
                     box_size = self.bg_box_size,
                     sigma_clip = astrostats.SigmaClip(sigma=self.bg_sigma),
                     filter_size = self.bg_filter_size,
@@ -220,7 +250,8 @@ class SubtractBackground:
         return bkg
     
     def estimate_background_IDW(self, img, mask):
-        bkg = Background2D(img, 
+        bkg = TiledBackground2D(img, 
+                    nthreads = self.background_threads,
                     box_size = self.bg_box_size,
                     sigma_clip = astrostats.SigmaClip(sigma=self.bg_sigma),
                     filter_size = self.bg_filter_size,
@@ -250,11 +281,56 @@ class SubtractBackground:
         log.info(f"Difference = {diff:.4f} at {significance:.2f} sigma significance")
     
     # Customize the parameters for the different steps here
-    def do_background_subtraction(self,datadir,fitsfile):
-        # Background subtract all the bands
+    def do_background_subtraction(self,datadir,fitsfile,write=True):
+        ''' Background subtract all the bands
+            Returns the background-subtracted image and the tier bitmask (the background is in self.background)
+            and, if write is True, also writes them to <prefix>_<suffix>.fits
+        '''
         log.info(fitsfile)
         sci, err = self.open_file(datadir,fitsfile)
+        source_tiers = source_mask.read_bits(fitsfile, self.source_mask_dir, source_mask.BACKGROUND_BITS)
+        bkgd_subtracted, bitmask = self.subtract_background(sci, err, source_tiers)
+        if not write:
+            return bkgd_subtracted, bitmask
+
+        # Write out the results
+        prefix = fitsfile[:fitsfile.rfind('_')]
+        outfile = f"{prefix}_{self.suffix}.fits"
+        outpath = path.join(datadir,outfile)
+        hdu = fits.open(path.join(datadir,fitsfile))
+        wcs = WCS(hdu['SCI'].header) # Attach WCS to it
+        # Replace or append the background-subtracted image
+        # Replace
+        if self.replace_sci:
+            hdu['SCI'].data = bkgd_subtracted
+        # Append 
+        else:
+            newhdu = fits.ImageHDU(bkgd_subtracted,header=wcs.to_header(),name='BKGSUB')
+            hdu.append(newhdu)
+        # Append an extension with the bitmask from the tiers of source rejection
+        newhdu = fits.ImageHDU(bitmask,header=wcs.to_header(),name='TIERMASK')
+        hdu.append(newhdu)
+        # Write out the new FITS file
+        hdu.writeto(outpath,overwrite=True)
+        log.info(f"Writing out {outpath}")
+        log.info("")
+        return bkgd_subtracted, bitmask
 
+    def do_background_subtraction_model(self, model):
+        ''' Same as do_background_subtraction, but for an in-memory ImageModel.
+            Nothing is written; returns the background-subtracted image and the tier bitmask
+        '''
+        log.info(model.meta.filename)
+        self.has_dq = True
+        self.dq = model.dq
+        source_tiers = source_mask.read_bits(model.meta.filename, self.source_mask_dir, source_mask.BACKGROUND_BITS)
+        return self.subtract_background(model.data, model.err, source_tiers)
+
+    def subtract_background(self, sci, err, source_tiers=None):
+        ''' Mask sources in tiers and subtract the background estimated from the unmasked regions
+            source_tiers are the tier masks of the shared source mask, if there is one
+            Returns the background-subtracted image and the tier bitmask; the background is kept in self.background
+        '''
         # Set up a bitmask
         bitmask = np.zeros(sci.shape,np.uint32) # Enough for 32 tiers
 
@@ -270,20 +346,29 @@ class SubtractBackground:
             mask = off_detector_mask 
         bitmask = np.bitwise_or(bitmask,np.left_shift(mask,0))
 
-        # Ring-median filter 
-        #filtered = self.ring_median_filter(sci, mask)
-        filtered = self.clipped_ring_median_filter(sci, mask)
-        
-        # Mask sources iteratively in tiers
-        bitmask = self.mask_sources(filtered, bitmask, starting_bit=1)
+        if (source_tiers is None) or self.refine_source_mask:
+            # Ring-median filter 
+            #filtered = self.ring_median_filter(sci, mask)
+            with run_report.phase('ring_median'):
+                filtered = self.clipped_ring_median_filter(sci, mask)
+            
+            # Mask sources iteratively in tiers
+            with run_report.phase('tier_masks'):
+                bitmask = self.mask_sources(filtered, bitmask, starting_bit=1)
+        if source_tiers is not None:
+            log.info("Using the tiers of the shared source mask")
+            for tiernum, tier in enumerate(source_tiers):
+                bitmask = np.bitwise_or(bitmask,np.left_shift(tier.astype(np.uint32),tiernum+1))
         mask = (bitmask != 0) 
 
         # Estimate the background using just unmasked regions
-        if self.interpolator == 'IDW':
-            bkg = self.estimate_background_IDW(sci, mask)
-        else:
-            bkg = self.estimate_background(sci, mask)
-        bkgd = bkg.background
+        with run_report.phase('Background2D'):
+            if self.interpolator == 'IDW':
+                bkg = self.estimate_background_IDW(sci, mask)
+            else:
+                bkg = self.estimate_background(sci, mask)
+            bkgd = bkg.background
+        self.background = bkgd
 
         # Subtract the background
         bkgd_subtracted = sci-bkgd
@@ -296,25 +381,4 @@ class SubtractBackground:
         for t in self.faint_tiers_for_evaluation:
             faintmask = faintmask | (np.bitwise_and(bitmask,2**t) != 0)
         self.evaluate_bias(bkgd,err,faintmask) # Just under the fainter sources
-        
-        # Write out the results
-        prefix = fitsfile[:fitsfile.rfind('_')]
-        outfile = f"{prefix}_{self.suffix}.fits"
-        outpath = path.join(datadir,outfile)
-        hdu = fits.open(path.join(datadir,fitsfile))
-        wcs = WCS(hdu['SCI'].header) # Attach WCS to it
-        # Replace or append the background-subtracted image
-        # Replace
-        if self.replace_sci:
-            hdu['SCI'].data = bkgd_subtracted
-        # Append 
-        else:
-            newhdu = fits.ImageHDU(bkgd_subtracted,header=wcs.to_header(),name='BKGSUB')
-            hdu.append(newhdu)
-        # Append an extension with the bitmask from the tiers of source rejection
-        newhdu = fits.ImageHDU(bitmask,header=wcs.to_header(),name='TIERMASK')
-        hdu.append(newhdu)
-        # Write out the new FITS file
-        hdu.writeto(outpath,overwrite=True)
-        log.info(f"Writing out {outpath}")
-        log.info("")
+        return bkgd_subtracted, bitmask
@@ -1,9 +1,9 @@
-from astropy.io import fits
-from astropy.stats import sigma_clipped_stats, sigma_clip, biweight_location
+from astropy.stats import sigma_clip, biweight_location
 from scipy.optimize import curve_fit
 import numpy as np
 import os
-import copy as cp
+import shutil
+import tempfile
 import logging
 import sys
 # import json
@@ -13,13 +13,22 @@ import compute_cal_sky_variance
 import pprint
 from jwst.datamodels import ImageModel
 import matplotlib.pyplot as plt
-from multiprocessing import Pool, cpu_count
 from tqdm.auto import tqdm
 import argparse
+import step_cache
+import robust_stats
+import async_io
+import worker_pool
+import run_report
+import profiling
 
 with open('config.yaml', 'r') as config_file:
     config = yaml.safe_load(config_file)
 
+# Exposures read ahead and written behind per worker, 0 for blocking I/O (see async_io.py)
+ASYNC_IO_DEPTH = config.get('async_io_depth', 0)
+ASYNC_IO_BATCH = config.get('async_io_batch', 4)
+
 # Set up logging
 log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG)
@@ -63,7 +72,24 @@ def fit_sky(data, plot_sky=False, ax=None, color='C1', label=None, **kwargs):
 
     return popt[1]
 
+def configure(bs):
+    """Ring median filter, Background2D, FFT, robust statistics and shared source mask settings from config.yaml"""
+    bs.ring_median_method = config.get('ring_median_method', 'blocked')
+    bs.ring_median_threads = config.get('ring_median_threads', 1)
+    bs.ring_median_validate = config.get('ring_median_validate', False)
+    bs.background_threads = config.get('background_threads', 1)
+    bs.fft_threads = config.get('fft_threads', 1)
+    bs.robust_stats_mode = robust_stats.step_mode(config, 'background_subtraction')
+    bs.compute_precision = config.get('compute_precision', 'float64')
+    bs.source_mask_dir = config.get('source_mask_dir', '')
+    bs.refine_source_mask = 'background_subtraction' in (config.get('source_mask_refine') or [])
+
 def bkgsub(directory, img, output_dir, plot_sky=False):
+    """Background-subtract directory/img and write it to output_dir/img.
+
+    The cal file is read once into an ImageModel and handed to bkgsub_model(),
+    so the 2D background-subtracted image and tier mask never go through a file.
+    """
     img_path = os.path.join(directory, img)
     
     # Check if the file exists
@@ -71,21 +97,53 @@ def bkgsub(directory, img, output_dir, plot_sky=False):
         log.info(f"File {img_path} does not exist or is not accessible.")
         return
     
-    bkg_suffix = 'bkgsub1'
-    file_suffix = 'final'
+    with run_report.exposure('background_subtraction', img):
+        model = ImageModel(img_path)
+        bkgsub_model(model, img, plot_sky)
+
+        # save output
+        save_atomically(model, os.path.join(output_dir, img))
+
+    log.info('finished: %s' % img)
+
+def save_atomically(model, path):
+    """Save model to path through a temporary file in the same directory, so that an interrupted
+    or failed save leaves the existing file (usually the input image) intact.
+
+    The temporary file is in a temporary subdirectory, with the same name, since the datamodel
+    records the name it is saved under.
+    """
+    temporary_dir = tempfile.mkdtemp(dir=os.path.dirname(path) or '.', prefix='.bkgsub_')
+    try:
+        temporary_file = os.path.join(temporary_dir, os.path.basename(path))
+        model.save(temporary_file)
+        os.replace(temporary_file, path)
+    finally:
+        shutil.rmtree(temporary_dir, ignore_errors=True)
+
+def bkgsub_model(model, img, plot_sky=False):
+    """Background-subtract an in-memory ImageModel, which is updated in place.
+
+    img is only used for logging and plot names.
+    """
     bs = background_subtraction.SubtractBackground()
-    bs.suffix = bkg_suffix
-    bs.replace_sci = True
-    bs.do_background_subtraction(directory, img)
-    bkgsub_file = os.path.join(img_path.replace('_final.fits', '_%s.fits' % bkg_suffix))
+    configure(bs)
+    bkgd_subtracted, mask = bs.do_background_subtraction_model(model)
 
-    with fits.open(bkgsub_file) as hdul:
-        mask = hdul[9].data
+    subtract_sky(model, mask, img, plot_sky)
 
-    model = ImageModel(img_path)
+    ### rescale variance maps
+    log.info('%s rescaling readnoise variance' % img)
+    sv = compute_cal_sky_variance.ScaledVariance()
+    log.info("ScaledVariance parameters:\n%s", pprint.pformat(sv.__dict__))
+    # use the 2D background subtracted image
+    sv.set_arrays(img, bkgd_subtracted, model.var_rnoise, mask)
+    rescale_variance(model, sv, img)
+
+def subtract_sky(model, mask, img, plot_sky=False):
+    """Fit the sky level in the unmasked pixels and subtract it from the model data."""
     dq = model.dq
     sci = model.data
-    original_data = cp.deepcopy(model.data)
 
     w = np.where((dq == 0) & (mask == 0))
     data = sci[w]
@@ -142,28 +200,19 @@ def bkgsub(directory, img, output_dir, plot_sky=False):
 
     log.info('%s' % img)
     log.info('  clipped median: %f' % medclip)
-    log.info('  biweight background: %f' % biweight_location(clipped))
+    log.info('  biweight background: %f' % biweight)
     log.info('  gaussian-fit background: %f' % sky)
     log.info('%s subtracting sky: %f' % (img, sky))
     # subtract off sky
-    processed_data = original_data - sky
+    processed_data = sci - sky
 
     model.meta.background.level = sky
     model.meta.background.subtracted = True
     model.meta.background.method = 'local'
+    model.data = processed_data
 
-    ### rescale variance maps
-    log.info('%s rescaling readnoise variance' % img)
-    # Instantiate the SubtractBackground object. Set the output suffix
-    sv = compute_cal_sky_variance.ScaledVariance()
-
-    # Print out the parameters being used
-    log.info("ScaledVariance parameters:\n%s", pprint.pformat(sv.__dict__))
-
-    # use the 2D background subtracted image
-    fitsfile = img.replace('%s.fits' % file_suffix, '%s.fits' % bkg_suffix)
-
-    sv.read_file(directory, fitsfile)
+def rescale_variance(model, sv, img):
+    """Rescale the readnoise variance to the measured sky variance and fill the variance map holes."""
     # directly pull corrected readnoise, rather than writing to file
     sv.correct_the_variance()
     varcorr = sv.predicted_skyvar
@@ -189,15 +238,8 @@ def bkgsub(directory, img, output_dir, plot_sky=False):
     model.flat = flat
     log.info('success %s' % img)
 
-    renamed_cal = img_path.replace('cal_final.fits', 'cal_final_pre_bkg.fits')
-    os.rename(img_path, renamed_cal)
-    # save output
-    model.data = processed_data
-    model.save(os.path.join(output_dir, img))
-
-    log.info('finished: %s' % img)
-
 def cleanup_intermediate_files(output_dir, image_filename):
+    """Remove the _bkgsub1 and _pre_bkg files left by earlier versions of this step."""
     base_filename = os.path.basename(image_filename).replace('_cal_final.fits', '')
     intermediate_files = [
         os.path.join(output_dir, base_filename + '_cal_bkgsub1.fits'),
@@ -215,12 +257,43 @@ def process_file(args):
     directory, output_dir, img, plot_sky = args
     bkgsub(directory, img, output_dir, plot_sky)
     cleanup_intermediate_files(directory, img)
+    return img
+
+def load_cal(args):
+    """ImageModel of the cal file of the process_file() args, None if there is no such file."""
+    directory, output_dir, img, plot_sky = args
+    img_path = os.path.join(directory, img)
+    if not os.path.exists(img_path):
+        log.info(f"File {img_path} does not exist or is not accessible.")
+        return None
+    return ImageModel(img_path)
+
+def save_model(model, path):
+    save_atomically(model, path)
+    model.close()
+
+def process_batch(batch):
+    """process_file() for a list of its args, reading the next cal file and writing
+    the previous result in background threads (see async_io.py)."""
+    with async_io.WriteBehind(ASYNC_IO_DEPTH) as writer, \
+         async_io.Prefetcher(batch, load_cal, ASYNC_IO_DEPTH) as inputs:
+        for (directory, output_dir, img, plot_sky), model in inputs:
+            if model is None:
+                continue
+            with run_report.exposure('background_subtraction', img):
+                bkgsub_model(model, img, plot_sky)
+            writer.submit(save_model, model, os.path.join(output_dir, img))
+            log.info('finished: %s' % img)
+    for directory, output_dir, img, plot_sky in batch:
+        cleanup_intermediate_files(directory, img)
+    return [img for directory, output_dir, img, plot_sky in batch]
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Stage 1 of the JWST data reduction pipeline.')
     parser.add_argument('--output_dir', type=str, help='Directory where output will be written')
     parser.add_argument('--input_dir', type=str, help='Directory where input is located')
+    parser.add_argument('--profile', type=int, default=0, help='Run every Nth task of the workers under cProfile (see profiling.py), 0 to disable')
     args = parser.parse_args()
 
     path = args.input_dir
@@ -229,12 +302,27 @@ if __name__ == "__main__":
     img_list = [file for file in img_file_list if file.endswith('cal_final.fits')]
     img_list = np.sort(img_list)
 
+    cache = step_cache.load(output_dir)
+    if cache is not None:
+        img_list = [os.path.basename(f) for f in cache.pending('background_subtraction', [os.path.join(path, img) for img in img_list])]
+
     pool_args = [(path, output_dir, img, config['plot_sky']) for img in img_list]
 
     log.info("Starting multiprocessing for background subtraction...")
-    with Pool(processes=cpu_count()) as pool:
+    with worker_pool.MemoryAwarePool.from_config(config, 'background_subtraction') as pool:
         with tqdm(total=len(pool_args), file=sys.stdout) as pbar:
-            for result in pool.imap_unordered(process_file, pool_args):
-                pbar.update(1) 
+            if ASYNC_IO_DEPTH > 0:
+                task, items = profiling.sample(process_batch, async_io.batches(pool_args, ASYNC_IO_BATCH),
+                                               'background_subtraction', args.profile, output_dir)
+                finished = pool.imap_unordered(task, items)
+            else:
+                task, items = profiling.sample(process_file, pool_args, 'background_subtraction', args.profile, output_dir)
+                finished = ([img] for img in pool.imap_unordered(task, items))
+            for results in finished:
+                for result in results:
+                    if cache is not None:
+                        cache.record('background_subtraction', os.path.join(output_dir, result))
+                pbar.update(len(results)) 
+    profiling.merge('background_subtraction', output_dir)
 
     log.info("Completed processing all files.")
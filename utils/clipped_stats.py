@@ -0,0 +1,156 @@
+"""
+Vectorized sigma-clipped medians along the rows or columns of an image.
+
+clipped_median() gives the same result as
+
+    astropy.stats.sigma_clipped_stats(data, mask=mask, sigma=sigma, maxiters=maxiters,
+                                      cenfunc='median', stdfunc='std', axis=axis)[1]
+
+for a 2D array, but processes all rows at once: every row is sorted once, after
+which each clipping iteration only moves the two ends of a window over the
+sorted values. The mean and standard deviation of the window come from prefix
+sums, and the median is read off the middle of the window.
+
+Tolerance: the clipping bounds are computed in float64 like astropy's, but the
+standard deviation comes from prefix sums instead of a second pass over the
+data. The bounds therefore differ by a few parts in 1e15, which only matters for
+a value lying exactly on a bound. The returned medians are otherwise identical,
+including NaN for rows without unmasked values. Run this module to compare
+both implementations on random data.
+
+Use
+---
+    >>> from clipped_stats import clipped_median
+    >>> row_medians = clipped_median(data, mask, axis=1, sigma=2.)
+"""
+import numpy as np
+
+
+def clipped_median(data, mask=None, axis=1, sigma=3., maxiters=5):
+    """Median of the sigma-clipped values of a 2D array along axis.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        2D input array. NaN and inf values are ignored.
+
+    mask : numpy.ndarray
+        Boolean array, True for pixels to ignore.
+
+    axis : int
+        1 for one value per row, 0 for one value per column.
+
+    sigma : float
+        Clipping threshold, in standard deviations around the median.
+
+    maxiters : int
+        Maximum number of clipping iterations.
+
+    Returns
+    -------
+    median : numpy.ndarray
+        Median of the clipped values for every row (or column), in the
+        floating point type of data.
+    """
+    data = np.asarray(data)
+    if data.dtype.kind != 'f':
+        data = data.astype(np.float32)
+    if axis == 0:
+        data = data.T
+        mask = mask.T if mask is not None else None
+
+    valid = np.isfinite(data)
+    if mask is not None:
+        valid &= ~np.asarray(mask, dtype=bool)
+
+    # Ignored values sort to the end of each row as NaN
+    sorted_data = np.sort(np.where(valid, data, np.nan), axis=1)
+    nrows = sorted_data.shape[0]
+    count = valid.sum(axis=1)
+    rows = np.arange(nrows)
+
+    # Prefix sums around a rough center to limit the cancellation in the variance.
+    # The NaNs at the end of a row only reach the sums past its last valid value.
+    shift = np.zeros(nrows)
+    has_data = count > 0
+    shift[has_data] = sorted_data[rows[has_data], (count[has_data] - 1) // 2]
+    centered = sorted_data - shift[:, None]
+    sum1 = np.zeros((nrows, sorted_data.shape[1] + 1))
+    sum2 = np.zeros((nrows, sorted_data.shape[1] + 1))
+    np.cumsum(centered, axis=1, out=sum1[:, 1:])
+    np.cumsum(np.square(centered, out=centered), axis=1, out=sum2[:, 1:])
+    del centered
+
+    # Window [start, stop) of the values that survived clipping so far
+    start = np.zeros(nrows, dtype=np.int64)
+    stop = count.astype(np.int64)
+    lower = np.full(nrows, np.nan)
+    upper = np.full(nrows, np.nan)
+    active = rows[has_data]
+
+    for _ in range(maxiters):
+        if active.size == 0:
+            break
+        a, b = start[active], stop[active]
+        n = b - a
+        middle = a + n // 2
+        upper_middle = sorted_data[active, middle].astype(np.float64)
+        lower_middle = sorted_data[active, np.maximum(middle - 1, 0)].astype(np.float64)
+        median = np.where(n % 2 == 1, upper_middle, 0.5 * (upper_middle + lower_middle))
+        mean = (sum1[active, b] - sum1[active, a]) / n
+        variance = (sum2[active, b] - sum2[active, a]) / n - mean**2
+        std = np.sqrt(np.maximum(variance, 0.0))
+        lower[active] = median - sigma * std
+        upper[active] = median + sigma * std
+
+        v = sorted_data if active.size == nrows else sorted_data[active]
+        with np.errstate(invalid='ignore'):
+            new_start = np.maximum(a, (v < lower[active, None]).sum(axis=1))
+            new_stop = np.minimum(b, (v <= upper[active, None]).sum(axis=1))
+        changed = (new_start != a) | (new_stop != b)
+        start[active], stop[active] = new_start, new_stop
+        active = active[changed]
+
+    # The final bounds are applied to all values, as astropy does
+    with np.errstate(invalid='ignore'):
+        first = (sorted_data < lower[:, None]).sum(axis=1)
+        last = (sorted_data <= upper[:, None]).sum(axis=1)
+    n = last - first
+    result = np.full(nrows, np.nan, dtype=data.dtype)
+    ok = n > 0
+    middle = first[ok] + n[ok] // 2
+    upper_middle = sorted_data[rows[ok], middle]
+    lower_middle = sorted_data[rows[ok], np.where(n[ok] % 2 == 1, middle, middle - 1)]
+    # Same rounding as numpy's median for an even number of values
+    result[ok] = (upper_middle + lower_middle) / data.dtype.type(2)
+    result[ok] = np.where(n[ok] % 2 == 1, upper_middle, result[ok])
+    return result
+
+
+if __name__ == '__main__':
+    import time
+    import warnings
+    from astropy.stats import sigma_clipped_stats
+    warnings.filterwarnings('ignore')
+
+    rng = np.random.default_rng(1)
+    shape = (2048, 2048)
+    data = rng.normal(0.3, 0.05, shape).astype(np.float32)
+    data += rng.normal(0, 0.01, shape[0]).astype(np.float32)[:, None]  # striping
+    sources = rng.random(shape) < 0.01
+    data[sources] += rng.exponential(2.0, sources.sum()).astype(np.float32)
+    data[rng.random(shape) < 0.001] = np.nan
+    mask = rng.random(shape) < 0.2
+    mask[:5] = True  # fully masked rows
+
+    for axis in (1, 0):
+        t0 = time.perf_counter()
+        expected = sigma_clipped_stats(data, mask=mask, sigma=2., cenfunc='median', stdfunc='std', axis=axis)[1]
+        t1 = time.perf_counter()
+        result = clipped_median(data, mask, axis=axis, sigma=2.)
+        t2 = time.perf_counter()
+        both = np.isfinite(expected)
+        assert np.array_equal(both, np.isfinite(result))
+        print(f'axis={axis}: astropy {t1-t0:.2f} s, vectorized {t2-t1:.2f} s, '
+              f'{np.sum(expected[both] != result[both])} of {both.sum()} medians differ, '
+              f'max abs difference {np.max(np.abs(expected[both] - result[both])):.3g}')
@@ -41,6 +41,13 @@ class ScaledVariance:
         self.var_rdnoise = self.hdu[6].data
         self.mask = self.hdu[self.mask_extension].data
 
+    def set_arrays(self,fitsfile,sci,var_rdnoise,mask):
+        # Same as read_file, for arrays already in memory (fitsfile is only used for logging)
+        self.fitsfile = fitsfile
+        self.sci = sci
+        self.var_rdnoise = var_rdnoise
+        self.mask = mask
+
     def compute_variance(self,img):
         blk_img = block_reduce(img,self.block_size)
         # Mask bins with any originally-masked pixels
@@ -0,0 +1,178 @@
+"""
+Stage 2, wisp subtraction and background subtraction in a single pass.
+
+In the staged pipeline every cal file is written by Image2Pipeline, read back by
+subtract_wisp.py to write the _cal_final file, then read again and rewritten by
+bkg_sub_parallel.py. Here the
+ImageModel returned by Image2Pipeline is handed from step to step in memory and
+written once, as _cal_final.fits.
+
+Exposures are grouped by visit and module (a long-wavelength exposure and its
+short-wavelength siblings) and each group is processed by a single worker. The
+long-wavelength exposure goes first, so its image is still in memory when the
+segmentation maps for the short-wavelength wisp subtraction are made.
+
+Use
+---
+    >>> python utils/fused_stage2.py --input_dir ./output/stage1_output --output_dir ./output/stage2_output --wisp_dir utils/wisp-templates
+"""
+import os
+import sys
+import logging
+import argparse
+from multiprocessing import Pool, current_process
+import yaml
+import numpy as np
+from tqdm.auto import tqdm
+
+with open('config.yaml', 'r') as config_file:
+    config = yaml.safe_load(config_file)
+
+os.environ['CRDS_PATH'] = config['crds_path']
+os.environ['CRDS_SERVER_URL'] = config['crds_server_url']
+
+log_file_path = "pipeline.log"
+
+if current_process().name == "MainProcess":
+    with open(log_file_path, 'a') as log_file:
+        log_file.write("\n--------------------------\n")
+        log_file.write("Stage 2 Processing (fused)\n")
+        log_file.write("--------------------------\n\n")
+
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+file_handler = logging.FileHandler(log_file_path, mode='a')
+file_handler.setFormatter(formatter)
+log.addHandler(file_handler)
+
+import pipeline_stage2
+import subtract_wisp
+import bkg_sub_parallel
+import step_cache
+import robust_stats
+import run_report
+
+# Steps replaced by a fused run, in the order they are applied
+FUSED_STEPS = ['stage2', 'wisp_subtraction', 'background_subtraction']
+
+# Shared source mask of the wisp subtraction, as passed by young_pipeline.sh
+WISP_SOURCE_MASK = {'source_mask_dir': config.get('source_mask_dir', ''),
+                    'refine_source_mask': 'wisp_subtraction' in (config.get('source_mask_refine') or [])}
+WISP_STATS_MODE = robust_stats.step_mode(config, 'wisp_subtraction')
+WISP_PRECISION = config.get('compute_precision', 'float64')
+
+
+def visit_key(rate):
+    """jw01063006004_02101_00005_nrca3_rate.fits -> jw01063006004_02101_00005_a"""
+    root = os.path.basename(rate).replace('_rate.fits', '')
+    detector = root.split('_')[-1]
+    return root[:-len(detector)] + detector[3]  # nrca3 / nrcalong -> a
+
+
+def process_exposure(rate, output_dir, wisp_dir, plot_sky=False, lw_segmap=None, seg_from_lw=True):
+    """Run Image2, wisp subtraction and background subtraction on one rate file and write its _cal_final file.
+
+    lw_segmap is the long-wavelength segmap from subtract_wisp.make_lw_segmap(), shared by the
+    short-wavelength exposures of the group. With seg_from_lw False the wisp segmap is detected
+    on the short-wavelength image itself. Returns (sci, dq, wcs) of the image before background
+    subtraction for long-wavelength exposures, to make that segmap from; None otherwise.
+    """
+    result = pipeline_stage2.stage2(rate, output_dir, save_results=False)
+    model = result[0]  # Image2Pipeline returns one model per input
+    cal = os.path.join(output_dir, os.path.basename(rate).replace('_rate.fits', '_cal.fits'))
+    final = cal.replace('_cal.fits', '_cal_final.fits')
+    detector = model.meta.instrument.detector.lower()
+
+    if detector in subtract_wisp.wisp_detectors:
+        # cal is never written; it only names the wisp model and plot products
+        subtract_wisp.process_file(cal, wisp_dir=wisp_dir, suffix='_final', model=model, lw_segmap=lw_segmap,
+                                   seg_from_lw=seg_from_lw, stats_mode=WISP_STATS_MODE,
+                                   compute_precision=WISP_PRECISION)
+
+    image = None
+    if 'long' in detector:
+        # The sky subtraction replaces model.data rather than changing it in place
+        image = (model.data, model.dq, model.get_fits_wcs())
+
+    bkg_sub_parallel.bkgsub_model(model, os.path.basename(final), plot_sky)
+    model.save(final)
+    model.close()
+    log.info(f'Wrote {final}')
+    return image
+
+
+def process_group(args):
+    """Process the exposures of one visit and module, long wavelength first."""
+    rates, output_dir, wisp_dir, plot_sky = args
+    failures = []
+    lw_image = None
+    lw_segmap = None
+    # The long-wavelength exposure of the group failed, so its image is neither in memory nor on disk
+    lw_failed = False
+    for rate in sorted(rates, key=lambda rate: 'long' not in rate):
+        affected = any(detector in rate for detector in subtract_wisp.wisp_detectors)
+        try:
+            if affected & (lw_segmap is None) & (not lw_failed):
+                # Made once from the long-wavelength image and blotted onto every affected detector
+                cal = os.path.join(output_dir, os.path.basename(rate).replace('_rate.fits', '_cal.fits'))
+                lw_segmap = subtract_wisp.make_lw_segmap(cal, lw_image=lw_image, **WISP_SOURCE_MASK)
+            with run_report.exposure('fused_stage2', rate):
+                image = process_exposure(rate, output_dir, wisp_dir, plot_sky, lw_segmap=lw_segmap,
+                                         seg_from_lw=not lw_failed)
+        except Exception as e:
+            log.exception(f'Fused stage 2 failed for {rate}')
+            failures.append((rate, f'{type(e).__name__}: {e}'))
+            if 'long' in os.path.basename(rate):
+                lw_failed = True
+                log.warning(f'Long-wavelength exposure {os.path.basename(rate)} failed, the wisp segmaps of its '
+                            f'short-wavelength siblings are detected on their own images')
+            continue
+        if image is not None:
+            lw_image = image
+    return rates, failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Stage 2, wisp subtraction and background subtraction in memory.')
+    parser.add_argument('--input_dir', type=str, help='Directory containing the rate files')
+    parser.add_argument('--output_dir', type=str, help='Directory where the _cal_final files will be written')
+    parser.add_argument('--wisp_dir', type=str, default='utils/wisp-templates', help='Directory containing the wisp templates')
+    parser.add_argument('--nproc', type=int, default=config.get('stage2_nproc', 1), help='Number of worker processes')
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    rate_list = np.sort([file for file in os.listdir(args.input_dir) if file.endswith('rate.fits')])
+    rate_paths = [os.path.join(args.input_dir, rate) for rate in rate_list]
+
+    cache = step_cache.load(args.output_dir)
+    if cache is not None:
+        rate_paths = cache.pending(FUSED_STEPS, rate_paths)
+
+    groups = {}
+    for rate_path in rate_paths:
+        groups.setdefault(visit_key(rate_path), []).append(rate_path)
+    pool_args = [(rates, args.output_dir, args.wisp_dir, config['plot_sky']) for rates in groups.values()]
+    log.info(f'Running fused stage 2 on {len(rate_paths)} exposures in {len(groups)} groups with {args.nproc} workers')
+
+    failures = []
+    with Pool(processes=args.nproc) as pool:
+        with tqdm(total=len(rate_paths), file=sys.stderr) as pbar:
+            for rates, group_failures in pool.imap_unordered(process_group, pool_args):
+                failures.extend(group_failures)
+                if cache is not None:
+                    failed = [rate for rate, _ in group_failures]
+                    for rate in rates:
+                        if rate not in failed:
+                            cache.record('stage2', rate, written=False)
+                            cache.record('wisp_subtraction', rate, written=False)
+                            cache.record('background_subtraction', rate)
+                pbar.update(len(rates))
+
+    if failures:
+        log.error(f'Fused stage 2 failed for {len(failures)} of {len(rate_paths)} exposures:')
+        for rate, error in failures:
+            log.error(f'  {os.path.basename(rate)}: {error}')
+        print(f'[Fused stage 2 failed for {len(failures)} of {len(rate_paths)} exposures, see pipeline.log]')
+        sys.exit(1)
@@ -0,0 +1,146 @@
+"""
+Multi-scale source detection on a single image transform.
+
+The 1/f source mask (remstriping_update_parallel.masksources) and the background
+tiers (SubtractBackground.mask_sources) both smooth one image with Gaussian
+kernels of several widths and detect sources in every smoothed version. Calling
+convolve_fft for each kernel transforms the image (and its NaN weights) again
+every time. MultiScaleDetector pads and transforms the image once, multiplies
+the transform with the cached transforms of all kernels, and inverts them in one
+batched scipy.fft call.
+
+The smoothed images are those of astropy.convolution.convolve_fft(image,
+Gaussian2DKernel(stddev)) with its default settings (zero fill outside the
+image, normalized kernel, NaNs interpolated), to within floating point rounding:
+about 1e-12 of the image rms. With dtype=np.float32 the transforms are done in
+single precision, which halves the memory (up to about 1e-5 of the image rms, see
+precision.py). Run this module to compare the two.
+
+Use
+---
+    >>> from multiscale_detection import MultiScaleDetector
+    >>> detector = MultiScaleDetector(image, [25, 15, 5, 2])
+    >>> smoothed = detector.convolve(25)
+    >>> mask = detector.source_mask(25, threshold, npixels=15)
+"""
+import numpy as np
+from scipy import fft as sp_fft
+from astropy.convolution import Gaussian2DKernel
+from photutils.segmentation import SegmentationImage, detect_sources
+
+# Kernel transforms for the last padded shape used, {(stddev, dtype): rfft2 of the kernel}
+_kernel_ffts = {}
+_kernel_shape = None
+
+
+def kernel_fft(stddev, shape, workers=1, dtype=np.float64):
+    """Transform of the normalized Gaussian2DKernel(stddev), centered on the origin of a shape array of dtype."""
+    global _kernel_shape
+    if shape != _kernel_shape:
+        _kernel_ffts.clear()
+        _kernel_shape = shape
+    key = (stddev, np.dtype(dtype).str)
+    if key not in _kernel_ffts:
+        kernel = Gaussian2DKernel(stddev).array
+        kernel = kernel / kernel.sum()
+        ky, kx = kernel.shape
+        padded = np.zeros(shape)
+        padded[:ky, :kx] = kernel
+        padded = np.roll(padded, (-(ky // 2), -(kx // 2)), axis=(0, 1))
+        _kernel_ffts[key] = sp_fft.rfft2(padded.astype(dtype), workers=workers)
+    return _kernel_ffts[key]
+
+
+class MultiScaleDetector:
+    """Gaussian-smoothed versions of an image at several scales, and the sources detected in them.
+
+    Parameters
+    ----------
+    image : numpy.ndarray
+        2D image. NaN and inf pixels are interpolated over, as in convolve_fft.
+
+    stddevs : list
+        Standard deviations (in pixels) of the Gaussian kernels.
+
+    workers : int
+        Number of threads for scipy.fft, -1 for all cores. Keep 1 in the pool workers,
+        which already run one exposure per core.
+
+    dtype : numpy.dtype
+        np.float64, or np.float32 for single precision transforms and smoothed images.
+    """
+
+    def __init__(self, image, stddevs, workers=1, dtype=np.float64):
+        image = np.asarray(image, dtype=dtype)
+        ny, nx = image.shape
+        self.shape = image.shape
+        self.stddevs = list(stddevs)
+
+        # Pad by the largest kernel so the zero fill never wraps around
+        max_size = max(max(Gaussian2DKernel(stddev).shape) for stddev in self.stddevs)
+        fft_shape = tuple(sp_fft.next_fast_len(n + max_size, real=True) for n in image.shape)
+        kernels = np.array([kernel_fft(stddev, fft_shape, workers=workers, dtype=dtype) for stddev in self.stddevs])
+
+        invalid = ~np.isfinite(image)
+        padded = np.zeros(fft_shape, dtype=dtype)
+        padded[:ny, :nx] = np.where(invalid, 0, image)
+        image_fft = sp_fft.rfft2(padded, workers=workers)
+        smoothed = sp_fft.irfft2(image_fft[None] * kernels, s=fft_shape, workers=workers)[:, :ny, :nx]
+
+        if invalid.any():
+            # Normalize by the kernel weight of the valid pixels (the zero fill counts as valid)
+            padded[:] = 0
+            padded[:ny, :nx] = invalid
+            invalid_fft = sp_fft.rfft2(padded, workers=workers)
+            weights = 1.0 - sp_fft.irfft2(invalid_fft[None] * kernels, s=fft_shape, workers=workers)[:, :ny, :nx]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                smoothed = smoothed / weights
+            smoothed[weights < 10 * np.finfo(dtype).eps] = 0.0
+
+        self.smoothed = dict(zip(self.stddevs, smoothed))
+
+    def convolve(self, stddev):
+        """The image smoothed with Gaussian2DKernel(stddev)."""
+        return self.smoothed[stddev]
+
+    def source_mask(self, stddev, threshold, npixels, mask=None, footprint=None):
+        """Boolean mask of the sources detected in the image smoothed at stddev.
+
+        threshold, npixels and mask are passed to photutils detect_sources; footprint
+        dilates the sources as in SegmentationImage.make_source_mask.
+        """
+        segm = detect_sources(self.smoothed[stddev], threshold, npixels=npixels, mask=mask)
+        if segm is None:
+            return np.zeros(self.shape, dtype=bool)
+        segm = SegmentationImage(segm.data.astype(int))
+        return segm.make_source_mask(footprint=footprint)
+
+
+if __name__ == '__main__':
+    import time
+    import warnings
+    from astropy.convolution import convolve_fft
+    warnings.filterwarnings('ignore')
+
+    rng = np.random.default_rng(2)
+    image = rng.normal(0, 0.05, (2048, 2048))
+    yy, xx = rng.integers(0, 2048, (2, 300))
+    for y, x in zip(yy, xx):
+        image[max(y-6, 0):y+6, max(x-6, 0):x+6] += rng.exponential(1.0)
+    image[rng.random(image.shape) < 0.001] = np.nan
+    image[:, :30] = np.nan
+    stddevs = [25, 15, 5, 2]
+
+    t0 = time.perf_counter()
+    expected = [convolve_fft(image, Gaussian2DKernel(stddev)) for stddev in stddevs]
+    t1 = time.perf_counter()
+    detector = MultiScaleDetector(image, stddevs)
+    t2 = time.perf_counter()
+    print(f'convolve_fft {t1-t0:.2f} s, MultiScaleDetector {t2-t1:.2f} s')
+    rms = np.nanstd(image)
+    for stddev, reference in zip(stddevs, expected):
+        difference = np.max(np.abs(detector.convolve(stddev) - reference)) / rms
+        threshold = 3 * np.std(reference)
+        reference_mask = SegmentationImage(detect_sources(reference, threshold, npixels=5).data).make_source_mask()
+        same = np.array_equal(reference_mask, detector.source_mask(stddev, threshold, npixels=5))
+        print(f'stddev {stddev}: max difference {difference:.2g} x rms, identical source mask: {same}')
@@ -0,0 +1,387 @@
+"""
+Per-exposure task graph for the YOUNG JWST pipeline.
+
+young_pipeline.sh runs every step over the whole directory before starting the
+next one, so a single slow exposure holds up all of the others at each stage
+boundary. Here each exposure's chain
+
+    uncal -> rate (stage1) -> 1/f -> cal (stage2) -> wisp -> bkgsub
+
+is modelled as a set of tasks that only depend on the previous step of the same
+exposure, and exposures stream through the steps independently. The only joins
+are the per-filter Image3 runs, which wait for all of that filter's exposures,
+and the short-wavelength wisp tasks, which need the stage 2 output of their
+long-wavelength sibling for the segmentation map.
+
+Use
+---
+    >>> python utils/pipeline_dag.py --output_dir ./output --nproc 16
+"""
+import os
+import sys
+import heapq
+import shutil
+import logging
+import subprocess
+import argparse
+import traceback
+from dataclasses import dataclass, field
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from multiprocessing import current_process
+import yaml
+from astropy.io import fits
+from tqdm.auto import tqdm
+
+with open('config.yaml', 'r') as config_file:
+    config = yaml.safe_load(config_file)
+
+os.environ['CRDS_PATH'] = config['crds_path']
+os.environ['CRDS_SERVER_URL'] = config['crds_server_url']
+
+log_file_path = "pipeline.log"
+
+if current_process().name == "MainProcess":
+    with open(log_file_path, 'a') as log_file:
+        log_file.write("\n-------------------\n")
+        log_file.write("Pipeline Task Graph\n")
+        log_file.write("-------------------\n\n")
+
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+file_handler = logging.FileHandler(log_file_path, mode='a')
+file_handler.setFormatter(formatter)
+log.addHandler(file_handler)
+
+# The step modules write their section of pipeline.log when imported, so run_task() imports
+# them in the workers, when a step of theirs runs
+import step_cache
+import robust_stats
+
+# Step names match the skip_steps entries in config.yaml
+STEP_ORDER = ['stage1', 'fnoise_correction', 'stage2', 'wisp_subtraction', 'background_subtraction', 'stage3']
+
+# Same as subtract_wisp.wisp_detectors
+WISP_DETECTORS = ['nrca3', 'nrca4', 'nrcb3', 'nrcb4']
+
+# Same settings as the remstriping_update_parallel.py call in young_pipeline.sh
+FNOISE_PARAMS = {'thresh': None, 'apply_flat': True, 'mask_sources': True}
+
+# Shared source mask of the wisp subtraction, as passed by young_pipeline.sh
+WISP_SOURCE_MASK = {'source_mask_dir': config.get('source_mask_dir', ''),
+                    'refine_source_mask': 'wisp_subtraction' in (config.get('source_mask_refine') or [])}
+WISP_STATS_MODE = robust_stats.step_mode(config, 'wisp_subtraction')
+WISP_PRECISION = config.get('compute_precision', 'float64')
+
+
+@dataclass
+class Task:
+    name: str
+    step: str
+    args: tuple
+    deps: list = field(default_factory=list)
+    optional_deps: list = field(default_factory=list)  # deps whose failure does not block this task
+    priority: tuple = ()
+    skip: bool = False
+
+
+def filter_wavelength(filter):
+    """Central wavelength of a NIRCam filter in 10 nm, F444W -> 444: the order of pipeline_stage3.filter_mapping."""
+    return int(filter[1:4])
+
+
+def exposure_root(uncal):
+    """jw01063006004_02101_00005_nrca3_uncal.fits -> jw01063006004_02101_00005_nrca3"""
+    return os.path.basename(uncal).replace('_uncal.fits', '')
+
+
+def lw_parent_root(root):
+    """Root name of the long-wavelength exposure taken alongside a short-wavelength one."""
+    detector = root.split('_')[-1]
+    if 'long' in detector:
+        return None
+    module = detector[3]  # nrca3 -> a
+    return root[:-len(detector)] + 'nrc{}long'.format(module)
+
+
+def build_graph(uncal_files, output_dir, wisp_dir):
+    """Create the per-exposure tasks and the per-filter Image3 joins."""
+    skip_steps = config.get('skip_steps') or []
+    stage1_dir = os.path.join(output_dir, 'stage1_output')
+    stage2_dir = os.path.join(output_dir, 'stage2_output')
+    stage3_dir = os.path.join(output_dir, 'stage3_output')
+
+    filters = {}
+    for uncal in uncal_files:
+        filters[exposure_root(uncal)] = fits.getheader(uncal)['FILTER']
+    sorted_filters = sorted(set(filters.values()), key=filter_wavelength, reverse=True)
+    reference_filter = sorted_filters[0] if sorted_filters else None
+
+    tasks = {}
+
+    def add(task):
+        task.skip = task.step in skip_steps
+        tasks[task.name] = task
+
+    for seq, uncal in enumerate(uncal_files):
+        root = exposure_root(uncal)
+        # Finish the reference filter first since every other Image3 run waits on it
+        rank = 0 if filters[root] == reference_filter else 1
+        rate = os.path.join(stage1_dir, root + '_rate.fits')
+        cal = os.path.join(stage2_dir, root + '_cal.fits')
+        affected = root.split('_')[-1] in WISP_DETECTORS
+
+        def prio(step):
+            # Prefer later steps so exposures drain through the chain instead of piling up
+            return (-STEP_ORDER.index(step), rank, seq)
+
+        add(Task('stage1:' + root, 'stage1', (uncal, stage1_dir), priority=prio('stage1')))
+        add(Task('fnoise_correction:' + root, 'fnoise_correction', (rate, stage1_dir),
+                 deps=['stage1:' + root], priority=prio('fnoise_correction')))
+        add(Task('stage2:' + root, 'stage2', (rate, stage2_dir),
+                 deps=['fnoise_correction:' + root], priority=prio('stage2')))
+        wisp_deps = ['stage2:' + root]
+        parent = lw_parent_root(root)
+        if affected and parent in filters:
+            wisp_deps.append('stage2:' + parent)
+        add(Task('wisp_subtraction:' + root, 'wisp_subtraction', (cal, wisp_dir, affected),
+                 deps=wisp_deps, priority=prio('wisp_subtraction')))
+        add(Task('background_subtraction:' + root, 'background_subtraction', (stage2_dir, root + '_cal_final.fits'),
+                 deps=['wisp_subtraction:' + root], priority=prio('background_subtraction')))
+
+    for filter in sorted_filters:
+        roots = [root for root in filters if filters[root] == filter]
+        cal_files = [os.path.join(stage2_dir, root + '_cal_final.fits') for root in roots]
+        exposure_deps = ['background_subtraction:' + root for root in roots]
+        deps = list(exposure_deps)
+        if filter != reference_filter:
+            deps.append('stage3:' + reference_filter)
+        add(Task('stage3:' + filter, 'stage3', (filter, stage3_dir, cal_files, reference_filter),
+                 deps=deps, optional_deps=exposure_deps, priority=(-STEP_ORDER.index('stage3'), 0, 0)))
+
+    return tasks
+
+
+def run_task(step, args):
+    """Run a single step for one exposure (or one filter for stage3) inside a worker process."""
+    if step == 'stage1':
+        import pipeline_stage1
+        uncal, output_dir = args
+        ramp_fit_cores, jump_cores = pipeline_stage1.worker_cores()
+        pipeline_stage1.main(uncal, output_dir, ramp_fit_cores=ramp_fit_cores, jump_cores=jump_cores)
+
+    elif step == 'fnoise_correction':
+        import remstriping_update_parallel
+        rate, output_dir = args
+        flat_file = remstriping_update_parallel.get_flat_file(rate)
+        pre1f = rate.replace('rate.fits', 'rate_pre1f.fits')
+        remstriping_update_parallel.process_file((rate, pre1f, output_dir, FNOISE_PARAMS['thresh'], FNOISE_PARAMS['apply_flat'],
+                                                  FNOISE_PARAMS['mask_sources'], False, flat_file))
+
+    elif step == 'stage2':
+        import pipeline_stage2
+        rate, output_dir = args
+        pipeline_stage2.stage2(rate, output_dir)
+
+    elif step == 'wisp_subtraction':
+        cal, wisp_dir, affected = args
+        if affected:
+            import subtract_wisp
+            subtract_wisp.process_file(cal, wisp_dir=wisp_dir, suffix='_final', stats_mode=WISP_STATS_MODE,
+                                       compute_precision=WISP_PRECISION, **WISP_SOURCE_MASK)
+        else:
+            # Link rather than rename: short-wavelength siblings may still need this cal file
+            # for their segmentation map. The _cal.fits names are removed at the end of the run.
+            final = cal.replace('_cal.fits', '_cal_final.fits')
+            if os.path.exists(final):
+                os.remove(final)
+            try:
+                os.link(cal, final)
+            except OSError:
+                shutil.copy2(cal, final)
+
+    elif step == 'background_subtraction':
+        import bkg_sub_parallel
+        directory, img = args
+        bkg_sub_parallel.process_file((directory, directory, img, config['plot_sky']))
+
+    elif step == 'stage3':
+        import pipeline_stage3
+        filter, stage3_dir, cal_files, reference_filter = args
+        filter_dir = os.path.join(stage3_dir, filter)
+        if os.path.isdir(filter_dir):
+            shutil.rmtree(filter_dir)  # left over from an earlier run of an incremental tree
+        for cal in cal_files:
+            if os.path.exists(cal):
+                pipeline_stage3.copy_exposure_to_filter_dir(cal, stage3_dir, filter)
+            else:
+                log.warning(f'{cal} not found, leaving it out of the {filter} association')
+        if filter == reference_filter:
+            if config['external_reference']:
+                pipeline_stage3.stage3(filter_dir, reference_catalog=config['reference_path'])
+            else:
+                log.info('NO REFERENCE CATALOG PROVIDED, USING GAIADR3')
+                pipeline_stage3.stage3(filter_dir)
+            pipeline_stage3.reference_products(filter_dir, filter)
+        else:
+            reference_dir = os.path.join(stage3_dir, reference_filter)
+            long_cat, long_params = pipeline_stage3.reference_products(reference_dir, reference_filter, convert=False)
+            pipeline_stage3.stage3(filter_dir, reference_catalog=long_cat, resample_params=long_params)
+
+    else:
+        raise ValueError('Unknown step {}'.format(step))
+
+
+def task_key(task):
+    """Cache key of a task: the exposure root, or the filter for stage 3."""
+    return task.name.split(':', 1)[1]
+
+
+def apply_cache(tasks, cache):
+    """Mark the tasks whose outputs are up to date as skipped."""
+    run = cache.must_run({'fnoise_correction': FNOISE_PARAMS})
+    nodes = cache.nodes()
+    for task in tasks.values():
+        node_id = (task.step, task_key(task))
+        if not task.skip and node_id in nodes and node_id not in run:
+            log.info(f'{task.name} is up to date')
+            task.skip = True
+
+
+def record_task(cache, task):
+    if task.step == 'stage3':
+        cache.record('stage3', task_key(task))
+    else:
+        params = FNOISE_PARAMS if task.step == 'fnoise_correction' else None
+        cache.record(task.step, task.args[0], params=params)
+
+
+def run_graph(tasks, nproc, cache=None):
+    """Execute the task graph, submitting each task as soon as its dependencies have finished.
+
+    Returns a dictionary of task name -> 'done', 'skipped', or 'failed'.
+    """
+    dependents = {name: [] for name in tasks}
+    waiting = {}
+    for name, task in tasks.items():
+        waiting[name] = len(task.deps)
+        for dep in task.deps:
+            dependents[dep].append(name)
+
+    status = {}
+    blocked = set()
+    ready = []
+    for name, task in tasks.items():
+        if waiting[name] == 0:
+            heapq.heappush(ready, (task.priority, name))
+
+    def finish(name, result):
+        # Resolve a task and release (or block) everything that depends on it
+        stack = [(name, result)]
+        while stack:
+            name, result = stack.pop()
+            status[name] = result
+            pbar.update(1)
+            for child in dependents[name]:
+                if result == 'failed' and name not in tasks[child].optional_deps:
+                    blocked.add(child)
+                waiting[child] -= 1
+                if waiting[child] == 0:
+                    if child in blocked:
+                        log.error(f'{child} not run because a dependency failed')
+                        stack.append((child, 'failed'))
+                    else:
+                        heapq.heappush(ready, (tasks[child].priority, child))
+
+    with tqdm(total=len(tasks), file=sys.stdout) as pbar:
+        with ProcessPoolExecutor(max_workers=nproc) as executor:
+            running = {}
+            while ready or running:
+                while ready and len(running) < nproc:
+                    _, name = heapq.heappop(ready)
+                    task = tasks[name]
+                    if task.skip:
+                        log.info(f'{name} skipped')
+                        finish(name, 'skipped')
+                        continue
+                    log.info(f'Starting {name}')
+                    running[executor.submit(run_task, task.step, task.args)] = name
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        future.result()
+                    except Exception:
+                        log.error(f'{name} failed:\n{traceback.format_exc()}')
+                        finish(name, 'failed')
+                    else:
+                        log.info(f'Finished {name}')
+                        if cache is not None:
+                            record_task(cache, tasks[name])
+                        finish(name, 'done')
+
+    return status
+
+
+def prefetch_references(uncal_files):
+    """Sync the reference files of every step to the CRDS cache before the workers start.
+
+    young_pipeline.sh runs crds bestrefs on the rate and the cal files before stage 2 and
+    stage 3 (download_rate_references and download_cal_references in skip_steps). Here the
+    exposures reach those steps at different times and concurrent workers would fetch the
+    missing references on demand into the shared cache, so all of them are synced up front
+    from the uncal files, whose headers select the same references as their products.
+    """
+    skip_steps = config.get('skip_steps') or []
+    if 'download_rate_references' in skip_steps and 'download_cal_references' in skip_steps:
+        return
+    log.info(f'Syncing the references of {len(uncal_files)} exposures')
+    result = subprocess.run(['crds', 'bestrefs', '--files', *uncal_files, '--sync-references=1'])
+    if result.returncode != 0:
+        log.error(f'crds bestrefs exited with status {result.returncode}, missing references are fetched by the steps')
+
+
+def cleanup_cal_files(stage2_dir):
+    """Remove stage 2 cal files that have been superseded by their _cal_final counterpart."""
+    for file in os.listdir(stage2_dir):
+        if file.endswith('_cal.fits'):
+            cal = os.path.join(stage2_dir, file)
+            if os.path.exists(cal.replace('_cal.fits', '_cal_final.fits')):
+                try:
+                    os.remove(cal)
+                    log.info(f'Deleted {cal}')
+                except Exception as e:
+                    log.error(f'Error deleting {cal}: {e}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run the full pipeline as a per-exposure task graph.')
+    parser.add_argument('--output_dir', type=str, help='Base directory for the stage1/stage2/stage3 output directories')
+    parser.add_argument('--wisp_dir', type=str, default='utils/wisp-templates', help='Directory containing the wisp templates')
+    parser.add_argument('--nproc', type=int, default=config.get('dag_nproc', 8), help='Number of worker processes')
+    args = parser.parse_args()
+
+    path = config['uncal_path']
+    uncal_list = sorted(os.path.join(path, file) for file in os.listdir(path) if file.endswith('uncal.fits'))
+
+    tasks = build_graph(uncal_list, args.output_dir, args.wisp_dir)
+    log.info(f'Task graph: {len(uncal_list)} exposures, {len(tasks)} tasks, {args.nproc} workers')
+    cache = step_cache.load(os.path.join(args.output_dir, 'stage1_output'))
+    if cache is not None:
+        apply_cache(tasks, cache)
+    if uncal_list:
+        prefetch_references(uncal_list)
+    status = run_graph(tasks, args.nproc, cache=cache)
+
+    stage2_dir = os.path.join(args.output_dir, 'stage2_output')
+    if os.path.isdir(stage2_dir):
+        cleanup_cal_files(stage2_dir)
+
+    failed = sorted(name for name, result in status.items() if result == 'failed')
+    if failed:
+        log.error('Failed tasks: {}'.format(', '.join(failed)))
+        print('[{} of {} tasks failed, see pipeline.log]'.format(len(failed), len(tasks)))
+        sys.exit(1)
@@ -7,7 +7,10 @@ from tqdm.auto import tqdm
 import logging
 import sys
 from multiprocessing import current_process
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import argparse
+import step_cache
+import run_report
 
 with open('config.yaml', 'r') as config_file:
     config = yaml.safe_load(config_file)
@@ -48,32 +51,85 @@ for logger in [log, crds_log, stpipe_log]:
         if isinstance(handler, logging.StreamHandler):
             logger.removeHandler(handler)
 
-def main(img, output_dir):
+def main(img, output_dir, ramp_fit_cores=None, jump_cores=None):
 
     if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-
-    result = Detector1Pipeline.call(
-        img, 
-        steps={
-            'ramp_fit': {'maximum_cores': config['ramp_fit_cores']}, 
-            'jump': {'maximum_cores': config['jump_cores']}
-        }, 
-        output_dir=output_dir, 
-        save_results=True
-    )
+        os.makedirs(output_dir, exist_ok=True)
+
+    if ramp_fit_cores is None:
+        ramp_fit_cores = config['ramp_fit_cores']
+    if jump_cores is None:
+        jump_cores = config['jump_cores']
+
+    with run_report.exposure('stage1', img), run_report.phase('Detector1'):
+        result = Detector1Pipeline.call(
+            img, 
+            steps={
+                'ramp_fit': {'maximum_cores': ramp_fit_cores}, 
+                'jump': {'maximum_cores': jump_cores}
+            }, 
+            output_dir=output_dir, 
+            save_results=True
+        )
+
+def worker_cores():
+    """Per-worker ramp_fit/jump core limits used when several exposures run at once."""
+    return str(config.get('stage1_worker_ramp_fit_cores', '1')), str(config.get('stage1_worker_jump_cores', '1'))
+
+def process_file(args):
+    """Run stage 1 on one exposure, returning the error message instead of raising so the batch continues."""
+    img, output_dir, ramp_fit_cores, jump_cores = args
+    try:
+        main(img, output_dir, ramp_fit_cores=ramp_fit_cores, jump_cores=jump_cores)
+    except Exception as e:
+        log.exception(f'Stage 1 failed for {img}')
+        return img, f'{type(e).__name__}: {e}'
+    return img, None
 
 if __name__=="__main__":
     parser = argparse.ArgumentParser(description='Stage 1 of the JWST data reduction pipeline.')
     parser.add_argument('--output_dir', type=str, help='Directory where output will be written')
+    parser.add_argument('--nproc', type=int, default=config.get('stage1_nproc', 1), help='Number of exposures to process in parallel')
     args = parser.parse_args()
 
     path = config['uncal_path']
     file_list1 = os.listdir(path)
     uncal_list = [file for file in file_list1 if file.endswith('uncal.fits')]
     uncal_list = np.sort(uncal_list)
-    for i, img in enumerate(tqdm(uncal_list, file=sys.stderr)):
-        main(os.path.join(path, img), args.output_dir)
-
-
-    
\ No newline at end of file
+    uncal_paths = [os.path.join(path, img) for img in uncal_list]
+
+    cache = step_cache.load(args.output_dir)
+    if cache is not None:
+        uncal_paths = cache.pending('stage1', uncal_paths)
+
+    failures = []
+    if args.nproc > 1:
+        # Detector1Pipeline spawns its own processes for jump/ramp_fit, which daemonic
+        # multiprocessing.Pool workers are not allowed to do, so use a ProcessPoolExecutor.
+        ramp_fit_cores, jump_cores = worker_cores()
+        log.info(f'Running stage 1 on {args.nproc} workers (ramp_fit cores: {ramp_fit_cores}, jump cores: {jump_cores})')
+        pool_args = [(img, args.output_dir, ramp_fit_cores, jump_cores) for img in uncal_paths]
+        with ProcessPoolExecutor(max_workers=args.nproc) as executor:
+            futures = [executor.submit(process_file, pool_arg) for pool_arg in pool_args]
+            for future in tqdm(as_completed(futures), total=len(futures), file=sys.stderr):
+                img, error = future.result()
+                if error is not None:
+                    failures.append((img, error))
+                elif cache is not None:
+                    cache.record('stage1', img)
+    else:
+        for i, img in enumerate(tqdm(uncal_paths, file=sys.stderr)):
+            img, error = process_file((img, args.output_dir, None, None))
+            if error is not None:
+                failures.append((img, error))
+            elif cache is not None:
+                cache.record('stage1', img)
+
+    # A failed exposure no longer stops the run, but the run still exits non-zero
+    # once the remaining exposures are done, as it did when the failure was raised
+    if failures:
+        log.error(f'Stage 1 failed for {len(failures)} of {len(uncal_paths)} exposures:')
+        for img, error in failures:
+            log.error(f'  {os.path.basename(img)}: {error}')
+        print(f'[Stage 1 failed for {len(failures)} of {len(uncal_paths)} exposures, see pipeline.log]')
+        sys.exit(1)
@@ -3,11 +3,17 @@ import os
 import yaml
 import numpy as np
 from jwst.pipeline import Image2Pipeline
+from jwst import datamodels
+from jwst.datamodels import ImageModel
+from astropy.io import fits
+import crds
 import logging
 import sys
 from tqdm.auto import tqdm
-from multiprocessing import current_process
+from multiprocessing import Pool
 import argparse
+import step_cache
+import run_report
 
 with open('config.yaml', 'r') as config_file:
     config = yaml.safe_load(config_file)
@@ -47,27 +53,161 @@ for logger in [log, crds_log, stpipe_log]:
         if isinstance(handler, logging.StreamHandler):
             logger.removeHandler(handler)
 
-def stage2(rate, output_dir):
+# References opened once and reused for every exposure of a (DETECTOR, FILTER, PUPIL) group.
+# assign_wcs loads the distortion/filteroffset references by filename, so those are resolved
+# once but passed on as paths.
+model_reference_types = {'flat': ('flat_field', 'override_flat'),
+                         'photom': ('photom', 'override_photom'),
+                         'area': ('photom', 'override_area')}
+path_reference_types = {'distortion': ('assign_wcs', 'override_distortion'),
+                        'filteroffset': ('assign_wcs', 'override_filteroffset')}
 
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+_reference_cache = {}
 
-    result = Image2Pipeline.call(
-        rate, 
-        steps={'resample': {'skip':config['skip_resample']}}, 
-        output_dir=output_dir, 
-        save_results=True
-    )
+# Whether the installed stpipe takes opened datamodels as override_* values; if not, the
+# worker falls back to the reference paths (see stage2_with_references())
+_model_overrides = True
+
+def group_key(rate):
+    header = fits.getheader(rate)
+    return header['DETECTOR'], header['FILTER'], header['PUPIL']
+
+def get_references(rate, as_paths=False):
+    """Reference file overrides for a rate file, reusing the models already opened by this worker.
+
+    With as_paths, the flat, photom and area references are passed as paths too.
+    """
+    with ImageModel(rate) as model:
+        parameters = model.get_crds_parameters()
+    reftypes = list(model_reference_types) + list(path_reference_types)
+    refs = crds.getreferences(parameters, reftypes=reftypes, observatory='jwst')
+
+    steps = {}
+    for reftype, (step, override) in {**model_reference_types, **path_reference_types}.items():
+        path = refs.get(reftype, '')
+        if not os.path.isfile(path):
+            continue
+        if reftype in model_reference_types and not as_paths:
+            if path not in _reference_cache:
+                ref_model = datamodels.open(path)
+                for ext in ('data', 'dq', 'err'):
+                    hasattr(ref_model, ext)  # reads the array now rather than once per exposure
+                _reference_cache[path] = ref_model
+                log.info(f'Loaded {reftype} reference {os.path.basename(path)}')
+            steps.setdefault(step, {})[override] = _reference_cache[path]
+        else:
+            steps.setdefault(step, {})[override] = path
+    return steps
+
+def clear_reference_cache():
+    for ref_model in _reference_cache.values():
+        ref_model.close()
+    _reference_cache.clear()
+
+def stage2(rate, output_dir, references=None, save_results=True):
+
+    if save_results and not os.path.exists(output_dir):
+        os.makedirs(output_dir, exist_ok=True)
+
+    steps = {'resample': {'skip':config['skip_resample']}}
+    if references:
+        for step, overrides in references.items():
+            steps.setdefault(step, {}).update(overrides)
+
+    with run_report.exposure('stage2', rate), run_report.phase('Image2'):
+        result = Image2Pipeline.call(
+            rate, 
+            steps=steps, 
+            output_dir=output_dir, 
+            save_results=save_results
+        )
+    return result
+
+def stage2_with_references(rate, output_dir):
+    """stage2() with the reference overrides of get_references().
+
+    Passing opened datamodels as override_* values needs an stpipe that accepts them. If the
+    run with the models fails, it is repeated with the reference paths, which this worker then
+    uses for the rest of its exposures.
+    """
+    global _model_overrides
+    if _model_overrides:
+        try:
+            return stage2(rate, output_dir, references=get_references(rate))
+        except Exception:
+            log.warning(f'Stage 2 with the opened reference models failed for {rate}, '
+                        f'retrying with the reference paths', exc_info=True)
+            _model_overrides = False
+            clear_reference_cache()
+    return stage2(rate, output_dir, references=get_references(rate, as_paths=True))
+
+def run_exposure(rate, output_dir, cache_references, failures):
+    """Run stage 2 on one exposure, adding (rate, error) to failures if it fails."""
+    try:
+        if cache_references:
+            stage2_with_references(rate, output_dir)
+        else:
+            stage2(rate, output_dir)
+    except Exception as e:
+        log.exception(f'Stage 2 failed for {rate}')
+        failures.append((rate, f'{type(e).__name__}: {e}'))
+        return False
+    return True
+
+def process_group(args):
+    """Run stage 2 on every exposure of one (DETECTOR, FILTER, PUPIL) group inside a single worker."""
+    key, rates, output_dir, cache_references = args
+    failures = []
+    for rate in rates:
+        run_exposure(rate, output_dir, cache_references, failures)
+    clear_reference_cache()
+    return key, rates, failures
 
 if __name__=="__main__":
     parser = argparse.ArgumentParser(description='Stage 1 of the JWST data reduction pipeline.')
     parser.add_argument('--output_dir', type=str, help='Directory where output will be written')
     parser.add_argument('--input_dir', type=str, help='Directory where output will be written')
+    parser.add_argument('--nproc', type=int, default=config.get('stage2_nproc', 1), help='Number of worker processes')
     args = parser.parse_args()
 
     path = args.input_dir
     file_list = os.listdir(path)
     rate_list = [file for file in file_list if file.endswith('rate.fits')]
     rate_list = np.sort(rate_list)
-    for i, rate in enumerate(tqdm(rate_list, file=sys.stderr)):
-        stage2(os.path.join(path, rate), args.output_dir)
\ No newline at end of file
+    rate_paths = [os.path.join(path, rate) for rate in rate_list]
+
+    cache = step_cache.load(args.output_dir)
+    if cache is not None:
+        rate_paths = cache.pending('stage2', rate_paths)
+
+    failures = []
+    if args.nproc > 1:
+        groups = {}
+        for rate_path in rate_paths:
+            groups.setdefault(group_key(rate_path), []).append(rate_path)
+        # Largest groups first so the long ones do not end up running alone at the end
+        pool_args = [(key, rates, args.output_dir, config.get('stage2_reference_cache', True))
+                     for key, rates in sorted(groups.items(), key=lambda item: len(item[1]), reverse=True)]
+        log.info(f'Running stage 2 on {len(groups)} (DETECTOR, FILTER, PUPIL) groups with {args.nproc} workers')
+
+        with Pool(processes=args.nproc) as pool:
+            with tqdm(total=len(rate_paths), file=sys.stderr) as pbar:
+                for key, rates, group_failures in pool.imap_unordered(process_group, pool_args):
+                    failures.extend(group_failures)
+                    if cache is not None:
+                        failed = [rate for rate, _ in group_failures]
+                        for rate in rates:
+                            if rate not in failed:
+                                cache.record('stage2', rate)
+                    pbar.update(len(rates))
+    else:
+        for i, rate in enumerate(tqdm(rate_paths, file=sys.stderr)):
+            if run_exposure(rate, args.output_dir, False, failures) and cache is not None:
+                cache.record('stage2', rate)
+
+    if failures:
+        log.error(f'Stage 2 failed for {len(failures)} of {len(rate_paths)} exposures:')
+        for rate, error in failures:
+            log.error(f'  {os.path.basename(rate)}: {error}')
+        print(f'[Stage 2 failed for {len(failures)} of {len(rate_paths)} exposures, see pipeline.log]')
+        sys.exit(1)
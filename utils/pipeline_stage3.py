@@ -1,6 +1,7 @@
 import os
 import subprocess
 from multiprocessing import current_process
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
 import json
 import yaml
 import shutil
@@ -11,6 +12,9 @@ from tqdm.auto import tqdm
 import logging
 import sys
 import argparse
+import step_cache
+from worker_pool import available_memory
+import run_report
 
 with open('config.yaml', 'r') as config_file:
     config = yaml.safe_load(config_file)
@@ -63,6 +67,28 @@ def get_filter_from_exposure(exp):
 import os
 import shutil
 
+filter_mapping = {
+    'F090W': 90,
+    'F115W': 115,
+    'F150W': 150,
+    'F200W': 200,
+    'F277W': 277,
+    'F356W': 356,
+    'F410M': 410,
+    'F444W': 444,
+}
+
+def copy_exposure_to_filter_dir(full_path, output_base_dir, filter=None):
+    if filter is None:
+        filter = get_filter_from_exposure(full_path)
+    filter_dir = os.path.join(output_base_dir, filter)
+    if not os.path.exists(filter_dir):
+        os.makedirs(filter_dir, exist_ok=True)
+    new_filename = os.path.basename(full_path).replace('cal_final.fits', 'cal.fits')
+    new_full_path = os.path.join(filter_dir, new_filename)
+    shutil.copy2(full_path, new_full_path)
+    return filter_dir
+
 def organize_exposures_by_filter(input_dir, output_base_dir):
     files = [file for file in os.listdir(input_dir) if file.endswith('cal_final.fits')]
     if not files:
@@ -72,13 +98,7 @@ def organize_exposures_by_filter(input_dir, output_base_dir):
     for filename in files:
         full_path = os.path.join(input_dir, filename)
         if os.path.isfile(full_path):
-            filter = get_filter_from_exposure(full_path)
-            filter_dir = os.path.join(output_base_dir, filter)
-            if not os.path.exists(filter_dir):
-                os.makedirs(filter_dir)
-            new_filename = filename.replace('cal_final.fits', 'cal.fits')
-            new_full_path = os.path.join(filter_dir, new_filename)
-            shutil.copy2(full_path, new_full_path)
+            copy_exposure_to_filter_dir(full_path, output_base_dir)
 
 def create_custom_association(filter_dir, output_filename, program, target, instrument, filter, pupil="clear", subarray="full", exp_type="nrc_image"):
     """
@@ -157,6 +177,18 @@ def extract_resample_info(mosaic_img_path):
         }
     return resample_info
 
+def reference_products(filter_dir, filter, convert=True):
+    """Tweakreg catalog and resample parameters from the reference (longest wavelength) filter."""
+    path_longest = filter_dir + '/output_files/'
+    if convert:
+        convert_catalog_to_tweakreg_format(path_longest, filter)
+    long_cat = os.path.join(path_longest, f'{filter}.csv')
+
+    long_list = [file for file in os.listdir(path_longest) if file.endswith(f'nircam_clear-{filter}_i2d.fits')]
+    long_processed_file = os.path.join(path_longest, long_list[0])
+    long_params = extract_resample_info(long_processed_file)
+    return long_cat, long_params
+
 def stage3(filter_dir, reference_catalog=None, resample_params=None):
 
     target = config['target']
@@ -237,50 +269,136 @@ def stage3(filter_dir, reference_catalog=None, resample_params=None):
     asn_list = [os.path.join(filter_dir, file) for file in os.listdir(filter_dir) if file.endswith('asn.json')]
     asn = asn_list[0]
 
-    result = Image3Pipeline.call(asn, steps=step_config, output_dir=output_dir, save_results=True)
+    with run_report.exposure('stage3', filter_dir), run_report.phase('Image3'):
+        result = Image3Pipeline.call(asn, steps=step_config, output_dir=output_dir, save_results=True)
+
+def estimate_filter_memory(filter_dir):
+    """Rough peak memory (bytes) of an Image3 run, which keeps every exposure in memory for outlier detection."""
+    nbytes = sum(os.path.getsize(os.path.join(filter_dir, file)) for file in os.listdir(filter_dir) if file.endswith('cal.fits'))
+    return nbytes * config.get('stage3_memory_factor', 4.0)
+
+def process_filter(args):
+    filter_dir, reference_catalog, resample_params = args
+    try:
+        stage3(filter_dir, reference_catalog=reference_catalog, resample_params=resample_params)
+    except Exception as e:
+        log.exception(f'Stage 3 failed for {filter_dir}')
+        return filter_dir, f'{type(e).__name__}: {e}'
+    return filter_dir, None
+
+def run_filters_concurrently(filter_dirs, reference_catalog, resample_params, nproc, memory_budget, pbar=None):
+    """Run the non-reference filters on a process pool, starting a filter only while the
+    estimated memory of all running filters stays within memory_budget (bytes)."""
+    pending = sorted(((d, estimate_filter_memory(d)) for d in filter_dirs), key=lambda item: item[1], reverse=True)
+    running = {}
+    failures = []
+    with ProcessPoolExecutor(max_workers=nproc) as executor:
+        while pending or running:
+            committed = sum(mem for _, mem in running.values())
+            while pending and len(running) < nproc:
+                # Largest filter that still fits; a filter over the whole budget runs on its own
+                fit = next((i for i, (_, mem) in enumerate(pending) if committed + mem <= memory_budget), None)
+                if fit is None:
+                    if running:
+                        break
+                    fit = 0
+                    log.warning(f'{pending[0][0]} is estimated to need {pending[0][1]/1e9:.1f} GB, more than the '
+                                f'{memory_budget/1e9:.1f} GB budget. Running it on its own.')
+                filter_dir, mem = pending.pop(fit)
+                log.info(f'Starting {os.path.basename(filter_dir)} (estimated {mem/1e9:.1f} GB)')
+                running[executor.submit(process_filter, (filter_dir, reference_catalog, resample_params))] = (filter_dir, mem)
+                committed += mem
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                running.pop(future)
+                filter_dir, error = future.result()
+                if error is not None:
+                    failures.append((filter_dir, error))
+                if pbar is not None:
+                    pbar.update(1)
+    return failures
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Stage 1 of the JWST data reduction pipeline.')
     parser.add_argument('--output_dir', type=str, help='Directory where output will be written')
     parser.add_argument('--input_dir', type=str, help='Directory where output will be written')
+    parser.add_argument('--nproc', type=int, default=config.get('stage3_nproc', 1), help='Number of filters to process at the same time after the reference filter')
     args = parser.parse_args()
 
     input_dir = args.input_dir
     output_base_dir = args.output_dir
 
-    filter_mapping = {
-        'F090W': 90,
-        'F115W': 115,
-        'F150W': 150,
-        'F200W': 200,
-        'F277W': 277,
-        'F356W': 356,
-        'F410M': 410,
-        'F444W': 444,
-    }
-    
-    organize_exposures_by_filter(input_dir, output_base_dir)
+    cache = step_cache.load(output_base_dir)
+    if cache is None:
+        organize_exposures_by_filter(input_dir, output_base_dir)
+    else:
+        # Only refresh the filters whose exposures or settings changed
+        exposures = {}
+        for filename in os.listdir(input_dir):
+            if filename.endswith('cal_final.fits'):
+                full_path = os.path.join(input_dir, filename)
+                exposures.setdefault(get_filter_from_exposure(full_path), []).append(full_path)
+        pending_filters = cache.pending('stage3', list(exposures))
+        os.makedirs(output_base_dir, exist_ok=True)
+        for filter in pending_filters:
+            filter_dir = os.path.join(output_base_dir, filter)
+            if os.path.isdir(filter_dir):
+                shutil.rmtree(filter_dir)
+            for full_path in exposures[filter]:
+                copy_exposure_to_filter_dir(full_path, output_base_dir, filter)
+
+    def up_to_date(dir):
+        return cache is not None and os.path.basename(dir) not in pending_filters
+
+    def record(dir):
+        if cache is not None:
+            cache.record('stage3', os.path.basename(dir))
+
     filter_dirs = [os.path.join(output_base_dir, d) for d in os.listdir(output_base_dir) if os.path.isdir(os.path.join(output_base_dir, d))]
     filter_names = [os.path.basename(d) for d in filter_dirs]
     sorted_filters = sorted(filter_names, key=lambda x: filter_mapping[x], reverse=True)
     sorted_filter_dirs = [os.path.join(output_base_dir, f) for f in sorted_filters]
 
-    for i,dir in enumerate(tqdm(sorted_filter_dirs, file=sys.stderr)):
-        if i == 0:
-            if config['external_reference']:
-                ref_cat = config['reference_path']
-                stage3(dir, reference_catalog=ref_cat)
-            else:
-                log.info('NO REFERENCE CATALOG PROVIDED, USING GAIADR3')
-                stage3(dir)
-        
-            path_longest = dir + '/output_files/'
-            convert_catalog_to_tweakreg_format(path_longest, sorted_filters[0])
-            long_cat = os.path.join(path_longest, f'{sorted_filters[0]}.csv')
-
-            long_list = [file for file in os.listdir(path_longest) if file.endswith(f'nircam_clear-{sorted_filters[0]}_i2d.fits')]
-            long_processed_file = os.path.join(path_longest, long_list[0])
-            long_params = extract_resample_info(long_processed_file)
-        
+    def run_reference(dir):
+        if up_to_date(dir):
+            log.info(f'{os.path.basename(dir)} is up to date')
+            return reference_products(dir, sorted_filters[0], convert=False)
+        if config['external_reference']:
+            ref_cat = config['reference_path']
+            stage3(dir, reference_catalog=ref_cat)
         else:
-            stage3(dir, reference_catalog=long_cat, resample_params=long_params)
+            log.info('NO REFERENCE CATALOG PROVIDED, USING GAIADR3')
+            stage3(dir)
+        long_cat, long_params = reference_products(dir, sorted_filters[0])
+        record(dir)
+        return long_cat, long_params
+
+    if args.nproc > 1 and len(sorted_filter_dirs) > 2:
+        # The reference filter has to finish first; the remaining filters only depend on its products
+        with tqdm(total=len(sorted_filter_dirs), file=sys.stderr) as pbar:
+            long_cat, long_params = run_reference(sorted_filter_dirs[0])
+            pbar.update(1)
+
+            other_dirs = [dir for dir in sorted_filter_dirs[1:] if not up_to_date(dir)]
+            pbar.update(len(sorted_filter_dirs) - 1 - len(other_dirs))
+            memory_budget = config.get('stage3_memory_budget_gb', 0) * 1e9 or 0.8 * available_memory()
+            log.info(f'Running {len(other_dirs)} filters on {args.nproc} workers with a {memory_budget/1e9:.1f} GB memory budget')
+            failures = run_filters_concurrently(other_dirs, long_cat, long_params, args.nproc, memory_budget, pbar=pbar)
+
+        failed_dirs = [filter_dir for filter_dir, _ in failures]
+        for dir in other_dirs:
+            if dir not in failed_dirs:
+                record(dir)
+        if failures:
+            for filter_dir, error in failures:
+                log.error(f'Stage 3 failed for {os.path.basename(filter_dir)}: {error}')
+            print(f'[Stage 3 failed for {len(failures)} filters, see pipeline.log]')
+            sys.exit(1)
+
+    else:
+        for i,dir in enumerate(tqdm(sorted_filter_dirs, file=sys.stderr)):
+            if i == 0:
+                long_cat, long_params = run_reference(dir)
+            elif not up_to_date(dir):
+                stage3(dir, reference_catalog=long_cat, resample_params=long_params)
+                record(dir)
@@ -0,0 +1,83 @@
+"""
+Working precision of the full-frame arrays of the calibration steps.
+
+NIRCam SCI arrays are float32, but several steps used to promote them to
+float64 on the way: the source detection transforms (MultiScaleDetector), the
+striping patterns of the 1/f step and the row/column correction of the wisp
+fit. compute_precision in config.yaml selects
+
+    "float64"  as before.
+    "float32"  keep these arrays in float32 end to end. The smoothed images of
+               the source detection differ by up to ~1e-5 of the image rms,
+               the other results by float32 rounding, and a worker needs
+               about half the memory for them.
+
+Run this module for the accuracy check: it runs the float32 computations of
+the three steps on a simulated detector and reports how much they differ from
+the float64 ones.
+
+Use
+---
+    >>> import precision
+    >>> dtype = precision.compute_dtype(config.get('compute_precision', 'float64'))
+"""
+import numpy as np
+
+PRECISIONS = {'float64': np.float64, 'float32': np.float32}
+
+
+def compute_dtype(compute_precision):
+    """numpy type of compute_precision, 'float64' or 'float32'."""
+    if compute_precision not in PRECISIONS:
+        raise ValueError(f"Unknown compute_precision '{compute_precision}', use one of {list(PRECISIONS)}")
+    return PRECISIONS[compute_precision]
+
+
+if __name__ == '__main__':
+    import warnings
+    from clipped_stats import clipped_median
+    from multiscale_detection import MultiScaleDetector
+    warnings.filterwarnings('ignore')
+
+    rng = np.random.default_rng(6)
+    shape = (2048, 2048)
+    sci = rng.normal(0.3, 0.05, shape).astype(np.float32)
+    sci += rng.normal(0, 0.02, shape[0]).astype(np.float32)[:, None]  # 1/f striping
+    yy, xx = rng.integers(0, 2048, (2, 400))
+    for y, x in zip(yy, xx):
+        sci[max(y-6, 0):y+6, max(x-6, 0):x+6] += rng.exponential(1.0)
+    sci[rng.random(shape) < 0.001] = np.nan
+    rms = np.nanstd(sci)
+    results = {}
+
+    for name, dtype in PRECISIONS.items():
+        # Source detection (1/f source mask, background tiers)
+        detector = MultiScaleDetector(sci - np.nanmedian(sci), [25, 15, 5, 2], dtype=dtype)
+        threshold = 3 * 0.05
+        masks = [detector.source_mask(stddev, threshold, npixels=5) for stddev in detector.stddevs]
+
+        # 1/f striping patterns, as in measure_striping
+        mask = masks[0] | ~np.isfinite(sci)
+        horizontal_striping = np.zeros(shape, dtype=dtype)
+        horizontal_striping[:] = clipped_median(sci, mask, axis=1, sigma=2.)[:, None]
+        vertical_striping = np.zeros(shape, dtype=dtype)
+        vertical_striping[:] = clipped_median(sci - horizontal_striping, mask, axis=0, sigma=2.)
+        cleaned = (sci - horizontal_striping - vertical_striping).astype(np.float32)
+
+        # Row correction of the wisp fit
+        data_masked = np.where(mask, np.nan, sci)
+        med = np.nanmedian(data_masked)
+        collapsed_rows = np.nanmedian(data_masked - med, axis=1).astype(dtype)
+        collapsed_cols = np.zeros(shape[1], dtype=dtype)
+        corrected = data_masked - (collapsed_rows[:, None] + collapsed_cols[None, :])
+
+        results[name] = (detector, masks, cleaned, corrected)
+
+    detector64, masks64, cleaned64, corrected64 = results['float64']
+    detector32, masks32, cleaned32, corrected32 = results['float32']
+    for stddev, mask64, mask32 in zip(detector64.stddevs, masks64, masks32):
+        difference = np.nanmax(np.abs(detector64.convolve(stddev) - detector32.convolve(stddev))) / rms
+        print(f'source detection, stddev {stddev}: max difference {difference:.2g} x rms, '
+              f'{np.sum(mask64 != mask32)} of {mask64.size} mask pixels differ')
+    print(f'1/f cleaned image: max difference {np.nanmax(np.abs(cleaned64 - cleaned32)) / rms:.2g} x rms')
+    print(f'wisp row-corrected image: max difference {np.nanmax(np.abs(corrected64 - corrected32)) / rms:.2g} x rms')
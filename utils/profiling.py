@@ -0,0 +1,220 @@
+"""
+cProfile of sampled pool worker tasks, merged into one report per step.
+
+The heavy work of the 1/f noise, wisp and background steps happens in their
+pool workers, where an external profiler cannot easily attach. With
+--profile N, a step runs every Nth task of its pool (an exposure, a batch of
+exposures with async I/O, or a longwave group of the wisp step) under cProfile
+in the worker. Each profiled task writes its stats to a part file in the output
+directory, and when the pool is done the parent merges them into
+
+    profile_<step>.pstats     the merged stats, for pstats, snakeviz, ...
+    profile_<step>.collapsed  collapsed stacks, one "frame;frame;frame microseconds" line each,
+                              for flamegraph.pl or speedscope
+
+and logs the time spent in each package (astropy, photutils, numpy, scipy,
+the pipeline's own modules, ...). The time of built-in functions, e.g. the
+numpy C routines, counts for the package that called them.
+
+cProfile records which function called which, not whole stacks, so the
+collapsed stacks split the time of a function among its callers in proportion
+to the time it spent under each of them. A profiled task runs slower, by up to
+about 2x for code spending its time in Python rather than in numpy.
+
+Run this module for the summary of a merged profile:
+
+    >>> python utils/profiling.py output/stage2_output/profile_background_subtraction.pstats --top 30
+
+Use
+---
+    >>> task, items = profiling.sample(process_file, pool_args, 'background_subtraction', every, output_dir)
+    >>> for result in pool.imap_unordered(task, items):
+    ...     ...
+    >>> profiling.merge('background_subtraction', output_dir)
+"""
+import argparse
+import cProfile
+import logging
+import os
+import pstats
+from glob import glob
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+log_file_path = 'pipeline.log'
+file_handler = logging.FileHandler(log_file_path, mode='a')
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+log.addHandler(file_handler)
+
+UTILS_DIR = os.path.dirname(os.path.abspath(__file__))
+# Shortest stack (s) written to the collapsed stacks
+MIN_STACK_TIME = 1e-6
+
+
+def part_files(step, directory):
+    """Stats files of the profiled tasks of step not merged yet."""
+    return sorted(glob(os.path.join(directory, f'profile_{step}.part-*.prof')))
+
+
+class ProfiledTask:
+    """func on (index, item) pairs, under cProfile for every every-th index.
+
+    Pickled to the pool workers, so func must be picklable (a module-level function or a partial of one).
+    """
+
+    def __init__(self, func, step, every, directory):
+        self.func = func
+        self.step = step
+        self.every = every
+        self.directory = directory
+
+    def __call__(self, indexed):
+        index, item = indexed
+        if index % self.every:
+            return self.func(item)
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(self.func, item)
+        finally:
+            profiler.dump_stats(os.path.join(self.directory, f'profile_{self.step}.part-{os.getpid()}-{index}.prof'))
+
+
+def sample(func, items, step, every, directory):
+    """Task function and items for Pool.imap_unordered that profile every every-th item of step.
+
+    With every 0 (profiling off) func and items are returned unchanged. Part files left by an
+    interrupted run of step in directory are removed.
+    """
+    if not every:
+        return func, items
+    for part in part_files(step, directory):
+        os.remove(part)
+    return ProfiledTask(func, step, every, directory), enumerate(items)
+
+
+def label(func):
+    """Flamegraph frame of a pstats function key (filename, line, name)."""
+    filename, line, name = func
+    name = name.replace(';', ',')
+    if filename == '~':
+        return name
+    return f'{name} ({os.path.basename(filename)}:{line})'
+
+
+def collapsed_stacks(stats, min_time=MIN_STACK_TIME):
+    """Self time (s) of each stack of labels, from the caller-callee times of stats.
+
+    A function gets the share of its time it spent under the caller on the stack. Recursive calls end
+    the stack; the times within recursive code (e.g. nested imports) are only approximate.
+    """
+    entries = stats.stats
+    children = {}
+    for func, (cc, nc, tt, ct, callers) in entries.items():
+        for caller in callers:
+            children.setdefault(caller, []).append(func)
+
+    stacks = {}
+    # (function, labels of the stack down to it, functions of the stack, fraction of its time on this stack)
+    pending = [(func, (), frozenset(), 1.0) for func, entry in entries.items() if not entry[4]]
+    while pending:
+        func, stack, path, fraction = pending.pop()
+        cc, nc, tt, ct, callers = entries[func]
+        stack = stack + (label(func),)
+        path = path | {func}
+        if tt * fraction > 0:
+            stacks[stack] = stacks.get(stack, 0.) + tt * fraction
+        for child in children.get(func, []):
+            child_ct = entries[child][3]
+            if child in path or child_ct <= 0:
+                continue
+            # Share of the time of child spent under func
+            child_fraction = fraction * entries[child][4][func][3] / child_ct
+            if child_ct * child_fraction >= min_time:
+                pending.append((child, stack, path, child_fraction))
+    return stacks
+
+
+def write_collapsed(stats, path):
+    """Write the collapsed stacks of stats to path, in microseconds."""
+    with open(path, 'w') as f:
+        for stack, seconds in sorted(collapsed_stacks(stats).items()):
+            microseconds = int(round(seconds * 1e6))
+            if microseconds > 0:
+                f.write(';'.join(stack) + f' {microseconds}\n')
+
+
+def package(filename):
+    """Package of a profiled source file: 'pipeline' for utils/, the top-level package for the
+    installed ones, 'python' for the standard library."""
+    path = os.path.abspath(filename)
+    if os.path.dirname(path) == UTILS_DIR:
+        return 'pipeline'
+    parts = path.split(os.sep)
+    for directory in ('site-packages', 'dist-packages'):
+        if directory in parts[:-1]:
+            top = parts[len(parts) - 1 - parts[::-1].index(directory) + 1]
+            return top.split('.')[0]
+    return 'python'
+
+
+def package_times(stats):
+    """Self time (s) of each package, built-in functions counting for the packages of their callers."""
+    times = {}
+    for (filename, line, name), (cc, nc, tt, ct, callers) in stats.stats.items():
+        if filename != '~':
+            times[package(filename)] = times.get(package(filename), 0.) + tt
+            continue
+        called = sum(edge[2] for edge in callers.values())
+        if not callers or called <= 0:
+            times['builtins'] = times.get('builtins', 0.) + tt
+            continue
+        for caller, edge in callers.items():
+            owner = 'builtins' if caller[0] == '~' else package(caller[0])
+            times[owner] = times.get(owner, 0.) + tt * edge[2] / called
+    return times
+
+
+def summary(stats):
+    """Lines of the time spent in each package."""
+    total = max(stats.total_tt, 1e-9)
+    lines = [f'{"package":<24}{"seconds":>10}{"share":>8}']
+    for name, seconds in sorted(package_times(stats).items(), key=lambda item: -item[1]):
+        lines.append(f'{name:<24}{seconds:>10.1f}{100 * seconds / total:>7.1f}%')
+    return lines
+
+
+def merge(step, directory):
+    """Merge the part files of step in directory into profile_<step>.pstats and profile_<step>.collapsed.
+
+    Returns the merged pstats.Stats, None if no task was profiled.
+    """
+    parts = part_files(step, directory)
+    if not parts:
+        return None
+    stats = pstats.Stats(*parts)
+    path = os.path.join(directory, f'profile_{step}.pstats')
+    stats.dump_stats(path)
+    write_collapsed(stats, os.path.join(directory, f'profile_{step}.collapsed'))
+    for part in parts:
+        os.remove(part)
+    log.info(f'{step}: {len(parts)} profiled tasks merged into {path}, {stats.total_tt:.1f} s')
+    for line in summary(stats):
+        log.info(f'  {line}')
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summary of a merged profile of a step.')
+    parser.add_argument('pstats_file', type=str, help='profile_<step>.pstats written by the step')
+    parser.add_argument('--top', type=int, default=20, help='Number of functions to list by own and by cumulative time')
+    parser.add_argument('--collapsed', type=str, default='', help='Also write the collapsed stacks to this file')
+    args = parser.parse_args()
+
+    stats = pstats.Stats(args.pstats_file)
+    print('\n'.join(summary(stats)))
+    stats.sort_stats('tottime').print_stats(args.top)
+    stats.sort_stats('cumulative').print_stats(args.top)
+    if args.collapsed:
+        write_collapsed(stats, args.collapsed)
+        print(f'Collapsed stacks written to {args.collapsed}')
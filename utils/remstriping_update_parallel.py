@@ -15,18 +15,26 @@ import argparse
 import numpy as np
 from astropy.io import fits
 import astropy.stats as astrostats
-from astropy.convolution import Ring2DKernel, Gaussian2DKernel, convolve_fft
+from astropy.convolution import Gaussian2DKernel
 from scipy.optimize import curve_fit
 from scipy.ndimage import binary_dilation
-from scipy.ndimage import median_filter
-from photutils.segmentation import SegmentationImage, detect_sources
 from glob import glob
 from jwst.datamodels import ImageModel, FlatModel, dqflags
 from jwst.flatfield.flat_field import do_correction
 from stdatamodels import util
 import crds
-from multiprocessing import Pool, cpu_count
 from tqdm.auto import tqdm
+import step_cache
+from clipped_stats import clipped_median
+from multiscale_detection import MultiScaleDetector
+from ring_median import ring_median
+import source_mask
+import robust_stats
+import async_io
+import precision
+import worker_pool
+import run_report
+import profiling
 
 with open('config.yaml', 'r') as config_file:
     config = yaml.safe_load(config_file)
@@ -69,6 +77,41 @@ for handler in stpipe_log.handlers:
         
 MASKTHRESH = 0.8
 
+# Read each rate file once and write the corrected file once (see measure_striping)
+MINIMAL_IO = config.get('fnoise_minimal_io', False)
+FNOISE_BACKUP = config.get('fnoise_backup', 'none')
+
+# 'vectorized' (clipped_stats.py) or 'astropy' for the clipped row/column medians
+STATS_ENGINE = config.get('fnoise_stats_engine', 'vectorized')
+
+# Ring median filter of the source masking (see ring_median.py)
+RING_MEDIAN = {'method': config.get('ring_median_method', 'blocked'),
+               'nthreads': config.get('ring_median_threads', 1),
+               'validate': config.get('ring_median_validate', False)}
+
+# Threads for the scipy.fft transforms of the source masking (see multiscale_detection.py)
+FFT_THREADS = config.get('fft_threads', 1)
+
+# 'exact' or 'fast' (subsampled) global statistics of the source masking (see robust_stats.py)
+ROBUST_STATS_MODE = robust_stats.step_mode(config, 'fnoise_correction')
+
+# Exposures read ahead and written behind per worker, 0 for blocking I/O (see async_io.py)
+ASYNC_IO_DEPTH = config.get('async_io_depth', 0)
+ASYNC_IO_BATCH = config.get('async_io_batch', 4)
+
+# 'float64' or 'float32' source detection and striping patterns (see precision.py)
+COMPUTE_PRECISION = config.get('compute_precision', 'float64')
+DTYPE = precision.compute_dtype(COMPUTE_PRECISION)
+
+# Settings of the background step for the background tiers of the shared source masks (see bkg_sub_parallel.configure)
+BACKGROUND_SETTINGS = {'compute_precision': COMPUTE_PRECISION,
+                       'robust_stats_mode': robust_stats.step_mode(config, 'background_subtraction'),
+                       'background_threads': config.get('background_threads', 1),
+                       'fft_threads': config.get('fft_threads', 1)}
+
+# Directory of the source masks shared with the wisp and background steps (see source_mask.py), '' to disable
+SOURCE_MASK_DIR = config.get('source_mask_dir', '')
+
 NIR_reference_sections = {'A': {'top': (2044, 2048, 0, 512),
                                 'bottom': (0, 4, 0, 512),
                                 'side': (0, 2048, 0, 4),
@@ -108,6 +151,8 @@ def fit_sky(data):
 
 def collapse_image(im, mask, dimension='y', sig=2.):
     """collapse an image along one dimension to check for striping."""
+    if STATS_ENGINE == 'vectorized':
+        return clipped_median(im, mask, axis=1 if dimension == 'y' else 0, sigma=sig)
     if dimension == 'y':
         res = astrostats.sigma_clipped_stats(im, mask=mask, sigma=sig, 
                                              cenfunc='median',
@@ -118,9 +163,29 @@ def collapse_image(im, mask, dimension='y', sig=2.):
                                              stdfunc='std', axis=0)
     return res[1]
 
-def masksources(image, output_dir):
-    """Detect sources in an image using a tiered approach for different source sizes."""
-    model = ImageModel(image)
+def collapse_amps(im, mask, amp_columns, sig=2.):
+    """collapse each amplifier strip along its rows, returns an array of shape (namps, nrows)."""
+    if STATS_ENGINE == 'vectorized':
+        # All strips in one call, padded to the same width with NaN (ignored)
+        width = max(colstop - colstart for colstart, colstop in amp_columns)
+        strips = np.full((len(amp_columns), im.shape[0], width), np.nan, dtype=im.dtype)
+        strip_mask = np.zeros(strips.shape, dtype=bool)
+        for k, (colstart, colstop) in enumerate(amp_columns):
+            strips[k, :, :colstop-colstart] = im[:, colstart:colstop]
+            strip_mask[k, :, :colstop-colstart] = mask[:, colstart:colstop]
+        res = clipped_median(strips.reshape(-1, width), strip_mask.reshape(-1, width), axis=1, sigma=sig)
+        return res.reshape(len(amp_columns), im.shape[0])
+    return np.array([collapse_image(im[:, colstart:colstop], mask[:, colstart:colstop], dimension='y', sig=sig)
+                     for colstart, colstop in amp_columns])
+
+def masksources(image, output_dir, model=None, save_mask=True):
+    """Detect sources in an image using a tiered approach for different source sizes.
+
+    model is the already opened rate image, if available. With save_mask=False the
+    mask is only returned, not written to disk.
+    """
+    if model is None:
+        model = ImageModel(image)
     sci = model.data
     err = model.err
     wht = model.wht
@@ -132,60 +197,55 @@ def masksources(image, output_dir):
 
     log.info('masking, estimating background')
     sci_nan = np.choose(np.isnan(err), (sci, err))
-    robust_mean_background = astrostats.biweight_location(sci_nan, c=6., ignore_nan=True)
+    robust_mean_background = robust_stats.biweight_location(sci_nan, c=6., ignore_nan=True, mode=ROBUST_STATS_MODE)
     sci_filled = np.copy(sci)
     sci_filled[np.isnan(sci)] = robust_mean_background
     
     log.info('masking, initial source mask')
-    ring = Ring2DKernel(40, 3)
-    filtered = median_filter(sci_filled, footprint=ring.array)
-
-    log.info('masking, mask tier 1')
-    convolved_difference = convolve_fft(sci-filtered, Gaussian2DKernel(25))
-    threshold = 3 * astrostats.mad_std(convolved_difference)
-    segm_array = detect_sources(convolved_difference, threshold, npixels=15)
-    segm = SegmentationImage(segm_array.data.astype(int))
-    mask1 = segm.make_source_mask()
-
-    temp = np.zeros(sci.shape)
-    temp[mask1] = 1
-    sources = np.logical_not(temp == 0)
-    dilation_sigma = 10
-    dilation_window = 11
-    dilation_kernel = Gaussian2DKernel(dilation_sigma, x_size=dilation_window, y_size=dilation_window)
-    source_wings = binary_dilation(sources, dilation_kernel)
-    temp[source_wings] = 1
-    mask1 = np.logical_not(temp == 0)
-
-    log.info('masksources: mask tier 2')
-    convolved_difference = convolve_fft(sci-filtered, Gaussian2DKernel(15))
-    threshold = 3 * astrostats.mad_std(convolved_difference)
-    segm_array = detect_sources(convolved_difference, threshold, npixels=15)
-    segm = SegmentationImage(segm_array.data.astype(int))
-    mask2 = segm.make_source_mask() | mask1
-
-    log.info('masksources: mask tier 3')
-    convolved_difference = convolve_fft(sci-filtered, Gaussian2DKernel(5))
-    threshold = 3 * astrostats.mad_std(convolved_difference)
-    segm_array = detect_sources(convolved_difference, threshold, npixels=5)
-    segm = SegmentationImage(segm_array.data.astype(int))
-    mask3 = segm.make_source_mask() | mask2
-
-    log.info('masksources: mask tier 4')
-    convolved_difference = convolve_fft(sci-filtered, Gaussian2DKernel(2))
-    threshold = 3 * astrostats.mad_std(convolved_difference)
-    segm_array = detect_sources(convolved_difference, threshold, npixels=3)
-    segm = SegmentationImage(segm_array.data.astype(int))
-    mask4 = segm.make_source_mask() | mask3
-
-    finalmask = mask4
+    with run_report.phase('ring_median'):
+        filtered = ring_median(sci_filled, 40, 3, **RING_MEDIAN)
+
+    with run_report.phase('tier_masks'):
+        # All four tiers smooth the same difference image, transform it once
+        difference = sci - filtered
+        detector = MultiScaleDetector(difference, [25, 15, 5, 2], workers=FFT_THREADS, dtype=DTYPE)
+
+        log.info('masking, mask tier 1')
+        threshold = 3 * robust_stats.mad_std(detector.convolve(25), mode=ROBUST_STATS_MODE)
+        mask1 = detector.source_mask(25, threshold, npixels=15)
+
+        # Add the wings of the sources
+        dilation_sigma = 10
+        dilation_window = 11
+        dilation_kernel = Gaussian2DKernel(dilation_sigma, x_size=dilation_window, y_size=dilation_window)
+        mask1 = mask1 | binary_dilation(mask1, dilation_kernel)
+
+        log.info('masksources: mask tier 2')
+        threshold = 3 * robust_stats.mad_std(detector.convolve(15), mode=ROBUST_STATS_MODE)
+        mask2 = detector.source_mask(15, threshold, npixels=15) | mask1
+
+        log.info('masksources: mask tier 3')
+        threshold = 3 * robust_stats.mad_std(detector.convolve(5), mode=ROBUST_STATS_MODE)
+        mask3 = detector.source_mask(5, threshold, npixels=5) | mask2
+
+        log.info('masksources: mask tier 4')
+        threshold = 3 * robust_stats.mad_std(detector.convolve(2), mode=ROBUST_STATS_MODE)
+        mask4 = detector.source_mask(2, threshold, npixels=3) | mask3
+
+        finalmask = mask4
+
+    if SOURCE_MASK_DIR:
+        log.info('masksources: adding the wisp and background masks to the shared source mask')
+        source_mask.make_product(image, SOURCE_MASK_DIR, sci, err, dq, difference, finalmask,
+                                 background_settings=BACKGROUND_SETTINGS)
 
-    outputbase = os.path.join(output_dir, os.path.basename(image))
-    maskname = outputbase.replace('.fits', '_1fmask_new.fits')
-    log.info('masksources: saving mask to %s' % maskname)
     outmask = np.zeros(finalmask.shape, dtype=int)
     outmask[finalmask] = 1
-    fits.writeto(maskname, outmask, overwrite=True)
+    if save_mask:
+        outputbase = os.path.join(output_dir, os.path.basename(image))
+        maskname = outputbase.replace('.fits', '_1fmask_new.fits')
+        log.info('masksources: saving mask to %s' % maskname)
+        fits.writeto(maskname, outmask, overwrite=True)
     return outmask
 
 def measure_fullimage_striping(fitdata, mask):
@@ -196,15 +256,34 @@ def measure_fullimage_striping(fitdata, mask):
     vertical_striping = collapse_image(temp_image2, mask, dimension='x')
     return horizontal_striping, vertical_striping
 
-def measure_striping(image, origfilename, output_dir, thresh=None, apply_flat=True, mask_sources=True, save_patterns=False, flat_file=None):
-    """Removes striping in rate.fits files before flat fielding."""
+def measure_striping(image, origfilename, output_dir, thresh=None, apply_flat=True, mask_sources=True, save_patterns=False, flat_file=None,
+                     minimal_io=MINIMAL_IO, backup=FNOISE_BACKUP, model=None, writer=None):
+    """Removes striping in rate.fits files before flat fielding.
+
+    With minimal_io the rate file is read once, the flat-fielded copy and the source
+    mask stay in memory, and the cleaned image replaces the rate file atomically.
+    backup then sets what is kept of the original image:
+        'none'    - nothing
+        'link'    - a hardlink to the original file at origfilename
+        'copy'    - a copy of the original file at origfilename
+        'vectors' - the measured striping patterns (_1fpattern.fits), which were
+                    subtracted from every non-zero pixel
+
+    model is the already opened rate image, if any. With minimal_io and an
+    async_io.WriteBehind writer, the cleaned image is written by the writer.
+    """
     
     if thresh is None:
         thresh = MASKTHRESH
 
     outputbase = os.path.join(output_dir, os.path.basename(image))
 
-    model = ImageModel(image)
+    if model is None:
+        model = ImageModel(image)
+    original = model if minimal_io else None
+    if minimal_io:
+        # Flat fielding and the pedestal subtraction below work on a copy, original is saved at the end
+        model = original.copy()
     log.info('Measuring image striping')
     log.info('Working on %s' % os.path.basename(image))
 
@@ -216,8 +295,10 @@ def measure_striping(image, origfilename, output_dir, thresh=None, apply_flat=Tr
             exit()
         log.info('Using flat: %s' % (os.path.basename(flatfile)))
         with FlatModel(flatfile) as flat:
+            # Depending on the jwst version do_correction corrects its input in place or a copy of it
             model, applied_flat = do_correction(model, flat)
-            model.save(outputbase.replace('.fits', '_flat-fielded.fits'))
+            if not minimal_io:
+                model.save(outputbase.replace('.fits', '_flat-fielded.fits'))
 
     mask = np.zeros(model.data.shape, dtype=bool)
     mask[model.dq > 0] = True
@@ -229,7 +310,7 @@ def measure_striping(image, origfilename, output_dir, thresh=None, apply_flat=Tr
             seg = fits.getdata(srcmask)
         else:
             log.info('Detecting sources to mask out source flux')
-            seg = masksources(image, output_dir)
+            seg = masksources(image, output_dir, model=original, save_mask=not minimal_io)
         wobj = np.where(seg > 0)
         mask[wobj] = True
 
@@ -247,34 +328,35 @@ def measure_striping(image, origfilename, output_dir, thresh=None, apply_flat=Tr
         log.info('Fit pedestal: %f' % pedestal)
 
     model.data -= pedestal
-    full_horizontal, vertical_striping = measure_fullimage_striping(model.data, mask)
-
-    horizontal_striping = np.zeros(model.data.shape)
-    vertical_striping = np.zeros(model.data.shape)
-
-    ampcounts = []
-    for amp in ['A', 'B', 'C', 'D']:
-        ampcount = 0
-        rowstart, rowstop, colstart, colstop = NIR_amps[amp]['data']
-        ampdata = model.data[:, colstart:colstop]
-        ampmask = mask[:, colstart:colstop]
-        hstriping_amp = collapse_image(ampdata, ampmask, dimension='y')
-        nmask = np.sum(ampmask, axis=1)
-        for i, row in enumerate(ampmask):
-            if nmask[i] > (ampmask.shape[1] * thresh):
-                horizontal_striping[i, colstart:colstop] = full_horizontal[i]
-                ampcount += 1
-            else:
-                horizontal_striping[i, colstart:colstop] = hstriping_amp[i]
-                if hstriping_amp[i] > 2 * (np.nanstd(full_horizontal)):
-                    horizontal_striping[i, colstart:colstop] = full_horizontal[i]
-        ampcounts.append('%s-%i' % (amp, ampcount))
+    # Only the full-row medians are needed here, the vertical pattern is measured below
+    with run_report.phase('collapse_image'):
+        full_horizontal = collapse_image(model.data, mask, dimension='y')
+
+    horizontal_striping = np.zeros(model.data.shape, dtype=DTYPE)
+    vertical_striping = np.zeros(model.data.shape, dtype=DTYPE)
+
+    amps = ['A', 'B', 'C', 'D']
+    amp_columns = [NIR_amps[amp]['data'][2:] for amp in amps]
+    with run_report.phase('collapse_image'):
+        hstriping_amps = collapse_amps(model.data, mask, amp_columns)
+    nmask = np.array([np.sum(mask[:, colstart:colstop], axis=1) for colstart, colstop in amp_columns])
+    widths = np.array([colstop - colstart for colstart, colstop in amp_columns])
+    # Use the full-row median where too much of the amp-row is masked, or where the amp median is too high
+    full_rows = nmask > (widths[:, None] * thresh)
+    with np.errstate(invalid='ignore'):
+        high_rows = ~full_rows & (hstriping_amps > 2 * (np.nanstd(full_horizontal)))
+    amp_striping = np.where(full_rows | high_rows, full_horizontal[None, :], hstriping_amps)
+    for (colstart, colstop), striping in zip(amp_columns, amp_striping):
+        horizontal_striping[:, colstart:colstop] = striping[:, None]
+    ampcounts = ['%s-%i' % (amp, ampcount) for amp, ampcount in zip(amps, full_rows.sum(axis=1))]
+    rowstart, rowstop = NIR_amps['D']['data'][:2]
 
     ampinfo = ', '.join(ampcounts)
     log.info('%s, full row medians used: %s /%i' % (os.path.basename(image), ampinfo, rowstop-rowstart))
 
     temp_sub = model.data - horizontal_striping
-    vstriping = collapse_image(temp_sub, mask, dimension='x')
+    with run_report.phase('collapse_image'):
+        vstriping = collapse_image(temp_sub, mask, dimension='x')
     vertical_striping[:, :] = vstriping
 
     if save_patterns:
@@ -282,24 +364,19 @@ def measure_striping(image, origfilename, output_dir, thresh=None, apply_flat=Tr
         fits.writeto(outputbase.replace('.fits', '_vert.fits'), vertical_striping, overwrite=True)
         fits.writeto(outputbase.replace('.fits', '_full_horizontal.fits'), full_horizontal, overwrite=True)
 
-    model.close()
+    model.close()  # the working copy with minimal_io
+
+    if minimal_io:
+        remove_striping(original, horizontal_striping, vertical_striping)
+        log.info('Saving cleaned image to %s' % outputbase)
+        if writer is not None:
+            writer.submit(save_rate_file, original, image, origfilename, backup, horizontal_striping, vertical_striping)
+        else:
+            save_rate_file(original, image, origfilename, backup, horizontal_striping, vertical_striping)
+        return
 
     with ImageModel(image) as immodel:
-        sci = immodel.data
-        wzero = np.where(sci == 0)
-        temp_sci = sci - horizontal_striping
-        outsci = temp_sci - vertical_striping
-        outsci[wzero] = 0
-        wnan = np.isnan(outsci)
-        bpflag = dqflags.pixel['DO_NOT_USE']
-        outsci[wnan] = 0
-        immodel.dq[wnan] = np.bitwise_or(immodel.dq[wnan], bpflag)
-        immodel.data = outsci
-        time = datetime.now()
-        stepdescription = 'Removed horizontal,vertical striping; remstriping.py %s' % time.strftime('%Y-%m-%d %H:%M:%S')
-        software_dict = {'name': 'remstriping.py', 'author': 'Micaela Bagley', 'version': '1.0', 'homepage': 'ceers.github.io'}
-        substr = util.create_history_entry(stepdescription, software=software_dict)
-        immodel.history.append(substr)
+        remove_striping(immodel, horizontal_striping, vertical_striping)
         log.info('Saving cleaned image to %s' % outputbase)
         original_file = image  # This is the 'rate.fits' file
         backup_file = origfilename #image.replace('rate.fits', 'rate_pre_fnoise.fits')  # This will be 'rate_pre_fnoise.fits'
@@ -329,6 +406,56 @@ def measure_striping(image, origfilename, output_dir, thresh=None, apply_flat=Tr
             else:
                 log.error("Temporary file not found after save operation")
 
+def remove_striping(immodel, horizontal_striping, vertical_striping):
+    """Subtract the striping patterns from an opened rate image and add a history entry."""
+    sci = immodel.data
+    wzero = np.where(sci == 0)
+    temp_sci = sci - horizontal_striping
+    outsci = temp_sci - vertical_striping
+    outsci[wzero] = 0
+    wnan = np.isnan(outsci)
+    bpflag = dqflags.pixel['DO_NOT_USE']
+    outsci[wnan] = 0
+    immodel.dq[wnan] = np.bitwise_or(immodel.dq[wnan], bpflag)
+    immodel.data = outsci
+    time = datetime.now()
+    stepdescription = 'Removed horizontal,vertical striping; remstriping.py %s' % time.strftime('%Y-%m-%d %H:%M:%S')
+    software_dict = {'name': 'remstriping.py', 'author': 'Micaela Bagley', 'version': '1.0', 'homepage': 'ceers.github.io'}
+    substr = util.create_history_entry(stepdescription, software=software_dict)
+    immodel.history.append(substr)
+
+def replace_rate_file(immodel, image, origfilename, backup, horizontal_striping, vertical_striping):
+    """Write the cleaned image over the rate file with a single atomic rename, keeping the requested backup."""
+    if backup in ('link', 'copy'):
+        if os.path.exists(origfilename):
+            os.remove(origfilename)
+        if backup == 'link':
+            os.link(image, origfilename)  # keeps the original data once the rate file name is replaced
+        else:
+            shutil.copy2(image, origfilename)
+        log.info(f"Kept original file as {origfilename}")
+    elif backup == 'vectors':
+        # One value per row and amplifier, and one per column
+        amp_columns = [NIR_amps[amp]['data'][2] for amp in ['A', 'B', 'C', 'D']]
+        patternfile = image.replace('rate.fits', 'rate_1fpattern.fits')
+        hdul = fits.HDUList([fits.PrimaryHDU(),
+                             fits.ImageHDU(horizontal_striping[:, amp_columns], name='HORIZONTAL'),
+                             fits.ImageHDU(vertical_striping[0], name='VERTICAL')])
+        hdul.writeto(patternfile, overwrite=True)
+        log.info(f"Saved striping patterns to {patternfile}")
+    elif backup != 'none':
+        raise ValueError(f"Unknown fnoise_backup option '{backup}'")
+
+    temporary_file = image.replace('rate.fits', 'rate_tmp.fits')
+    immodel.save(temporary_file)
+    os.replace(temporary_file, image)
+    log.info(f"Replaced {image}")
+
+def save_rate_file(immodel, *args):
+    """replace_rate_file(immodel, *args), then close immodel."""
+    replace_rate_file(immodel, *args)
+    immodel.close()
+
 def cleanup_intermediate_files(output_dir, image_filename):
     base_filename = os.path.basename(image_filename).replace('rate.fits', '')
     intermediate_files = [
@@ -344,10 +471,43 @@ def cleanup_intermediate_files(output_dir, image_filename):
             except Exception as e:
                 log.error(f"Error deleting file: {file}, {e}")
 
+def get_flat_file(image):
+    """Look up the CRDS flat reference file for a rate image."""
+    model = ImageModel(image)
+    crds_dict = {
+        'INSTRUME': 'NIRCAM',
+        'DETECTOR': model.meta.instrument.detector,
+        'FILTER': model.meta.instrument.filter,
+        'PUPIL': model.meta.instrument.pupil,
+        'DATE-OBS': model.meta.observation.date,
+        'TIME-OBS': model.meta.observation.time
+    }
+    model.close()
+    flats = crds.getreferences(crds_dict, reftypes=['flat'])
+    return flats.get('flat')
+
 def process_file(args):
     image, pre1f, output_dir, thresh, apply_flat, mask_sources, save_patterns, flat_file = args
-    measure_striping(image, pre1f, output_dir, thresh=thresh, apply_flat=apply_flat, mask_sources=mask_sources, save_patterns=save_patterns, flat_file=flat_file)
-    cleanup_intermediate_files(output_dir, image)
+    with run_report.exposure('fnoise_correction', image):
+        measure_striping(image, pre1f, output_dir, thresh=thresh, apply_flat=apply_flat, mask_sources=mask_sources, save_patterns=save_patterns, flat_file=flat_file)
+    if not MINIMAL_IO:
+        cleanup_intermediate_files(output_dir, image)
+    return image
+
+def process_batch(batch):
+    """process_file() for a list of its args, reading the next rate file and (with
+    fnoise_minimal_io) writing the previous result in background threads (see async_io.py)."""
+    with async_io.WriteBehind(ASYNC_IO_DEPTH) as writer, \
+         async_io.Prefetcher(batch, lambda args: ImageModel(args[0]), ASYNC_IO_DEPTH) as inputs:
+        for args, model in inputs:
+            image, pre1f, output_dir, thresh, apply_flat, mask_sources, save_patterns, flat_file = args
+            with run_report.exposure('fnoise_correction', image):
+                measure_striping(image, pre1f, output_dir, thresh=thresh, apply_flat=apply_flat, mask_sources=mask_sources,
+                                 save_patterns=save_patterns, flat_file=flat_file, model=model,
+                                 writer=writer if MINIMAL_IO else None)
+            if not MINIMAL_IO:
+                cleanup_intermediate_files(output_dir, image)
+    return [args[0] for args in batch]
 
 def main():
     parser = argparse.ArgumentParser(description='Measure and remove horizontal and vertical striping pattern (1/f noise) from rate file')
@@ -361,6 +521,7 @@ def main():
     parser.add_argument('image', nargs='?', type=str, help='Filename of rate image for pattern subtraction (required if --runone is not used)')
     parser.add_argument('--apply_flat', dest='apply_flat', action=argparse.BooleanOptionalAction, required=False, default=True)
     parser.add_argument('--mask_sources', dest='mask_sources', action=argparse.BooleanOptionalAction, required=False, default=True)
+    parser.add_argument('--profile', type=int, default=0, help='With --runall, run every Nth task of the workers under cProfile (see profiling.py), 0 to disable')
     args = parser.parse_args()
 
     if args.runone:
@@ -368,6 +529,13 @@ def main():
     elif args.runall:
         images = glob(os.path.join(args.output_dir, '*rate.fits'))
         images.sort()
+
+    cache = step_cache.load(args.output_dir)
+    cache_params = {'thresh': args.thresh, 'apply_flat': args.apply_flat, 'mask_sources': args.mask_sources}
+    if cache is not None:
+        images = cache.pending('fnoise_correction', images, params=cache_params)
+        if not images:
+            return
         
     crds_context = os.environ.get('CRDS_CONTEXT', None)
     if not crds_context:
@@ -375,30 +543,36 @@ def main():
     # Pre-fetch flats for all images
     flats_dict = {}
     for image in images:
-        model = ImageModel(image)
-        crds_dict = {
-            'INSTRUME': 'NIRCAM',
-            'DETECTOR': model.meta.instrument.detector,
-            'FILTER': model.meta.instrument.filter,
-            'PUPIL': model.meta.instrument.pupil,
-            'DATE-OBS': model.meta.observation.date,
-            'TIME-OBS': model.meta.observation.time
-        }
-        flats = crds.getreferences(crds_dict, reftypes=['flat'])
-        if 'flat' in flats:
-            flats_dict[image] = flats['flat']
-            log.info(f'Flat file {flats["flat"]} for {os.path.basename(image)} is available.')
+        flat_file = get_flat_file(image)
+        if flat_file is not None:
+            flats_dict[image] = flat_file
+            log.info(f'Flat file {flat_file} for {os.path.basename(image)} is available.')
 
     if args.runone:
         pre1f = images[0].replace('rate.fits', 'rate_pre1f.fits')
-        measure_striping(images[0], pre1f, args.output_dir, thresh=args.thresh, apply_flat=args.apply_flat, mask_sources=args.mask_sources, save_patterns=args.save_patterns, flat_file=flats_dict[images[0]])
-        cleanup_intermediate_files(args.output_dir, args.runone)
+        with run_report.exposure('fnoise_correction', images[0]):
+            measure_striping(images[0], pre1f, args.output_dir, thresh=args.thresh, apply_flat=args.apply_flat, mask_sources=args.mask_sources, save_patterns=args.save_patterns, flat_file=flats_dict[images[0]])
+        if not MINIMAL_IO:
+            cleanup_intermediate_files(args.output_dir, args.runone)
+        if cache is not None:
+            cache.record('fnoise_correction', images[0], params=cache_params)
     elif args.runall:
         pool_args = [(rate, rate.replace('rate.fits', 'rate_pre1f.fits'), args.output_dir, args.thresh, args.apply_flat, args.mask_sources, args.save_patterns, flats_dict[rate]) for rate in images]
-        with Pool(processes=cpu_count()) as pool:
+        with worker_pool.MemoryAwarePool.from_config(config, 'fnoise_correction') as pool:
             with tqdm(total=len(pool_args), file=sys.stdout) as pbar:
-                for _ in pool.imap_unordered(process_file, pool_args):
-                    pbar.update(1)
+                if ASYNC_IO_DEPTH > 0:
+                    task, items = profiling.sample(process_batch, async_io.batches(pool_args, ASYNC_IO_BATCH),
+                                                   'fnoise_correction', args.profile, args.output_dir)
+                    finished = pool.imap_unordered(task, items)
+                else:
+                    task, items = profiling.sample(process_file, pool_args, 'fnoise_correction', args.profile, args.output_dir)
+                    finished = ([image] for image in pool.imap_unordered(task, items))
+                for images in finished:
+                    for image in images:
+                        if cache is not None:
+                            cache.record('fnoise_correction', image, params=cache_params)
+                    pbar.update(len(images))
+        profiling.merge('fnoise_correction', args.output_dir)
 
 if __name__ == '__main__':
     main()
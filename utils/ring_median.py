@@ -0,0 +1,157 @@
+"""
+Median filter over a Ring2DKernel footprint.
+
+remstriping_update_parallel.masksources and SubtractBackground.clipped_ring_median_filter
+subtract a median filtered image with a Ring2DKernel(40, 3) footprint: 776 pixels
+for each of the 4M pixels of a detector. scipy.ndimage.median_filter treats the
+ring as a generic footprint and runs on a single core. ring_median() offers:
+
+    "scipy"       scipy.ndimage.median_filter, as before.
+    "blocked"     The same (exact) medians. The ring values of a block of rows are
+                  gathered with one precomputed index table and the median is
+                  selected with np.partition. Blocks run in nthreads threads.
+    "subsampled"  As "blocked", but with every subsample-th pixel of the ring only.
+                  Not exact, faster by about the subsample factor.
+
+All methods use scipy's default 'reflect' boundary and, for a ring with an even
+number of pixels, scipy's choice of the upper of the two middle values. The
+input should not contain NaNs (the callers fill masked pixels first).
+
+With validate=True the scipy result is computed as well and the differences are
+logged. Run this module to compare the methods on random data.
+
+Use
+---
+    >>> from ring_median import ring_median
+    >>> filtered = ring_median(sci_filled, 40, 3, method='blocked', nthreads=4)
+"""
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from astropy.convolution import Ring2DKernel
+from scipy.ndimage import median_filter
+
+METHODS = ('scipy', 'blocked', 'subsampled')
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+log_file_path = 'pipeline.log'
+file_handler = logging.FileHandler(log_file_path, mode='a')
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+log.addHandler(file_handler)
+
+
+def ring_footprint(radius_in, width):
+    """Boolean footprint of Ring2DKernel(radius_in, width)."""
+    return Ring2DKernel(radius_in, width).array != 0
+
+
+def footprint_median(image, footprint, nthreads=1, block_rows=4):
+    """Exact median filter of image over footprint, for blocks of rows in nthreads threads.
+
+    Gives the same result as scipy.ndimage.median_filter(image, footprint=footprint).
+    """
+    image = np.asarray(image)
+    ny, nx = image.shape
+    ry, rx = footprint.shape[0] // 2, footprint.shape[1] // 2
+    padded = np.pad(image, ((ry, footprint.shape[0] - 1 - ry), (rx, footprint.shape[1] - 1 - rx)), mode='symmetric')
+    width = padded.shape[1]
+    flat = padded.ravel()
+
+    # Position in flat of every footprint pixel of every output pixel in a block, relative to the block start
+    rows, cols = np.nonzero(footprint)
+    offsets = (np.arange(block_rows)[:, None, None] * width + np.arange(nx)[None, :, None]
+               + (rows * width + cols)[None, None, :])
+    kth = len(rows) // 2  # scipy takes the upper middle value for an even count
+
+    filtered = np.empty_like(image)
+
+    def filter_block(start):
+        stop = min(start + block_rows, ny)
+        values = flat[start * width:].take(offsets[:stop - start])
+        filtered[start:stop] = np.partition(values, kth, axis=-1)[..., kth]
+
+    starts = range(0, ny, block_rows)
+    if nthreads > 1:
+        # take and partition release the GIL
+        with ThreadPoolExecutor(max_workers=nthreads) as executor:
+            list(executor.map(filter_block, starts))
+    else:
+        for start in starts:
+            filter_block(start)
+    return filtered
+
+
+def ring_median(image, radius_in, width, method='blocked', nthreads=1, subsample=2, validate=False):
+    """Median filter image over a Ring2DKernel(radius_in, width) footprint.
+
+    Parameters
+    ----------
+    image : numpy.ndarray
+        2D image without NaNs.
+
+    radius_in, width : float
+        Inner radius and width of the ring, as for Ring2DKernel.
+
+    method : str
+        "scipy", "blocked" or "subsampled", see the module docstring.
+
+    nthreads : int
+        Threads for the blocked and subsampled methods, 0 for all cores.
+
+    subsample : int
+        Use every subsample-th ring pixel with method="subsampled".
+
+    validate : bool
+        Also compute the scipy result and log how much the two differ.
+
+    Returns
+    -------
+    filtered : numpy.ndarray
+        Median filtered image, in the data type of image.
+    """
+    if method not in METHODS:
+        raise ValueError(f"Unknown ring median method '{method}', use one of {METHODS}")
+    footprint = ring_footprint(radius_in, width)
+    nthreads = nthreads or os.cpu_count()
+
+    if method == 'scipy':
+        return median_filter(image, footprint=footprint)
+    if method == 'subsampled':
+        rows, cols = np.nonzero(footprint)
+        footprint = np.zeros_like(footprint)
+        footprint[rows[::subsample], cols[::subsample]] = True
+    filtered = footprint_median(image, footprint, nthreads=nthreads)
+
+    if validate:
+        expected = median_filter(image, footprint=ring_footprint(radius_in, width))
+        different = filtered != expected
+        max_difference = np.max(np.abs(filtered - expected)) if different.any() else 0.
+        message = (f"ring median ({method}) validation: {different.sum()} of {different.size} pixels differ "
+                   f"from scipy, max abs difference {max_difference:.3g}")
+        if method == 'blocked' and different.any():
+            log.warning(message)
+        else:
+            log.info(message)
+    return filtered
+
+
+if __name__ == '__main__':
+    import time
+
+    rng = np.random.default_rng(3)
+    image = rng.normal(0.3, 0.05, (512, 2048)).astype(np.float32)
+    sources = rng.random(image.shape) < 0.01
+    image[sources] += rng.exponential(2.0, sources.sum()).astype(np.float32)
+
+    t0 = time.perf_counter()
+    expected = ring_median(image, 40, 3, method='scipy')
+    print(f'scipy {time.perf_counter()-t0:.2f} s')
+    for method in ('blocked', 'subsampled'):
+        t0 = time.perf_counter()
+        filtered = ring_median(image, 40, 3, method=method, nthreads=0)
+        print(f'{method} {time.perf_counter()-t0:.2f} s on {os.cpu_count()} cores, '
+              f'{np.sum(filtered != expected)} of {image.size} pixels differ, '
+              f'max abs difference {np.max(np.abs(filtered - expected)):.3g}')
@@ -0,0 +1,155 @@
+"""
+Global robust statistics of full-frame arrays, exact or from a subsample.
+
+Several steps reduce a whole detector (4M pixels) to a single robust number:
+the fill value for masked pixels (biweight location), the background rms of the
+source tiers (biweight scale), the detection thresholds of the 1/f source mask
+(MAD standard deviation), the median level in the wisp fit. Each takes a few
+tenths of a second, and they add up to seconds per exposure.
+
+Every function has two modes:
+
+    "exact"   The astropy or numpy function, with the arguments the call sites
+              have always used. The result is unchanged.
+    "fast"    The same estimator on a deterministic subsample of at most
+              max_samples values, taken at low-discrepancy (golden ratio)
+              positions so that no row, column or amplifier pattern is
+              aliased. The full array is never passed over. The estimated
+              error is logged (and returned with return_error=True): the
+              spread of the estimator over nsplit interleaved parts of the
+              subsample, scaled to the whole subsample.
+
+Arrays with no more than max_samples elements are always reduced exactly.
+
+A step uses the fast mode when it is listed in robust_stats_fast in
+config.yaml, see step_mode(). Run this module to compare both modes on random
+data.
+
+Use
+---
+    >>> import robust_stats
+    >>> rms = robust_stats.biweight_scale(img, mask=mask, mode='fast')
+    >>> level, error = robust_stats.biweight_location(img, ignore_nan=True, mode='fast', return_error=True)
+"""
+import logging
+import numpy as np
+from astropy import stats as astrostats
+
+MODES = ('exact', 'fast')
+MAX_SAMPLES = 2**18
+NSPLIT = 8
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+log_file_path = 'pipeline.log'
+file_handler = logging.FileHandler(log_file_path, mode='a')
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+log.addHandler(file_handler)
+
+
+def step_mode(config, step):
+    """'fast' if step is listed in robust_stats_fast in config, otherwise 'exact'."""
+    return 'fast' if step in (config.get('robust_stats_fast') or []) else 'exact'
+
+
+def subsample(data, mask=None, max_samples=MAX_SAMPLES, skip_nan=False):
+    """Unmasked (and, with skip_nan, non-NaN) values of data at up to max_samples low-discrepancy positions.
+
+    Returns the values and the estimated number of such values in data.
+    """
+    flat = np.ravel(data)
+    positions = np.arange(min(max_samples, flat.size)) * ((np.sqrt(5) - 1) / 2) % 1
+    index = np.sort((positions * flat.size).astype(np.intp))
+    values = flat[index]
+    keep = ~np.isnan(values) if skip_nan else np.ones(values.shape, dtype=bool)
+    if mask is not None:
+        keep &= ~np.ravel(mask)[index]
+    return values[keep], flat.size * keep.mean()
+
+
+def estimate(name, estimator, data, mask=None, mode='exact', max_samples=MAX_SAMPLES, nsplit=NSPLIT,
+             skip_nan=False, **kwargs):
+    """Apply estimator(values, **kwargs) to data[~mask] exactly or to a subsample of it.
+
+    skip_nan tells whether the estimator ignores NaNs, in which case they are left out of the subsample.
+    Returns the value and its estimated error (0 in exact mode).
+    """
+    if mode not in MODES:
+        raise ValueError(f"Unknown robust statistics mode '{mode}', use one of {MODES}")
+    if mode == 'exact' or np.size(data) <= max_samples:
+        return estimator(data if mask is None else data[~mask], **kwargs), 0.0
+
+    values, nvalid = subsample(data, mask, max_samples, skip_nan)
+    value = estimator(values, **kwargs)
+    parts = [estimator(values[k::nsplit], **kwargs) for k in range(nsplit)]
+    # The parts scatter sqrt(nsplit) times more than the whole subsample, and
+    # the subsample does not scatter around the exact value once it is all of the data
+    error = np.std(parts, ddof=1) / np.sqrt(nsplit) * np.sqrt(max(1 - values.size / max(nvalid, 1), 0))
+    log.info(f"{name} (fast): {value:.6g} +- {error:.2g} from {values.size} of ~{nvalid:.0f} values")
+    return value, error
+
+
+def biweight_location(data, c=6.0, mask=None, ignore_nan=False, mode='exact', return_error=False, **kwargs):
+    """astropy biweight_location of data[~mask]."""
+    value, error = estimate('biweight_location', astrostats.biweight_location, data, mask, mode,
+                            skip_nan=ignore_nan, c=c, ignore_nan=ignore_nan, **kwargs)
+    return (value, error) if return_error else value
+
+
+def biweight_scale(data, c=9.0, mask=None, ignore_nan=False, mode='exact', return_error=False, **kwargs):
+    """astropy biweight_scale of data[~mask]."""
+    value, error = estimate('biweight_scale', astrostats.biweight_scale, data, mask, mode,
+                            skip_nan=ignore_nan, c=c, ignore_nan=ignore_nan, **kwargs)
+    return (value, error) if return_error else value
+
+
+def biweight_midvariance(data, c=9.0, mask=None, ignore_nan=False, mode='exact', return_error=False, **kwargs):
+    """astropy biweight_midvariance of data[~mask]."""
+    value, error = estimate('biweight_midvariance', astrostats.biweight_midvariance, data, mask, mode,
+                            skip_nan=ignore_nan, c=c, ignore_nan=ignore_nan, **kwargs)
+    return (value, error) if return_error else value
+
+
+def mad_std(data, mask=None, ignore_nan=False, mode='exact', return_error=False, **kwargs):
+    """astropy mad_std of data[~mask]."""
+    value, error = estimate('mad_std', astrostats.mad_std, data, mask, mode,
+                            skip_nan=ignore_nan, ignore_nan=ignore_nan, **kwargs)
+    return (value, error) if return_error else value
+
+
+def median(data, mask=None, mode='exact', return_error=False):
+    """numpy nanmedian of data[~mask]."""
+    value, error = estimate('median', np.nanmedian, data, mask, mode, skip_nan=True)
+    return (value, error) if return_error else value
+
+
+if __name__ == '__main__':
+    import time
+    import warnings
+    warnings.filterwarnings('ignore')
+
+    rng = np.random.default_rng(5)
+    shape = (2048, 2048)
+    data = rng.normal(0.3, 0.05, shape)
+    data += rng.normal(0, 0.01, shape[0])[:, None]  # striping
+    sources = rng.random(shape) < 0.02
+    data[sources] += rng.exponential(2.0, sources.sum())
+    data[rng.random(shape) < 0.001] = np.nan
+    mask = rng.random(shape) < 0.3
+
+    for function in (biweight_location, biweight_scale, biweight_midvariance, mad_std):
+        t0 = time.perf_counter()
+        exact = function(data, mask=mask, ignore_nan=True)
+        t1 = time.perf_counter()
+        fast, error = function(data, mask=mask, ignore_nan=True, mode='fast', return_error=True)
+        t2 = time.perf_counter()
+        print(f'{function.__name__}: exact {exact:.6g} in {t1-t0:.3f} s, fast {fast:.6g} +- {error:.2g} '
+              f'in {t2-t1:.3f} s, actual error {fast-exact:.2g} ({abs(fast-exact)/error:.1f} sigma)')
+    t0 = time.perf_counter()
+    exact = median(data, mask=mask)
+    t1 = time.perf_counter()
+    fast, error = median(data, mask=mask, mode='fast', return_error=True)
+    t2 = time.perf_counter()
+    print(f'median: exact {exact:.6g} in {t1-t0:.3f} s, fast {fast:.6g} +- {error:.2g} '
+          f'in {t2-t1:.3f} s, actual error {fast-exact:.2g} ({abs(fast-exact)/error:.1f} sigma)')
@@ -0,0 +1,195 @@
+"""
+Run report: wall time, CPU time, peak memory and I/O of every step and exposure.
+
+Each step writes one JSON line per exposure (per filter for stage 3) to the
+file named by run_report in config.yaml:
+
+    {"step": "background_subtraction", "exposure": "jw..._cal_final.fits",
+     "start": 1760000000.0, "wall": 41.2, "cpu": 39.8, "peak_rss": 5.1e9,
+     "read_bytes": 2.1e8, "write_bytes": 1.7e8, "status": "ok",
+     "phases": {"ring_median": 12.1, "tier_masks": 6.3, "Background2D": 9.8},
+     "host": "node042", "pid": 12345}
+
+    cpu          user + system time of the process and of the child processes
+                 it waited for during the exposure.
+    peak_rss     peak resident memory of the process up to the end of the
+                 exposure (a pool worker's peak over all its tasks so far).
+    read_bytes,  bytes passed through read/write calls (/proc/self/io rchar
+    write_bytes  and wchar; memory-mapped reads are not counted). None where
+                 /proc is not available.
+    phases       seconds spent in the timed sub-phases, see phase().
+
+Records of nested exposures (e.g. stage 2 within the fused stage 2) are
+written separately; the phases go to the innermost one. Records are appended
+with a single write each, so the pool workers can share the file.
+
+Run this module for a summary table of the report, e.g. at the end of
+young_pipeline.sh:
+
+    >>> python utils/run_report.py --since 1760000000 [--csv run_report.csv]
+
+Use
+---
+    >>> with run_report.exposure('fnoise_correction', image):
+    ...     with run_report.phase('ring_median'):
+    ...         filtered = ring_median(...)
+"""
+import argparse
+import json
+import os
+import resource
+import socket
+import sys
+import time
+from contextlib import contextmanager
+
+import yaml
+
+from worker_pool import peak_rss
+
+try:
+    with open('config.yaml') as config_file:
+        REPORT_PATH = (yaml.safe_load(config_file) or {}).get('run_report', '')
+except OSError:
+    REPORT_PATH = ''
+
+# Open exposure records of this process, innermost last
+_records = []
+
+
+def io_counters():
+    """(bytes read, bytes written) by this process so far, (None, None) without /proc."""
+    try:
+        with open('/proc/self/io') as io:
+            counters = dict(line.split(':') for line in io)
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def cpu_time():
+    """User + system time (s) of this process and of its waited-for children."""
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def write(record, path=None):
+    """Append record to the run report."""
+    path = path or REPORT_PATH
+    if not path:
+        return
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (json.dumps(record) + '\n').encode())
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def exposure(step, name):
+    """Time step on exposure (or filter) name and write its record to the run report."""
+    if not REPORT_PATH:
+        yield
+        return
+    record = {'step': step, 'exposure': os.path.basename(str(name)), 'start': time.time(), 'phases': {}}
+    _records.append(record)
+    read0, written0 = io_counters()
+    cpu0 = cpu_time()
+    t0 = time.perf_counter()
+    status = 'error'
+    try:
+        yield
+        status = 'ok'
+    finally:
+        _records.remove(record)
+        read1, written1 = io_counters()
+        record.update(wall=time.perf_counter() - t0, cpu=cpu_time() - cpu0, peak_rss=peak_rss(),
+                      read_bytes=None if read0 is None else read1 - read0,
+                      write_bytes=None if written0 is None else written1 - written0,
+                      status=status, host=socket.gethostname(), pid=os.getpid())
+        write(record)
+
+
+@contextmanager
+def phase(name):
+    """Add the time spent in the block to phase name of the innermost open exposure record."""
+    if not _records:
+        yield
+        return
+    record = _records[-1]
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        record['phases'][name] = record['phases'].get(name, 0.0) + time.perf_counter() - t0
+
+
+def load(path, since=0):
+    """Records of the run report at path that started at or after since (epoch seconds)."""
+    records = []
+    with open(path) as report:
+        for line in report:
+            if line.strip():
+                record = json.loads(line)
+                if record['start'] >= since:
+                    records.append(record)
+    return records
+
+
+def summary(records):
+    """Table (list of lines) of the wall time, CPU time, memory and I/O of each step, and of its phases."""
+    steps = {}
+    for record in sorted(records, key=lambda record: record['start']):
+        steps.setdefault(record['step'], []).append(record)
+    lines = [f'{"step":<24}{"exposures":>10}{"errors":>8}{"wall h":>9}{"mean s":>9}{"max s":>9}'
+             f'{"CPU h":>9}{"CPU/wall":>9}{"peak GB":>9}{"read GB":>9}{"written GB":>11}']
+    for step, step_records in steps.items():
+        wall = sum(record['wall'] for record in step_records)
+        cpu = sum(record['cpu'] for record in step_records)
+        read = sum(record['read_bytes'] or 0 for record in step_records)
+        written = sum(record['write_bytes'] or 0 for record in step_records)
+        errors = sum(record['status'] != 'ok' for record in step_records)
+        lines.append(f'{step:<24}{len(step_records):>10}{errors:>8}{wall/3600:>9.2f}{wall/len(step_records):>9.1f}'
+                     f'{max(record["wall"] for record in step_records):>9.1f}{cpu/3600:>9.2f}'
+                     f'{cpu/max(wall, 1e-9):>9.2f}{max(record["peak_rss"] for record in step_records)/1e9:>9.2f}'
+                     f'{read/1e9:>9.2f}{written/1e9:>11.2f}')
+        phases = {}
+        for record in step_records:
+            for name, seconds in record['phases'].items():
+                phases[name] = phases.get(name, 0.0) + seconds
+        for name, seconds in sorted(phases.items(), key=lambda item: -item[1]):
+            lines.append(f'  {name:<22}{"":>18}{seconds/3600:>9.2f}{"":>18}  {100*seconds/max(wall, 1e-9):5.1f}% of the step')
+    return lines
+
+
+def write_csv(records, path):
+    """Write records to path as CSV, one column per phase."""
+    import csv
+    phases = sorted({name for record in records for name in record['phases']})
+    columns = ['step', 'exposure', 'start', 'wall', 'cpu', 'peak_rss', 'read_bytes', 'write_bytes', 'status', 'host', 'pid']
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns + [f'phase_{name}' for name in phases])
+        for record in records:
+            writer.writerow([record.get(column) for column in columns] + [record['phases'].get(name) for name in phases])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summary of the run report.')
+    parser.add_argument('--report', type=str, default=REPORT_PATH, help='Run report (default: run_report in config.yaml)')
+    parser.add_argument('--since', type=float, default=0, help='Only the records that started at or after this time (epoch seconds)')
+    parser.add_argument('--csv', type=str, default='', help='Also write the records to this CSV file')
+    args = parser.parse_args()
+
+    if not args.report or not os.path.exists(args.report):
+        print('No run report.')
+        sys.exit(0)
+    records = load(args.report, since=args.since)
+    if not records:
+        print(f'No records in {args.report}.')
+        sys.exit(0)
+    print('\n'.join(summary(records)))
+    if args.csv:
+        write_csv(records, args.csv)
+        print(f'Records written to {args.csv}')
@@ -0,0 +1,162 @@
+"""
+Per-exposure source mask product shared by the 1/f, wisp and background steps.
+
+Every exposure used to have its sources detected three times, with three
+different algorithms: remstriping_update_parallel.masksources on the rate file,
+subtract_wisp.make_segmap on the long-wavelength cal file (once for every
+short-wavelength sibling), and SubtractBackground.mask_sources on the cal file,
+each with its own ring median filter, convolution, detection and dilation.
+
+When source_mask_dir is set in config.yaml, the 1/f step, which is the first to
+see an exposure, runs all three algorithms on the one ring-median-filtered rate
+image it makes anyway and stores the results as <exposure>_srcmask.fits, one bit
+per consumer:
+
+    bit 0      FNOISE     1/f striping mask (masksources)
+    bit 1      WISP       wisp segmentation map, in the pixels of the exposure
+                          itself, long-wavelength exposures only (make_segmap
+                          before the reprojection onto the short-wavelength detector)
+    bits 2-5   BKG1-4     background source tiers 1-4 (SubtractBackground.mask_sources)
+
+The wisp and background steps then read their bits instead of detecting sources
+again. A step listed in source_mask_refine still runs its own detection on its
+own input and adds the result to the stored mask (for that step only; the
+product on disk is not changed).
+
+The masks come from the rate image rather than the cal image, and the background
+tiers from a plain rather than a clipped ring median, so they differ slightly
+from the ones the steps would make themselves. Only detector pixels are
+involved, so the masks are valid for every product of the exposure. The product
+is rewritten every time the 1/f step runs; delete source_mask_dir if stage 1 is
+rerun with the 1/f step skipped.
+
+Use
+---
+    >>> import source_mask
+    >>> tiers = source_mask.read_bits('jw01063006004_02101_00005_nrca3_cal.fits', './output/source_masks',
+    ...                               source_mask.BACKGROUND_BITS)
+"""
+import os
+import logging
+import numpy as np
+from astropy.io import fits
+from astropy.convolution import convolve, Gaussian2DKernel
+from photutils.segmentation import detect_sources, detect_threshold
+from scipy.ndimage import binary_dilation, generate_binary_structure
+
+FNOISE_BIT = 0
+WISP_BIT = 1
+BACKGROUND_BITS = [2, 3, 4, 5]
+BIT_NAMES = {FNOISE_BIT: 'FNOISE', WISP_BIT: 'WISP', 2: 'BKG1', 3: 'BKG2', 4: 'BKG3', 5: 'BKG4'}
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+log_file_path = 'pipeline.log'
+file_handler = logging.FileHandler(log_file_path, mode='a')
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+log.addHandler(file_handler)
+
+
+def exposure_root(filename):
+    """jw01063006004_02101_00005_nrca3_cal_final.fits -> jw01063006004_02101_00005_nrca3"""
+    return '_'.join(os.path.basename(filename).split('_')[:4])
+
+
+def product_path(filename, mask_dir):
+    return os.path.join(mask_dir, exposure_root(filename) + '_srcmask.fits')
+
+
+def long_wavelength_root(filename):
+    """Exposure root of the long-wavelength exposure taken with the (short-wavelength) exposure filename."""
+    root = exposure_root(filename)
+    detector = root.split('_')[-1]
+    return root[:-len(detector)] + 'nrc' + detector[3] + 'long'
+
+
+def read_bits(filename, mask_dir, bits):
+    """Boolean masks for bits from the product of the exposure of filename.
+
+    Returns None if source_mask_dir is not set, there is no product, or it lacks one of the bits.
+    """
+    if not mask_dir:
+        return None
+    path = product_path(filename, mask_dir)
+    if not os.path.exists(path):
+        return None
+    with fits.open(path) as hdul:
+        hdu = hdul['SRCMASK']
+        if not all(hdu.header.get(f'BIT{bit}') == BIT_NAMES[bit] for bit in bits):
+            return None
+        bitmask = hdu.data
+        return [(bitmask & (1 << bit)) != 0 for bit in bits]
+
+
+def write_bits(filename, mask_dir, masks):
+    """Store masks, {bit: boolean array}, in the product of the exposure of filename, keeping its other bits."""
+    os.makedirs(mask_dir, exist_ok=True)
+    path = product_path(filename, mask_dir)
+    shape = next(iter(masks.values())).shape
+    bitmask = np.zeros(shape, dtype=np.uint8)
+    present = []
+    if os.path.exists(path):
+        with fits.open(path) as hdul:
+            bitmask[:] = hdul['SRCMASK'].data
+            present = [bit for bit in BIT_NAMES if hdul['SRCMASK'].header.get(f'BIT{bit}')]
+    for bit, mask in masks.items():
+        bitmask &= np.uint8(~(1 << bit) & 0xff)
+        bitmask |= (np.asarray(mask) != 0).astype(np.uint8) << bit
+    hdu = fits.CompImageHDU(bitmask, name='SRCMASK', compression_type='RICE_1')
+    for bit in sorted(set(present) | set(masks)):
+        hdu.header[f'BIT{bit}'] = (BIT_NAMES[bit], 'source mask bit')
+    # Written under a temporary name so readers never see a partial file
+    tmp_path = path.replace('.fits', '.tmp.fits')
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(tmp_path, overwrite=True)
+    os.replace(tmp_path, path)
+    log.info(f'Wrote {", ".join(BIT_NAMES[bit] for bit in masks)} to {path}')
+
+
+def wisp_segmap(data, dq, sigma=0.8, npixels=10, dilate_segmap=5):
+    """Source detection of subtract_wisp.make_segmap, in the pixels of data (see its docstring)."""
+    threshold = detect_threshold(data, sigma)
+    g = Gaussian2DKernel(x_stddev=3)
+    data_conv = convolve(data, g, mask=dq&1!=0)  # Smooth input image before detecting sources
+    seg = detect_sources(data_conv, threshold, npixels=npixels, mask=dq&1!=0)  # avoid bad pixels as sources
+    segmap_data = seg.data
+    segmap_data[segmap_data!=0] = 1
+
+    # Dilate the segmap outwards
+    if dilate_segmap != 0:
+        segmap_data = binary_dilation(segmap_data, iterations=dilate_segmap, structure=generate_binary_structure(2, 2))
+        segmap_data[segmap_data!=0] = 1
+    return segmap_data
+
+
+def make_product(filename, mask_dir, sci, err, dq, difference, fnoise_mask, background_settings=None):
+    """Write the product of an exposure from its rate image.
+
+    difference is the ring-median-subtracted image of the 1/f step and fnoise_mask its source mask.
+    background_settings are the SubtractBackground attributes the background step sets from config.yaml
+    (compute_precision, robust_stats_mode, background_threads, fft_threads), so the tiers match its own.
+    """
+    import background_subtraction  # imported here, background_subtraction imports this module
+
+    masks = {FNOISE_BIT: fnoise_mask}
+
+    # Background tiers with the settings of the background step, on the same ring-median-subtracted image
+    bs = background_subtraction.SubtractBackground()
+    for name, value in (background_settings or {}).items():
+        setattr(bs, name, value)
+    bs.has_dq = True
+    bs.dq = dq
+    bs.mask_by_dq()
+    bad = bs.off_detector(sci, err) | bs.dqmask | ~np.isfinite(difference)
+    bitmask = bs.mask_sources(difference, bad.astype(np.uint32), starting_bit=1)
+    for tier, bit in enumerate(BACKGROUND_BITS):
+        masks[bit] = np.bitwise_and(bitmask, 1 << (tier + 1)) != 0
+
+    # The short-wavelength wisp segmaps are reprojected from the long-wavelength detection
+    if 'long' in exposure_root(filename):
+        masks[WISP_BIT] = wisp_segmap(sci, dq)
+
+    write_bits(filename, mask_dir, masks)
@@ -0,0 +1,379 @@
+"""
+Content-addressed incremental cache for the pipeline steps.
+
+Every step records, per exposure (per filter for stage 3), a fingerprint made of
+the hashes of its inputs, the config.yaml keys and command line parameters it
+depends on, the CRDS context (for steps that use references), and the version of
+its code. On a rerun, a step only processes the exposures whose fingerprint has
+changed, or whose output is needed again downstream.
+
+Some steps work in place (1/f correction, background subtraction) or delete their
+input (wisp subtraction removes the _cal.fits files). When a step has to run
+again but its input is gone or has been overwritten, the step that produces that
+input is run again as well. For example, changing the background subtraction
+also reruns stage 2 and the wisp step for that exposure, but not stage 1.
+Changing only the tweakreg settings reruns only stage 3. Intermediate products
+that no later step needs (for example a deleted _cal_final.fits whose mosaic is
+up to date) are not recreated.
+
+The manifests are kept as JSON files in <output>/.cache. Enable with
+incremental: true in config.yaml.
+"""
+import os
+import json
+import hashlib
+import logging
+from importlib import metadata
+import yaml
+from astropy.io import fits
+
+with open('config.yaml', 'r') as config_file:
+    config = yaml.safe_load(config_file)
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+log_file_path = 'pipeline.log'
+file_handler = logging.FileHandler(log_file_path, mode='a')
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+log.addHandler(file_handler)
+
+CHAIN = ['stage1', 'fnoise_correction', 'stage2', 'wisp_subtraction', 'background_subtraction']
+
+# config.yaml keys that change the result of each step
+CONFIG_KEYS = {
+    'stage1': ['ramp_fit_cores', 'jump_cores', 'stage1_worker_ramp_fit_cores', 'stage1_worker_jump_cores'],
+    'fnoise_correction': ['ring_median_method', 'source_mask_dir', 'robust_stats_fast', 'compute_precision',
+                          'fnoise_minimal_io', 'fnoise_backup', 'fnoise_stats_engine'],
+    'stage2': ['skip_resample'],
+    'wisp_subtraction': ['source_mask_dir', 'source_mask_refine', 'robust_stats_fast', 'compute_precision'],
+    'background_subtraction': ['ring_median_method', 'source_mask_dir', 'source_mask_refine', 'robust_stats_fast',
+                               'compute_precision'],
+    'stage3': ['target', 'pixel_scale', 'pixfrac', 'rotation', 'external_reference', 'reference_path',
+               'starfinder', 'tweakreg_snr'],
+}
+
+# Source files making up each step
+CODE_FILES = {
+    'stage1': ['pipeline_stage1.py'],
+    'fnoise_correction': ['remstriping_update_parallel.py', 'clipped_stats.py', 'multiscale_detection.py', 'ring_median.py',
+                          'source_mask.py', 'robust_stats.py', 'async_io.py', 'precision.py'],
+    'stage2': ['pipeline_stage2.py'],
+    'wisp_subtraction': ['subtract_wisp.py', 'source_mask.py', 'robust_stats.py', 'async_io.py', 'precision.py'],
+    'background_subtraction': ['bkg_sub_parallel.py', 'background_subtraction.py', 'compute_cal_sky_variance.py',
+                               'multiscale_detection.py', 'ring_median.py', 'source_mask.py', 'tiled_background.py',
+                               'robust_stats.py', 'async_io.py', 'precision.py'],
+    'stage3': ['pipeline_stage3.py'],
+}
+
+# Steps that use CRDS reference files (and the jwst package)
+CRDS_STEPS = ['stage1', 'fnoise_correction', 'stage2', 'stage3']
+
+EXPOSURE_SUFFIXES = ['_uncal.fits', '_rate.fits', '_cal_final.fits', '_cal.fits']
+
+
+def root_name(path):
+    """jw01063006004_02101_00005_nrca3_cal_final.fits -> jw01063006004_02101_00005_nrca3"""
+    name = os.path.basename(path)
+    for suffix in EXPOSURE_SUFFIXES:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def file_sha256(path, blocksize=2**23):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def load(step_dir):
+    """StepCache for the output tree containing step_dir, or None when incremental processing is off."""
+    if not config.get('incremental', False):
+        return None
+    return StepCache(os.path.dirname(os.path.abspath(step_dir)))
+
+
+class StepCache:
+    """Fingerprint manifests and rerun planning for one output tree (the directory holding
+    stage1_output, stage2_output and stage3_output)."""
+
+    def __init__(self, output_base, uncal_path=None):
+        self.output_base = output_base
+        self.uncal_path = uncal_path if uncal_path is not None else config['uncal_path']
+        self.stage_dirs = {stage: os.path.join(output_base, f'{stage}_output') for stage in ('stage1', 'stage2', 'stage3')}
+        self.cache_dir = os.path.join(output_base, '.cache')
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.skip_steps = config.get('skip_steps') or []
+
+        self.records = {step: self._read_json(step) for step in CHAIN + ['stage3']}
+        self.hashes = self._read_json('hashes')
+        self._code_versions = {}
+        self._crds_context = None
+        self._nodes = None
+
+    # ----- persistence ------------------------------------------------------------
+
+    def _read_json(self, name):
+        path = os.path.join(self.cache_dir, name + '.json')
+        if os.path.exists(path):
+            with open(path) as f:
+                return json.load(f)
+        return {}
+
+    def _write_json(self, name, data):
+        path = os.path.join(self.cache_dir, name + '.json')
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        os.replace(tmp, path)
+
+    # ----- hashing ----------------------------------------------------------------
+
+    def file_hash(self, path):
+        """Content hash of a file, reusing the stored hash while its size and mtime are unchanged."""
+        if not os.path.exists(path):
+            return None
+        st = os.stat(path)
+        memo = self.hashes.get(path)
+        if memo is not None and memo['size'] == st.st_size and memo['mtime_ns'] == st.st_mtime_ns:
+            return memo['sha256']
+        sha = file_sha256(path)
+        self.hashes[path] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha256': sha}
+        return sha
+
+    def code_version(self, step):
+        if step not in self._code_versions:
+            sha = hashlib.sha256()
+            utils_dir = os.path.dirname(os.path.abspath(__file__))
+            for name in CODE_FILES[step]:
+                with open(os.path.join(utils_dir, name), 'rb') as f:
+                    sha.update(f.read())
+            if step in CRDS_STEPS:
+                try:
+                    sha.update(metadata.version('jwst').encode())
+                except metadata.PackageNotFoundError:
+                    pass
+            self._code_versions[step] = sha.hexdigest()
+        return self._code_versions[step]
+
+    def crds_context(self):
+        if self._crds_context is None:
+            context = os.environ.get('CRDS_CONTEXT')
+            if not context:
+                try:
+                    import crds
+                    context = crds.get_default_context()
+                except Exception as e:
+                    log.warning(f'Could not determine the CRDS context ({e}); references are assumed unchanged')
+                    context = 'unknown'
+            self._crds_context = context
+        return self._crds_context
+
+    # ----- task graph -------------------------------------------------------------
+
+    def exposure_filter(self, root):
+        for path in (os.path.join(self.uncal_path, root + '_uncal.fits'),
+                     os.path.join(self.stage_dirs['stage1'], root + '_rate.fits'),
+                     os.path.join(self.stage_dirs['stage2'], root + '_cal_final.fits'),
+                     os.path.join(self.stage_dirs['stage2'], root + '_cal.fits')):
+            if os.path.exists(path):
+                return fits.getheader(path)['FILTER']
+        return None
+
+    def nodes(self):
+        """All (step, key) nodes of this output tree, with their inputs and output file."""
+        if self._nodes is not None:
+            return self._nodes
+
+        roots = set()
+        if os.path.isdir(self.uncal_path):
+            roots |= {root_name(f) for f in os.listdir(self.uncal_path) if f.endswith('_uncal.fits')}
+        for stage in ('stage1', 'stage2'):
+            if os.path.isdir(self.stage_dirs[stage]):
+                roots |= {root_name(f) for f in os.listdir(self.stage_dirs[stage])
+                          if f.endswith(('_rate.fits', '_cal.fits', '_cal_final.fits'))}
+
+        wisp_detectors = ['nrca3', 'nrca4', 'nrcb3', 'nrcb4']
+        s1, s2, s3 = self.stage_dirs['stage1'], self.stage_dirs['stage2'], self.stage_dirs['stage3']
+        nodes = {}
+        filters = {}
+        for root in sorted(roots):
+            rate = os.path.join(s1, root + '_rate.fits')
+            nodes[('stage1', root)] = {'inputs': [('file', os.path.join(self.uncal_path, root + '_uncal.fits'))], 'output': rate}
+            nodes[('fnoise_correction', root)] = {'inputs': [('stage1', root)], 'output': rate}
+            nodes[('stage2', root)] = {'inputs': [('fnoise_correction', root)], 'output': os.path.join(s2, root + '_cal.fits')}
+            wisp_inputs = [('stage2', root)]
+            detector = root.split('_')[-1]
+            lw_root = root[:-len(detector)] + 'nrc{}long'.format(detector[3:4])
+            if detector in wisp_detectors and lw_root in roots:
+                wisp_inputs.append(('stage2', lw_root))
+            nodes[('wisp_subtraction', root)] = {'inputs': wisp_inputs, 'output': os.path.join(s2, root + '_cal_final.fits')}
+            nodes[('background_subtraction', root)] = {'inputs': [('wisp_subtraction', root)], 'output': os.path.join(s2, root + '_cal_final.fits')}
+            filter = self.exposure_filter(root)
+            if filter is not None:
+                filters.setdefault(filter, []).append(root)
+
+        if filters:
+            # Longest wavelength first, as in pipeline_stage3 (F090W -> 90, F410M -> 410)
+            sorted_filters = sorted(filters, key=lambda x: int(''.join(c for c in x if c.isdigit())), reverse=True)
+            for filter in sorted_filters:
+                inputs = [('background_subtraction', root) for root in filters[filter]]
+                if filter != sorted_filters[0]:
+                    inputs.append(('stage3', sorted_filters[0]))
+                i2d = os.path.join(s3, filter, 'output_files', f"{config['target']}_nircam_clear-{filter}_i2d.fits")
+                nodes[('stage3', filter)] = {'inputs': inputs, 'output': i2d}
+
+        for node in nodes.values():
+            node['consumers'] = []
+        for node_id, node in nodes.items():
+            for input_id in node['inputs']:
+                if input_id in nodes:
+                    nodes[input_id]['consumers'].append(node_id)
+
+        self._nodes = nodes
+        return nodes
+
+    # ----- fingerprints -----------------------------------------------------------
+
+    def token(self, input_id):
+        """Hash standing for one input: the recorded output of the producing step, or the file itself."""
+        if input_id[0] == 'file':
+            return self.file_hash(input_id[1])
+        step, key = input_id
+        record = self.records[step].get(key)
+        if record is not None:
+            return record['output']['sha256']
+        node = self.nodes().get(input_id)
+        if step in self.skip_steps and node is not None:
+            return self.file_hash(node['output'])  # never run through the cache; take the file as it is
+        return None
+
+    def fingerprint(self, node_id, params=None):
+        step, key = node_id
+        node = self.nodes()[node_id]
+        record = self.records[step].get(key, {})
+        if params is None:
+            params = record.get('params')
+        recorded_inputs = record.get('inputs', [])
+        inputs = []
+        for i, input_id in enumerate(node['inputs']):
+            token = self.token(input_id)
+            if token is None and input_id[0] == 'file' and i < len(recorded_inputs):
+                token = recorded_inputs[i]  # e.g. uncal files removed after stage 1
+            inputs.append(token)
+        content = {
+            'step': step,
+            'config': {k: config.get(k) for k in CONFIG_KEYS[step]},
+            'params': params,
+            'code': self.code_version(step),
+            'crds_context': self.crds_context() if step in CRDS_STEPS else None,
+            'inputs': inputs,
+        }
+        return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest(), inputs
+
+    def valid(self, node_id, params=None):
+        step, key = node_id
+        record = self.records[step].get(key)
+        return record is not None and record['fingerprint'] == self.fingerprint(node_id, params)[0]
+
+    def intact(self, node_id):
+        """True if the step's output is still on disk exactly as the step left it."""
+        step, key = node_id
+        record = self.records[step].get(key)
+        if record is None or record['output']['sha256'] is None:
+            return False
+        return self.file_hash(self.nodes()[node_id]['output']) == record['output']['sha256']
+
+    # ----- planning ---------------------------------------------------------------
+
+    def must_run(self, params=None):
+        """Set of (step, key) nodes that have to be (re)computed.
+
+        params: {step: params} for the steps whose command line parameters are known in
+        this run. Other steps are checked against the parameters they were last run with.
+        """
+        params = params or {}
+        nodes = self.nodes()
+        skipped = {n for n in nodes if n[0] in self.skip_steps}
+        run = {n for n in nodes if n not in skipped and not self.valid(n, params.get(n[0]))}
+        intact = {}
+
+        def is_intact(n):
+            if n not in intact:
+                intact[n] = self.intact(n)
+            return intact[n]
+
+        def changed(n):
+            # Output of n will change in this run (skipped steps pass their input through)
+            if n in run:
+                return True
+            return n in skipped and any(changed(i) for i in nodes[n]['inputs'] if i in nodes)
+
+        def needed(n):
+            # Output of n will be read by a step that runs (or is a final product)
+            consumers = nodes[n]['consumers']
+            if not consumers:
+                return True
+            return any(c in run or (c in skipped and needed(c)) for c in consumers)
+
+        updated = True
+        while updated:
+            updated = False
+            for n in nodes:
+                if n in run or n in skipped:
+                    continue
+                if any(changed(i) for i in nodes[n]['inputs'] if i in nodes) or (not is_intact(n) and needed(n)):
+                    run.add(n)
+                    updated = True
+
+        for n in run:
+            for i in nodes[n]['inputs']:
+                if i in skipped and self.records[i[0]].get(i[1]) is not None and not is_intact(i):
+                    log.warning(f'{n[0]} has to run for {n[1]}, but its input from the skipped step {i[0]} '
+                                f'has been modified since that step ran')
+        return run
+
+    def pending(self, step, paths, params=None):
+        """The subset of paths (one per exposure, or filter names for stage 3) that step has to process.
+
+        step can also be a list of steps that run together on each path (fused stage 2).
+        """
+        steps = [step] if isinstance(step, str) else list(step)
+        run = self.must_run({s: params for s in steps} if params is not None else None)
+        todo = [p for p in paths if any((s, root_name(p)) in run or (s, root_name(p)) not in self.nodes() for s in steps)]
+        log.info(f"{'+'.join(steps)}: {len(todo)} of {len(paths)} inputs need processing, {len(paths)-len(todo)} are up to date")
+        self._write_json('hashes', self.hashes)
+        return todo
+
+    def record(self, step, path, params=None, written=True):
+        """Store the fingerprint and output hash of step after it finished successfully for path.
+
+        written=False records a step whose output was only handed on in memory (fused
+        stage 2). The step counts as up to date, but its output as missing whenever a
+        later step has to run again.
+        """
+        node_id = (step, root_name(path))
+        node = self.nodes().get(node_id)
+        if node is None:
+            return
+        output = node['output']
+        if written and not os.path.exists(output):
+            log.warning(f'{step}: expected output {output} not found, not recording')
+            return
+        fingerprint, inputs = self.fingerprint(node_id, params)
+        if written:
+            st = os.stat(output)
+            output_record = {'path': output, 'sha256': self.file_hash(output), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+        else:
+            output_record = {'path': output, 'sha256': None, 'size': None, 'mtime_ns': None}
+        self.records[step][node_id[1]] = {
+            'fingerprint': fingerprint,
+            'params': params,
+            'inputs': inputs,
+            'output': output_record,
+        }
+        self._write_json(step, self.records[step])
+        self._write_json('hashes', self.hashes)
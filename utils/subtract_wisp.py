@@ -37,9 +37,10 @@ import logging
 import argparse
 from functools import partial
 #import multiprocessing
-from multiprocessing import Pool
 import sys
 import os
+import shutil
+import tempfile
 import warnings
 warnings.filterwarnings('ignore', message="Input data contains invalid values*")  # nan values expected throughout code
 warnings.filterwarnings('ignore', message="All-NaN slice encountered*")
@@ -48,16 +49,24 @@ warnings.filterwarnings('ignore', message="'datfix' made the change*")  # from a
 
 from astropy.convolution import convolve, Gaussian2DKernel
 from astropy.io import fits
-from astropy.stats import median_absolute_deviation, sigma_clipped_stats
+from astropy.stats import sigma_clipped_stats
 from astropy.wcs import WCS
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import numpy as np
-from photutils.segmentation import detect_sources, detect_threshold
 from scipy.ndimage import binary_dilation, generate_binary_structure
 from tqdm.auto import tqdm
 
+import step_cache
+import source_mask
+import robust_stats
+import async_io
+import precision
+import worker_pool
+import run_report
+import profiling
+
 log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG)
 
@@ -73,9 +82,13 @@ formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(messag
 file_handler.setFormatter(formatter)
 log.addHandler(file_handler)
 
+# Detectors impacted by wisps
+wisp_detectors = ['nrca3', 'nrca4', 'nrcb3', 'nrcb4']
+
 # -----------------------------------------------------------------------------
 
-def make_segmap(f, seg_from_lw=True, sigma=0.8, npixels=10, dilate_segmap=5, save_segmap=False):
+def make_segmap(f, seg_from_lw=True, sigma=0.8, npixels=10, dilate_segmap=5, save_segmap=False, model=None, lw_image=None,
+                source_mask_dir=None, refine_source_mask=False, blot_method='polynomial', lw_segmap=None):
     """
     Make a segmentation map for the input file.
     
@@ -103,6 +116,30 @@ def make_segmap(f, seg_from_lw=True, sigma=0.8, npixels=10, dilate_segmap=5, sav
     save_segmap : bool
         Option to save the generated segmentation map.
 
+    model : jwst.datamodels.ImageModel
+        In-memory version of f. If given, its SCI, DQ and WCS are used instead of 
+        reading the cal file from disk.
+
+    lw_image : tuple
+        (sci, dq, wcs) of the corresponding longwave image, used instead of reading
+        the longwave cal file when seg_from_lw is True.
+
+    source_mask_dir : str
+        Directory of the shared source masks (see source_mask.py). If the longwave
+        exposure has one, its wisp segmap is used instead of detecting sources again.
+
+    refine_source_mask : bool
+        Option to also detect sources in the longwave image and add them to the
+        shared segmap.
+
+    blot_method : str
+        How the longwave segmap is projected onto the shortwave detector, 'polynomial'
+        or 'exact'. See blot_segmap().
+
+    lw_segmap : tuple
+        (segmap, wcs) of the corresponding longwave image from make_lw_segmap(), used
+        instead of making it again when seg_from_lw is True.
+
     Returns
     -------
     segmap : numpy.ndarray
@@ -121,41 +158,28 @@ def make_segmap(f, seg_from_lw=True, sigma=0.8, npixels=10, dilate_segmap=5, sav
     detector = os.path.basename(f).split('_')[-2].lower()
     f_sw = f.replace('_rate.fits', '_cal.fits')
     if (seg_from_lw) & ('long' not in detector):
-        if 'a' in detector:
-            f_lw = f.replace(detector.lower(), 'nrcalong').replace('_rate.fits', '_cal.fits')
-        if 'b' in detector:
-            f_lw = f.replace(detector.lower(), 'nrcblong').replace('_rate.fits', '_cal.fits')
-        data = fits.getdata(f_lw, 'SCI')
-        dq = fits.getdata(f_lw, 'DQ')
+        if lw_segmap is None:
+            lw_segmap = make_lw_segmap(f, sigma=sigma, npixels=npixels, dilate_segmap=dilate_segmap, lw_image=lw_image,
+                                       source_mask_dir=source_mask_dir, refine_source_mask=refine_source_mask)
+        segmap_data, lw_wcs = lw_segmap
     else:
-        data = fits.getdata(f_sw, 'SCI')
-        dq = fits.getdata(f_sw, 'DQ')
+        if model is not None:
+            data = model.data
+            dq = model.dq
+        else:
+            data = fits.getdata(f_sw, 'SCI')
+            dq = fits.getdata(f_sw, 'DQ')
 
-    # Make the segmentation map
-    threshold = detect_threshold(data, sigma)
-    g = Gaussian2DKernel(x_stddev=3)
-    data_conv = convolve(data, g, mask=dq&1!=0)  # Smooth input image before detecting sources
-    seg = detect_sources(data_conv, threshold, npixels=npixels, mask=dq&1!=0)  # avoid bad pixels as sources
-    segmap_data = seg.data
-    segmap_data[segmap_data!=0] = 1
-
-    # Dilate the segmap outwards
-    if dilate_segmap != 0:
-        segmap_data = binary_dilation(segmap_data, iterations=dilate_segmap, structure=generate_binary_structure(2, 2))
-        segmap_data[segmap_data!=0] = 1
+        # Make the segmentation map
+        segmap_data = source_mask.wisp_segmap(data, dq, sigma=sigma, npixels=npixels, dilate_segmap=dilate_segmap)
     
     # Blot LW segmap back onto SW detector space
     if (seg_from_lw) & ('long' not in detector):
-        segmap_tmp = np.zeros(segmap_data.shape).astype(int)
-        wcs = WCS(fits.getheader(f_lw, 'SCI'))  # lw cal wcs
-        seg_y, seg_x = np.where(segmap_data!=0)
-        sky_coords = wcs.pixel_to_world(seg_x, seg_y)
-        wcs = WCS(fits.getheader(f_sw, 'SCI'))  # sw cal wcs
-        coords = wcs.world_to_pixel(sky_coords)
-        for i in np.arange(len(coords[0])):
-            y,x = int(coords[1][i]), int(coords[0][i])
-            if (y<2048) & (x<2048) & (y>=0) & (x>=0):
-                segmap_tmp[y,x] = 1
+        if model is not None:
+            wcs = model.get_fits_wcs()  # sw cal wcs
+        else:
+            wcs = WCS(fits.getheader(f_sw, 'SCI'))  # sw cal wcs
+        segmap_tmp = blot_segmap(segmap_data, lw_wcs, wcs, method=blot_method)
         # Dilate to compensate for y,x rounding due to different lw/sw pixel scales
         segmap_data = binary_dilation(segmap_tmp, iterations=1, structure=generate_binary_structure(2, 2)).astype(int)
 
@@ -168,11 +192,272 @@ def make_segmap(f, seg_from_lw=True, sigma=0.8, npixels=10, dilate_segmap=5, sav
 
 # -----------------------------------------------------------------------------
 
+def make_lw_segmap(f, sigma=0.8, npixels=10, dilate_segmap=5, lw_image=None, source_mask_dir=None,
+                   refine_source_mask=False):
+    """
+    Make the segmentation map of the longwave image corresponding to the shortwave file f, in
+    longwave pixels. The shortwave files of a module share this segmap; make_segmap() blots it
+    onto each of their detectors.
+
+    See make_segmap() for the parameters.
+
+    Returns
+    -------
+    lw_segmap : tuple
+        (segmap, wcs) of the longwave image.
+    """
+
+    detector = os.path.basename(f).split('_')[-2].lower()
+    if 'a' in detector:
+        f_lw = f.replace(detector.lower(), 'nrcalong').replace('_rate.fits', '_cal.fits')
+    if 'b' in detector:
+        f_lw = f.replace(detector.lower(), 'nrcblong').replace('_rate.fits', '_cal.fits')
+    log.info('Making longwave segmap for {}'.format(f))
+
+    shared = source_mask.read_bits(source_mask.long_wavelength_root(f), source_mask_dir, [source_mask.WISP_BIT])
+    if lw_image is not None:
+        data, dq, lw_wcs = lw_image
+    else:
+        if not os.path.exists(f_lw):
+            # The longwave cal file is gone once it has been through the wisp/background steps
+            f_lw = f_lw.replace('_cal.fits', '_cal_final.fits')
+        lw_wcs = WCS(fits.getheader(f_lw, 'SCI'))
+        if (shared is None) | refine_source_mask:
+            data = fits.getdata(f_lw, 'SCI')
+            dq = fits.getdata(f_lw, 'DQ')
+
+    # Make the segmentation map
+    if shared is not None:
+        log.info('Using the shared source mask of {}'.format(source_mask.long_wavelength_root(f)))
+        segmap_data = shared[0].astype(int)
+        if refine_source_mask:
+            segmap_data[source_mask.wisp_segmap(data, dq, sigma, npixels, dilate_segmap) != 0] = 1
+    else:
+        segmap_data = source_mask.wisp_segmap(data, dq, sigma=sigma, npixels=npixels, dilate_segmap=dilate_segmap)
+    return segmap_data, lw_wcs
+
+# -----------------------------------------------------------------------------
+
+def sw_footprint(lw_wcs, sw_wcs, sw_shape, lw_shape, margin=4):
+    """
+    The box (x0, x1, y0, y1) of longwave pixels that can fall on the shortwave detector: the bounding
+    box of the shortwave detector edges in longwave pixels, grown by margin pixels and clipped to lw_shape.
+    """
+
+    ny, nx = sw_shape
+    edge = np.linspace(0, 1, 65)
+    x = np.concatenate([edge * (nx - 1), np.full(65, nx - 1), edge * (nx - 1), np.zeros(65)])
+    y = np.concatenate([np.zeros(65), edge * (ny - 1), np.full(65, ny - 1), edge * (ny - 1)])
+    lw_x, lw_y = lw_wcs.world_to_pixel(sw_wcs.pixel_to_world(x, y))
+    x0 = int(max(np.floor(np.min(lw_x)) - margin, 0))
+    x1 = int(min(np.ceil(np.max(lw_x)) + margin, lw_shape[1] - 1))
+    y0 = int(max(np.floor(np.min(lw_y)) - margin, 0))
+    y1 = int(min(np.ceil(np.max(lw_y)) + margin, lw_shape[0] - 1))
+    return x0, x1, y0, y1
+
+# -----------------------------------------------------------------------------
+
+def fit_pixel_mapping(lw_wcs, sw_wcs, box, degree=5, grid_step=32):
+    """
+    Fit polynomials in the longwave pixel coordinates to the shortwave pixel coordinates of the same sky positions.
+
+    The fit uses a grid of longwave pixels with grid_step spacing over box (x0, x1, y0, y1), and is
+    checked against the exact transform at the centers of the grid cells.
+
+    Returns
+    -------
+    mapping : function
+        mapping(x, y) returns the shortwave (x, y) of longwave pixels (x, y).
+
+    error : float
+        The maximum distance (in shortwave pixels) between the fit and the exact transform at
+        the grid cell centers.
+    """
+
+    x0, x1, y0, y1 = box
+    x_mid, y_mid = (x0 + x1) / 2, (y0 + y1) / 2
+    x_half, y_half = max((x1 - x0) / 2, 1), max((y1 - y0) / 2, 1)
+    terms = [(i, j) for i in range(degree + 1) for j in range(degree + 1 - i)]
+
+    def exact(x, y):
+        return sw_wcs.world_to_pixel(lw_wcs.pixel_to_world(x, y))
+
+    def powers(x, y):
+        # Normalized coordinates keep the fit well conditioned
+        u = (np.asarray(x, dtype=float) - x_mid) / x_half
+        v = (np.asarray(y, dtype=float) - y_mid) / y_half
+        u_powers, v_powers = [np.ones_like(u)], [np.ones_like(v)]
+        for _ in range(degree):
+            u_powers.append(u_powers[-1] * u)
+            v_powers.append(v_powers[-1] * v)
+        return u_powers, v_powers
+
+    def mapping(x, y):
+        u_powers, v_powers = powers(x, y)
+        sw_x, sw_y = np.zeros(u_powers[0].shape), np.zeros(u_powers[0].shape)
+        for (i, j), (cx, cy) in zip(terms, coeffs):
+            term = u_powers[i] * v_powers[j]
+            sw_x += cx * term
+            sw_y += cy * term
+        return sw_x, sw_y
+
+    gx = np.unique(np.append(np.arange(x0, x1, grid_step), x1))
+    gy = np.unique(np.append(np.arange(y0, y1, grid_step), y1))
+    gx, gy = [a.ravel() for a in np.meshgrid(gx, gy)]
+    u_powers, v_powers = powers(gx, gy)
+    design = np.array([u_powers[i] * v_powers[j] for i, j in terms]).T
+    coeffs = np.linalg.lstsq(design, np.column_stack(exact(gx, gy)), rcond=None)[0]
+
+    cx, cy = np.meshgrid(np.arange(x0 + grid_step / 2, x1, grid_step), np.arange(y0 + grid_step / 2, y1, grid_step))
+    check_x, check_y = exact(cx.ravel(), cy.ravel())
+    fit_x, fit_y = mapping(cx.ravel(), cy.ravel())
+    error = np.max(np.hypot(fit_x - check_x, fit_y - check_y), initial=0)
+
+    return mapping, error
+
+# -----------------------------------------------------------------------------
+
+def blot_segmap(segmap_data, lw_wcs, sw_wcs, method='polynomial', degree=5, grid_step=32, tolerance=0.01):
+    """
+    Project a longwave segmap onto the shortwave detector: every shortwave pixel that
+    contains the center of a longwave source pixel is set to 1.
+
+    Parameters
+    ----------
+    segmap_data : numpy.ndarray
+        The longwave segmap.
+
+    lw_wcs, sw_wcs : astropy.wcs.WCS
+        The longwave and shortwave WCS.
+
+    method : str
+        'exact' transforms every source pixel to the sky and back with the two WCSs.
+        'polynomial' only considers the source pixels within the shortwave footprint (see
+        sw_footprint()) and maps them with fit_pixel_mapping(), using the given degree and
+        grid_step, unless its error is larger than tolerance shortwave pixels.
+
+    Returns
+    -------
+    segmap_tmp : numpy.ndarray
+        The segmap in shortwave pixels, before dilation.
+    """
+
+    seg_y, seg_x = np.where(segmap_data!=0)
+    mapping = None
+    if method == 'polynomial':
+        box = sw_footprint(lw_wcs, sw_wcs, segmap_data.shape, segmap_data.shape)
+        mapping, error = fit_pixel_mapping(lw_wcs, sw_wcs, box, degree=degree, grid_step=grid_step)
+        if np.isfinite(error) & (error <= tolerance):
+            log.info('Blotting with a polynomial pixel mapping, max error {:.2g} pixels'.format(error))
+            x0, x1, y0, y1 = box
+            in_box = (seg_x >= x0) & (seg_x <= x1) & (seg_y >= y0) & (seg_y <= y1)
+            seg_x, seg_y = seg_x[in_box], seg_y[in_box]
+        else:
+            log.info('Polynomial pixel mapping error {:.2g} pixels above {}, blotting with the exact transform'.format(error, tolerance))
+            mapping = None
+    if mapping is not None:
+        coords = mapping(seg_x, seg_y)
+    else:
+        coords = sw_wcs.world_to_pixel(lw_wcs.pixel_to_world(seg_x, seg_y))
+
+    # Truncate like int() and keep the pixels on the detector
+    finite = np.isfinite(coords[0]) & np.isfinite(coords[1])
+    x, y = coords[0][finite].astype(int), coords[1][finite].astype(int)
+    inside = (y<segmap_data.shape[0]) & (x<segmap_data.shape[1]) & (y>=0) & (x>=0)
+    segmap_tmp = np.zeros(segmap_data.shape).astype(int)
+    segmap_tmp[y[inside], x[inside]] = 1
+    return segmap_tmp
+
+# -----------------------------------------------------------------------------
+
+def wisp_region(wisp_data):
+    """Mask of the brightest region of a wisp template, used to scale it."""
+
+    mean, med, stddev = sigma_clipped_stats(wisp_data)
+    return (wisp_data > med + 2 * stddev).astype(int)
+
+# -----------------------------------------------------------------------------
+
+class WispTemplateStore:
+    """
+    The wisp templates needed for a set of files, with their bright-region masks, as memory-mapped
+    .npy files in a temporary directory.
+
+    The parent process reads each template once (see from_files()) and the pool workers map the
+    .npy files (see attach_template_store()), so they share one copy of each template through the
+    page cache instead of each reading and holding their own.
+
+    Parameters
+    ----------
+    directory : str
+        The directory of the .npy files.
+
+    index : dict
+        {(detector, filter, pupil, file_type): (template file, mask file)}
+    """
+
+    def __init__(self, directory, index):
+        self.directory = directory
+        self.index = index
+        self.templates = {}
+
+    @classmethod
+    def from_files(cls, files, wisp_dir, gauss_smooth_wisp=False, gauss_stddev=3.0):
+        """Load the templates for files from wisp_dir, smoothed if gauss_smooth_wisp is set."""
+
+        keys = set()
+        for f in files:
+            header = fits.getheader(f)
+            file_type = f.split('_')[-1].replace('.fits', '').upper()  # CAL or RATE
+            keys.add((header['DETECTOR'], header['FILTER'], header['PUPIL'], file_type))
+
+        directory = tempfile.mkdtemp(prefix='wisp_templates_')
+        index = {}
+        for det, fltr, pupil, file_type in sorted(keys):
+            template_file = os.path.join(wisp_dir, 'WISP_{}_{}_{}.fits'.format(det, fltr, pupil))
+            if not os.path.exists(template_file):
+                continue  # process_file reports the missing template
+            wisp_data = fits.getdata(template_file, file_type)
+            if gauss_smooth_wisp:
+                wisp_data = convolve(wisp_data, Gaussian2DKernel(x_stddev=gauss_stddev))
+            name = os.path.join(directory, 'WISP_{}_{}_{}_{}'.format(det, fltr, pupil, file_type))
+            np.save(name + '.npy', wisp_data)
+            np.save(name + '_mask.npy', wisp_region(wisp_data))
+            index[(det, fltr, pupil, file_type)] = (name + '.npy', name + '_mask.npy')
+        log.info('Loaded {} wisp templates into {}'.format(len(index), directory))
+        return cls(directory, index)
+
+    def get(self, det, fltr, pupil, file_type):
+        """(template, mask) as read-only memory maps, or None if the template is not in the store."""
+
+        key = (det, fltr, pupil, file_type)
+        if key not in self.index:
+            return None
+        if key not in self.templates:
+            self.templates[key] = tuple(np.load(name, mmap_mode='r') for name in self.index[key])
+        return self.templates[key]
+
+    def remove(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+# Template store of a pool worker, see attach_template_store()
+template_store = None
+
+def attach_template_store(directory, index):
+    """Pool initializer giving the worker access to the parent's WispTemplateStore."""
+
+    global template_store
+    template_store = WispTemplateStore(directory, index)
+
+# -----------------------------------------------------------------------------
+
 def process_file(f, wisp_dir='./', create_segmap=True, seg_from_lw=True, sigma=0.8, npixels=10, dilate_segmap=5,
                  save_segmap=False, sub_wisp=True, gauss_smooth_wisp=False, gauss_stddev=3.0, scale_wisp=True,
                  scale_method='mad', poly_degree=5, factor_min=0.0, factor_max=2.0, factor_step=0.01, min_wisp=None, 
                  flag_wisp_thresh=None, dq_val=1, correct_rows=True, correct_cols=False, save_data=True, save_model=True, 
-                 plot=True, show_plot=False, suffix='_wisp'):
+                 plot=True, show_plot=False, suffix='_wisp', model=None, lw_image=None, source_mask_dir=None,
+                 refine_source_mask=False, factor_search='grid', blot_method='polynomial', lw_segmap=None,
+                 stats_mode='exact', compute_precision='float64', writer=None):
     """
     The main processing function. Combines the segmap creation and wisp scaling/subtraction steps together.
 
@@ -187,48 +472,137 @@ def process_file(f, wisp_dir='./', create_segmap=True, seg_from_lw=True, sigma=0
     wisp_dir : str
         The directory containing the wisp templates. The templates are assumed to have the 
         form WISP_{DETECTOR}_{FILTER}_{PUPIL}.fits.
+
+    model : jwst.datamodels.ImageModel
+        In-memory cal image for f. If given, the wisp is subtracted from the model rather than
+        from the file on disk, and f is only used to name the output products.
+
+    lw_image : tuple
+        (sci, dq, wcs) of the corresponding longwave image, see make_segmap().
+
+    lw_segmap : tuple
+        (segmap, wcs) of the corresponding longwave image, see make_segmap().
+
+    writer : async_io.WriteBehind
+        Writes the output products in the background, see subtract_wisp().
     """
 
-    # Get the relevant wisp template
-    log.info('Processing {}'.format(f))
-    header = fits.getheader(f)
-    det, fltr, pupil = header['DETECTOR'], header['FILTER'], header['PUPIL']
-    file_type = f.split('_')[-1].replace('.fits', '').upper()  # CAL or RATE
-    wisp_data = fits.getdata(os.path.join(wisp_dir, 'WISP_{}_{}_{}.fits'.format(det, fltr, pupil)), file_type)
+    with run_report.exposure('wisp_subtraction', f):
+        # Get the relevant wisp template
+        log.info('Processing {}'.format(f))
+        if model is not None:
+            instrument = model.meta.instrument
+            det, fltr, pupil = instrument.detector, instrument.filter, instrument.pupil
+            file_type = 'CAL'
+        else:
+            header = fits.getheader(f)
+            det, fltr, pupil = header['DETECTOR'], header['FILTER'], header['PUPIL']
+            file_type = f.split('_')[-1].replace('.fits', '').upper()  # CAL or RATE
+        template = template_store.get(det, fltr, pupil, file_type) if template_store is not None else None
+        if template is not None:
+            # Already smoothed if gauss_smooth_wisp is set, see WispTemplateStore
+            wisp_data, wisp_mask = template
+            gauss_smooth_wisp = False
+        else:
+            wisp_data = fits.getdata(os.path.join(wisp_dir, 'WISP_{}_{}_{}.fits'.format(det, fltr, pupil)), file_type)
+            wisp_mask = None
+
+        # Make the segmentation map
+        if create_segmap:
+            with run_report.phase('segmap'):
+                segmap_data = make_segmap(f, seg_from_lw=seg_from_lw, sigma=sigma, npixels=npixels, 
+                                          dilate_segmap=dilate_segmap, save_segmap=save_segmap,
+                                          model=model, lw_image=lw_image, source_mask_dir=source_mask_dir,
+                                          refine_source_mask=refine_source_mask, blot_method=blot_method,
+                                          lw_segmap=lw_segmap)
+        else:
+            segmap_data = np.zeros(wisp_data.shape).astype(int)
+
+        # Scale and subtract wisp template
+        results = subtract_wisp(f, wisp_data=wisp_data, segmap_data=segmap_data, sub_wisp=sub_wisp, 
+                                gauss_smooth_wisp=gauss_smooth_wisp, gauss_stddev=gauss_stddev, 
+                                scale_wisp=scale_wisp, scale_method=scale_method, poly_degree=poly_degree, 
+                                factor_min=factor_min, factor_max=factor_max, factor_step=factor_step, 
+                                min_wisp=min_wisp, flag_wisp_thresh=flag_wisp_thresh, dq_val=dq_val, 
+                                correct_rows=correct_rows, correct_cols=correct_cols, save_data=save_data, 
+                                save_model=save_model, plot=plot, show_plot=show_plot, suffix=suffix, model=model,
+                                factor_search=factor_search, wisp_mask=wisp_mask,
+                                stats_mode=stats_mode, compute_precision=compute_precision, writer=writer)
+        log.info('Processing complete for {}'.format(f))
+
+# -----------------------------------------------------------------------------
+
+def process_group(files, async_io_depth=0, **kwargs):
+    """Run process_file() on shortwave files of the same module and exposure, making their longwave segmap only once.
 
-    # Make the segmentation map
-    if create_segmap:
-        segmap_data = make_segmap(f, seg_from_lw=seg_from_lw, sigma=sigma, npixels=npixels, 
-                                  dilate_segmap=dilate_segmap, save_segmap=save_segmap)
+    With async_io_depth > 0 the next files are read into the page cache and the products
+    of the previous ones are written in background threads (see async_io.py).
+    """
+
+    def longwave_segmap():
+        if kwargs.get('create_segmap', True) & kwargs.get('seg_from_lw', True):
+            return make_lw_segmap(files[0], sigma=kwargs.get('sigma', 0.8), npixels=kwargs.get('npixels', 10),
+                                  dilate_segmap=kwargs.get('dilate_segmap', 5),
+                                  source_mask_dir=kwargs.get('source_mask_dir'),
+                                  refine_source_mask=kwargs.get('refine_source_mask', False))
+        return None
+
+    if async_io_depth > 0:
+        with async_io.WriteBehind(async_io_depth) as writer, \
+             async_io.Prefetcher(files, async_io.read_ahead, async_io_depth) as inputs:
+            lw_segmap = longwave_segmap()
+            for f, _ in inputs:
+                process_file(f, lw_segmap=lw_segmap, writer=writer, **kwargs)
     else:
-        segmap_data = np.zeros(wisp_data.shape).astype(int)
-
-    # Scale and subtract wisp template
-    results = subtract_wisp(f, wisp_data=wisp_data, segmap_data=segmap_data, sub_wisp=sub_wisp, 
-                            gauss_smooth_wisp=gauss_smooth_wisp, gauss_stddev=gauss_stddev, 
-                            scale_wisp=scale_wisp, scale_method=scale_method, poly_degree=poly_degree, 
-                            factor_min=factor_min, factor_max=factor_max, factor_step=factor_step, 
-                            min_wisp=min_wisp, flag_wisp_thresh=flag_wisp_thresh, dq_val=dq_val, 
-                            correct_rows=correct_rows, correct_cols=correct_cols, save_data=save_data, 
-                            save_model=save_model, plot=plot, show_plot=show_plot, suffix=suffix)
-    log.info('Processing complete for {}'.format(f))
+        lw_segmap = longwave_segmap()
+        for f in files:
+            process_file(f, lw_segmap=lw_segmap, **kwargs)
+    return files
 
 # -----------------------------------------------------------------------------
 
-def process_files(files, nproc=6, **kwargs):
-    """"Wrapper around the process_file() function to allow for multiprocessing."""
+def process_files(files, nproc=6, memory_aware=False, memory_budget_gb=0, task_memory_gb=0, maxtasksperchild=0, profile=0,
+                  **kwargs):
+    """"Wrapper around the process_file() function to allow for multiprocessing.
+
+    With memory_aware, groups of files start only while their memory fits in memory_budget_gb,
+    see worker_pool.py.
+    With profile N, every Nth group runs under cProfile and the merged profile is written next
+    to the files, see profiling.py.
+    """
 
     # Remove any files that are not in a detector impacted by wisps
-    relevant_files = [f for f in files if any(substring in f for substring in ['nrca3', 'nrca4', 'nrcb3', 'nrcb4'])]
+    relevant_files = [f for f in files if any(substring in f for substring in wisp_detectors)]
     non_relevant_files = [f for f in files if f not in relevant_files]
     log.info('Found {} relevant input files.'.format(len(relevant_files)))
     log.info('Found {} non-relevant input files.'.format(len(non_relevant_files)))
     
-    process_file_partial = partial(process_file, **kwargs)
-    with Pool(processes=nproc) as pool:
-        with tqdm(total=len(relevant_files), file=sys.stdout) as pbar:
-            for _ in pool.imap_unordered(process_file_partial, relevant_files):
-                pbar.update(1)
+    # Files sharing a longwave segmap go to the same worker
+    groups = {}
+    for f in relevant_files:
+        groups.setdefault(source_mask.long_wavelength_root(f), []).append(f)
+    log.info('Processing {} longwave segmap groups.'.format(len(groups)))
+
+    # Load every template once, for all workers
+    store = WispTemplateStore.from_files(relevant_files, kwargs.get('wisp_dir', './'),
+                                         gauss_smooth_wisp=kwargs.get('gauss_smooth_wisp', False),
+                                         gauss_stddev=kwargs.get('gauss_stddev', 3.0))
+
+    process_group_partial = partial(process_group, **kwargs)
+    profile_dir = os.path.dirname(relevant_files[0]) if relevant_files else '.'
+    task, items = profiling.sample(process_group_partial, groups.values(), 'wisp_subtraction', profile, profile_dir)
+    try:
+        with worker_pool.MemoryAwarePool('wisp_subtraction', processes=nproc, memory_budget=memory_budget_gb * 1e9,
+                                         task_memory=task_memory_gb * 1e9, maxtasksperchild=maxtasksperchild,
+                                         memory_aware=memory_aware,
+                                         initializer=attach_template_store,
+                                         initargs=(store.directory, store.index)) as pool:
+            with tqdm(total=len(relevant_files), file=sys.stdout) as pbar:
+                for group in pool.imap_unordered(task, items):
+                    pbar.update(len(group))
+    finally:
+        store.remove()
+    profiling.merge('wisp_subtraction', profile_dir)
 
     for file in non_relevant_files:
         if file.endswith('_cal.fits'):
@@ -246,10 +620,87 @@ def process_files(files, nproc=6, **kwargs):
 
 # -----------------------------------------------------------------------------
 
+def wisp_residuals(data_masked, wisp_data_masked, factors, scale_method='mad', med=None, block_size=2**22):
+    """
+    Residuals of data_masked - factor * wisp_data_masked for each of the wisp scale factors.
+
+    Gives the same residuals as scaling the full images factor by factor (see subtract_wisp()),
+    but only keeps the pixels where both images are finite and evaluates blocks of factors at once.
+
+    Parameters
+    ----------
+    data_masked : numpy.ndarray
+        The data, NaN outside the good pixels in the wisp region.
+
+    wisp_data_masked : numpy.ndarray
+        The wisp template, NaN outside the good pixels in the wisp region.
+
+    factors : numpy.ndarray
+        The wisp scale factors to test.
+
+    scale_method : str
+        'mad' or 'median', see subtract_wisp().
+
+    med : float
+        The median of the data outside the wisp region, used by the 'median' scale_method.
+
+    block_size : int
+        The maximum number of values evaluated at once.
+
+    Returns
+    -------
+    residuals : numpy.ndarray
+        The residual for each factor.
+    """
+
+    valid = np.isfinite(data_masked) & np.isfinite(wisp_data_masked)
+    data_values = data_masked[valid]
+    wisp_values = wisp_data_masked[valid]
+    residuals = np.full(len(factors), np.nan)
+    if data_values.size == 0:
+        return residuals
+
+    # Scale in the type of the array-times-scalar product of the full images
+    factor_dtype = (wisp_data_masked[:1, :1] * factors[0]).dtype
+    nblock = max(1, block_size // data_values.size)
+    for start in range(0, len(factors), nblock):
+        block = factors[start:start + nblock, None].astype(factor_dtype)
+        new_data = data_values - wisp_values * block
+        if scale_method == 'mad':
+            center = np.median(new_data, axis=1, keepdims=True)
+            residuals[start:start + nblock] = np.median(np.abs(new_data - center), axis=1)
+        if scale_method == 'median':
+            residuals[start:start + nblock] = abs(med - np.median(new_data, axis=1))
+    return residuals
+
+# -----------------------------------------------------------------------------
+
+def coarse_wisp_residuals(data_masked, wisp_data_masked, factors, scale_method='mad', med=None, coarse_step=10):
+    """
+    Residuals of every coarse_step-th wisp scale factor, and of all factors between the
+    coarse neighbours of the best of those. The residuals of the other factors are NaN.
+
+    See wisp_residuals() for the parameters.
+    """
+
+    residuals = np.full(len(factors), np.nan)
+    coarse = np.arange(0, len(factors), coarse_step)
+    residuals[coarse] = wisp_residuals(data_masked, wisp_data_masked, factors[coarse], scale_method, med)
+    if np.all(np.isnan(residuals)):
+        return residuals
+    best = coarse[np.nanargmin(residuals[coarse])]
+    fine = np.arange(max(best - coarse_step + 1, 0), min(best + coarse_step, len(factors)))
+    fine = fine[np.isnan(residuals[fine])]
+    residuals[fine] = wisp_residuals(data_masked, wisp_data_masked, factors[fine], scale_method, med)
+    return residuals
+
+# -----------------------------------------------------------------------------
+
 def subtract_wisp(f, wisp_data, segmap_data=None, sub_wisp=True, gauss_smooth_wisp=False, gauss_stddev=3.0, scale_wisp=True,
                   scale_method='mad', poly_degree=5, factor_min=0.0, factor_max=2.0, factor_step=0.01, min_wisp=None, 
                   flag_wisp_thresh=None, dq_val=1, correct_rows=True, correct_cols=False, save_data=True, save_model=True, plot=True, 
-                  show_plot=False, suffix='_wisp'):
+                  show_plot=False, suffix='_wisp', model=None, factor_search='grid', wisp_mask=None, stats_mode='exact',
+                  compute_precision='float64', writer=None):
     """Scales and subtracts a wisp template from the input file.
 
     Parameters
@@ -300,6 +751,23 @@ def subtract_wisp(f, wisp_data, segmap_data=None, sub_wisp=True, gauss_smooth_wi
         Scale factors from factor_min to factor_max in iterations equal to the step distance 
         specified here will all be tested.
 
+    factor_search : str
+        How the scale factors are tested. 'grid' tests all of them (see wisp_residuals()).
+        'coarse' tests every tenth factor and then all factors around the best one (see
+        coarse_wisp_residuals()); it is faster but only finds the same factor if the residuals
+        have a single minimum, and the residuals of the untested factors are NaN.
+
+    stats_mode : str
+        'exact' or 'fast' for the median levels of the image outside the wisp region, see
+        robust_stats.py.
+
+    compute_precision : str
+        'float64' or 'float32' for the row/column correction of the data, see precision.py.
+
+    writer : async_io.WriteBehind
+        If given, the output FITS files are written by writer, in the background, instead of
+        before this function returns.
+
     min_wisp : float
         The minimum wisp value to perform wisp subtraction. Everything below this value will be set
         to zero in the wisp template before subtracting from the input file. The units of this
@@ -346,6 +814,14 @@ def subtract_wisp(f, wisp_data, segmap_data=None, sub_wisp=True, gauss_smooth_wi
         The suffix added to all of the output products. If left blank, the original input file will be 
         overwritten if save_data is True.
 
+    model : jwst.datamodels.ImageModel
+        In-memory cal image for f. If given, the data are taken from the model and, if save_data
+        is True, the wisp-subtracted SCI and DQ arrays are put back into the model instead of
+        being written to disk.
+
+    wisp_mask : numpy.ndarray
+        The bright region of wisp_data, as made by wisp_region(). Computed here if None.
+
     Returns
     -------
     new_data : numpy.ndarray
@@ -380,9 +856,13 @@ def subtract_wisp(f, wisp_data, segmap_data=None, sub_wisp=True, gauss_smooth_wi
 
     # Get the input data
     log.info('Applying wisp template to {}'.format(f))
-    h = fits.open(f)
-    data = h['SCI'].data
-    dq = h['DQ'].data
+    if model is not None:
+        data = model.data
+        dq = model.dq
+    else:
+        h = fits.open(f)
+        data = h['SCI'].data
+        dq = h['DQ'].data
     if segmap_data is None:
         log.info('Warning: No segmap data given for {}. Assuming no sources.'.format(f))
         segmap_data = np.zeros(data.shape)
@@ -395,8 +875,8 @@ def subtract_wisp(f, wisp_data, segmap_data=None, sub_wisp=True, gauss_smooth_wi
     # Scale the wisp template
     if scale_wisp:
         # Make a mask of the brightest wisp region
-        mean, med, stddev = sigma_clipped_stats(wisp_data)
-        wisp_mask = (wisp_data > med + 2 * stddev).astype(int)
+        if wisp_mask is None:
+            wisp_mask = wisp_region(wisp_data)
 
         # Make versions of the original data and wisp model where only good 
         # pixels in the wisp region are unmasked.
@@ -412,40 +892,36 @@ def subtract_wisp(f, wisp_data, segmap_data=None, sub_wisp=True, gauss_smooth_wi
 
         # Correct median-collapsed row/column offsets, representing the 1/f residuals 
         # and odd-even column residuals and amp offsets, respectively.
-        med = np.nanmedian(data_masked_ff)
+        dtype = precision.compute_dtype(compute_precision)
+        med = robust_stats.median(data_masked_ff, mode=stats_mode)
         if correct_rows:
-            collapsed_rows = np.nanmedian(data_masked_ff - med, axis=1)
+            collapsed_rows = np.nanmedian(data_masked_ff - med, axis=1).astype(dtype)
         else:
-            collapsed_rows = np.zeros(2048)
+            collapsed_rows = np.zeros(2048, dtype=dtype)
         if correct_cols:
-            collapsed_cols = np.nanmedian(data_masked_ff - med, axis=0)
+            collapsed_cols = np.nanmedian(data_masked_ff - med, axis=0).astype(dtype)
         else:
-            collapsed_cols = np.zeros(2048)
-        correction_image = np.tile(collapsed_cols, (2048, 1)) + \
-                        np.swapaxes(np.tile(collapsed_rows, (2048, 1)), 0, 1)
+            collapsed_cols = np.zeros(2048, dtype=dtype)
+        correction_image = collapsed_cols[None, :] + collapsed_rows[:, None]
         data_masked = data_masked - correction_image        
         data_masked_ff = data_masked_ff - correction_image
-        med = np.nanmedian(data_masked_ff)
+        med = robust_stats.median(data_masked_ff, mode=stats_mode)
         
         # Scale wisp template and record residuals
         factors = np.arange(factor_min, factor_max, factor_step)
-        residuals = []
-        for factor in factors:
-            wisp_model = wisp_data_masked * factor
-            new_data = data_masked - wisp_model
-            if scale_method == 'mad':
-                residual = median_absolute_deviation(new_data, ignore_nan=True)
-            if scale_method == 'median':
-                residual = abs(med - np.nanmedian(new_data))
-            residuals.append(residual)
-        residuals = np.array(residuals)
+        with run_report.phase('factor_loop'):
+            if factor_search == 'coarse':
+                residuals = coarse_wisp_residuals(data_masked, wisp_data_masked, factors, scale_method, med)
+            else:
+                residuals = wisp_residuals(data_masked, wisp_data_masked, factors, scale_method, med)
+        evaluated = np.isfinite(residuals)
 
         # Choose the wisp template with the lowest noise
         if poly_degree != 0:
-            fn = np.poly1d(np.polyfit(factors, residuals, poly_degree))  # smooth results
+            fn = np.poly1d(np.polyfit(factors[evaluated], residuals[evaluated], poly_degree))  # smooth results
             factor = factors[np.argmin(fn(factors))]
         else:
-            factor = factors[np.argmin(residuals)]
+            factor = factors[np.nanargmin(residuals)]
         wisp_model = wisp_data * factor
     else:
         # Don't scale the wisp data
@@ -471,13 +947,23 @@ def subtract_wisp(f, wisp_data, segmap_data=None, sub_wisp=True, gauss_smooth_wi
         new_data = data
 
     # Save the wisp-subtracted data and model
+    if writer is not None:
+        write = writer.submit
+    else:
+        def write(function, *args, **kwargs):
+            function(*args, **kwargs)
     if save_data:
-        h['SCI'].data = new_data.astype('float32')
-        h['DQ'].data = new_dq
-        h.writeto(f.replace('.fits', '{}.fits'.format(suffix)), overwrite=True)
+        if model is not None:
+            model.data = new_data.astype('float32')
+            model.dq = new_dq
+        else:
+            h['SCI'].data = new_data.astype('float32')
+            h['DQ'].data = new_dq
+            write(h.writeto, f.replace('.fits', '{}.fits'.format(suffix)), overwrite=True)
     if save_model:
-        fits.writeto(f.replace('.fits', '{}_model.fits'.format(suffix)), wisp_model, overwrite=True)
-    h.close()
+        write(fits.writeto, f.replace('.fits', '{}_model.fits'.format(suffix)), wisp_model, overwrite=True)
+    if model is None:
+        write(h.close)  # after the writes, which may still read from h
 
     # Make diagnostic plots
     if plot:
@@ -536,6 +1022,11 @@ def parse_args():
     # Make the help strings
     files_help = 'The files to subtract the wisp templates from. Wildcards are supported, e.g. ./data/*nrca3*_cal.fits'
     nproc_help = 'The number of processes to use during multiprocessing.'
+    memory_aware_help = 'Option to start groups of files only while their memory fits in the budget. See worker_pool.py.'
+    memory_help = 'With --memory_aware, memory budget (GB) of all workers together, 0 for 80%% of the available memory.'
+    task_memory_help = 'With --memory_aware, peak memory (GB) of a worker task, 0 to measure it.'
+    maxtasksperchild_help = 'Tasks after which a worker is replaced, 0 to keep the workers.'
+    profile_help = 'Run every Nth longwave group of files under cProfile, 0 to disable. See profiling.py.'
     wisp_dir_help = 'The directory containing the wisp templates. The templates are assumed to have the form WISP_{DETECTOR}_{FILTER}_{PUPIL}.fits.'
     create_segmap_help = 'Option to make a source segmentation map to help with scaling the wisp template.'
 
@@ -543,6 +1034,11 @@ def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--files', dest='files', action='store', nargs='+', type=str, required=False, help=files_help, default='./*_cal.fits')
     parser.add_argument('--nproc', dest='nproc', action='store', type=int, required=False, help=nproc_help, default=6)
+    parser.add_argument('--memory_aware', dest='memory_aware', action=argparse.BooleanOptionalAction, required=False, help=memory_aware_help, default=False)
+    parser.add_argument('--memory_budget_gb', dest='memory_budget_gb', action='store', type=float, required=False, help=memory_help, default=0)
+    parser.add_argument('--task_memory_gb', dest='task_memory_gb', action='store', type=float, required=False, help=task_memory_help, default=0)
+    parser.add_argument('--maxtasksperchild', dest='maxtasksperchild', action='store', type=int, required=False, help=maxtasksperchild_help, default=0)
+    parser.add_argument('--profile', dest='profile', action='store', type=int, required=False, help=profile_help, default=0)
     parser.add_argument('--wisp_dir', dest='wisp_dir', action='store', type=str, required=False, help=wisp_dir_help, default='./')
     parser.add_argument('--create_segmap', dest='create_segmap', action=argparse.BooleanOptionalAction, required=False, help=create_segmap_help, default=True)
     
@@ -552,6 +1048,9 @@ def parse_args():
     parser.add_argument('--npixels', dest='npixels', action='store', type=int, required=False, default=10)
     parser.add_argument('--dilate_segmap', dest='dilate_segmap', action='store', type=int, required=False, default=5)
     parser.add_argument('--save_segmap', dest='save_segmap', action=argparse.BooleanOptionalAction, required=False, default=False)
+    parser.add_argument('--source_mask_dir', dest='source_mask_dir', action='store', type=str, required=False, default=None)
+    parser.add_argument('--refine_source_mask', dest='refine_source_mask', action=argparse.BooleanOptionalAction, required=False, default=False)
+    parser.add_argument('--blot_method', dest='blot_method', action='store', type=str, required=False, default='polynomial', choices=['polynomial', 'exact'])
 
     # Add arguments for subtract_wisp()
     parser.add_argument('--sub_wisp', dest='sub_wisp', action=argparse.BooleanOptionalAction, required=False, default=True)
@@ -563,6 +1062,10 @@ def parse_args():
     parser.add_argument('--factor_min', dest='factor_min', action='store', type=float, required=False, default=0.0)
     parser.add_argument('--factor_max', dest='factor_max', action='store', type=float, required=False, default=2.0)
     parser.add_argument('--factor_step', dest='factor_step', action='store', type=float, required=False, default=0.01)
+    parser.add_argument('--factor_search', dest='factor_search', action='store', type=str, required=False, default='grid', choices=['grid', 'coarse'])
+    parser.add_argument('--async_io_depth', dest='async_io_depth', action='store', type=int, required=False, default=0)
+    parser.add_argument('--stats_mode', dest='stats_mode', action='store', type=str, required=False, default='exact', choices=list(robust_stats.MODES))
+    parser.add_argument('--compute_precision', dest='compute_precision', action='store', type=str, required=False, default='float64', choices=list(precision.PRECISIONS))
     parser.add_argument('--min_wisp', dest='min_wisp', action='store', type=float, required=False, default=None)
     parser.add_argument('--flag_wisp_thresh', dest='flag_wisp_thresh', action='store', type=float, required=False, default=None)
     parser.add_argument('--dq_val', dest='dq_val', action='store', type=int, required=False, default=1)
@@ -587,6 +1090,21 @@ if __name__ == '__main__':
     # Get the command line arguments
     args = parse_args()
 
+    # Only process the files whose inputs or settings changed since the last run
+    kwargs = vars(args)
+    cache = None
+    if isinstance(kwargs['files'], list) and kwargs['files']:
+        cache = step_cache.load(os.path.dirname(kwargs['files'][0]))
+    if cache is not None:
+        cache_params = {k: v for k, v in kwargs.items() if k not in ('files', 'nproc', 'async_io_depth', 'memory_aware', 'memory_budget_gb',
+                                                                   'task_memory_gb', 'maxtasksperchild', 'profile')}
+        # The shell glob stays unexpanded when every _cal.fits has already been replaced
+        files = [f for f in kwargs['files'] if os.path.exists(f)]
+        kwargs['files'] = cache.pending('wisp_subtraction', files, params=cache_params)
+
     # Process the input files
-    results = process_files(**vars(args))
+    results = process_files(**kwargs)
+    if cache is not None:
+        for f in kwargs['files']:
+            cache.record('wisp_subtraction', f, params=cache_params)
     log.info('subtract_wisp.py complete.')
@@ -0,0 +1,116 @@
+"""
+Background2D with the box statistics in threads and a vectorized mesh filter.
+
+SubtractBackground.estimate_background runs photutils Background2D with 5x5
+boxes on a 2048x2048 detector: about 168k boxes, each sigma clipped and reduced
+to a biweight location, and then a 3x3 median filter over the mesh, which
+scipy's generic_filter evaluates with one Python call to nanmedian per mesh
+point (most of the run time).
+
+TiledBackground2D is a drop-in Background2D that
+
+    - splits the rows of boxes into nthreads strips and computes their
+      statistics in a thread pool. Every box is independent of the others, so
+      the strips need no overlap and the stitched mesh is the one Background2D
+      computes. Threads rather than processes, since the callers already run
+      one process per exposure (and pool workers cannot start pools of their
+      own).
+    - filters the mesh by sorting all 3x3 windows at once.
+
+The mesh, the filtered mesh and the background are identical to those of
+Background2D. The two hooks override photutils internals (photutils 2.x/3.x);
+with a photutils that does not have them the Background2D implementation is
+used unchanged. Run this module to compare the two on random data.
+
+Use
+---
+    >>> from tiled_background import TiledBackground2D
+    >>> bkg = TiledBackground2D(img, box_size=5, nthreads=4, mask=mask, ...)
+    >>> background = bkg.background
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from photutils.background import Background2D
+
+
+def mesh_median_filter(data, filter_size):
+    """Median of the non-NaN values in each filter_size window of data, NaN outside.
+
+    Same as scipy.ndimage.generic_filter(data, np.nanmedian, size=filter_size, mode='constant', cval=np.nan).
+    """
+    fy, fx = filter_size
+    padded = np.pad(data, ((fy // 2, fy // 2), (fx // 2, fx // 2)), constant_values=np.nan)
+    windows = np.sort(sliding_window_view(padded, (fy, fx)).reshape(*data.shape, fy * fx), axis=-1)
+
+    # The NaNs sort to the end of each window
+    count = np.count_nonzero(~np.isnan(windows), axis=-1)
+    upper = np.take_along_axis(windows, (count // 2)[..., None], axis=-1)[..., 0]
+    lower = np.take_along_axis(windows, np.maximum(count - 1, 0)[..., None] // 2, axis=-1)[..., 0]
+    # Same rounding as numpy's median for an even number of values
+    filtered = np.where(count % 2 == 1, upper, (upper + lower) / data.dtype.type(2))
+    filtered[count == 0] = np.nan
+    return filtered
+
+
+class TiledBackground2D(Background2D):
+    """photutils Background2D computed in nthreads threads (0 for all cores), see the module docstring.
+
+    All other arguments are those of Background2D.
+    """
+
+    def __init__(self, data, box_size, nthreads=1, **kwargs):
+        self.nthreads = nthreads or os.cpu_count()
+        super().__init__(data, box_size, **kwargs)
+
+    def _compute_box_statistics(self, data, *, axis=None):
+        # data is (rows of boxes, columns of boxes, pixels) for the full boxes
+        if self.nthreads == 1 or np.ndim(data) != 3 or data.shape[0] < 2 * self.nthreads:
+            return super()._compute_box_statistics(data, axis=axis)
+        strips = np.array_split(np.arange(data.shape[0]), self.nthreads)
+
+        def strip_statistics(rows):
+            return super(TiledBackground2D, self)._compute_box_statistics(data[rows[0]:rows[-1] + 1], axis=axis)
+
+        with ThreadPoolExecutor(max_workers=self.nthreads) as executor:
+            results = list(executor.map(strip_statistics, strips))
+        return tuple(np.concatenate(parts, axis=0) for parts in zip(*results))
+
+    def _filter_grid(self, data):
+        if tuple(self.filter_size) == (1, 1) or (self.filter_threshold is not None
+                                                 and self.filter_threshold >= self._min_bkg_stats):
+            # Nothing or only part of the mesh to filter
+            return super()._filter_grid(data)
+        return mesh_median_filter(data, self.filter_size)
+
+
+if __name__ == '__main__':
+    import time
+    import warnings
+    from astropy.stats import SigmaClip
+    from photutils.background import BiweightLocationBackground, BkgZoomInterpolator
+    warnings.filterwarnings('ignore')
+
+    rng = np.random.default_rng(4)
+    image = rng.normal(0.3, 0.05, (2048, 2048)).astype(np.float32)
+    sources = rng.random(image.shape) < 0.01
+    image[sources] += rng.exponential(2.0, sources.sum()).astype(np.float32)
+    mask = rng.random(image.shape) < 0.2
+    mask[:300, :300] = True  # fully masked boxes
+    image[rng.random(image.shape) < 0.001] = np.nan
+
+    for box_size in (5, 100):
+        kwargs = dict(sigma_clip=SigmaClip(sigma=3), filter_size=3, bkg_estimator=BiweightLocationBackground(),
+                      exclude_percentile=90, mask=mask, interpolator=BkgZoomInterpolator())
+        t0 = time.perf_counter()
+        expected = Background2D(image, box_size, **kwargs)
+        expected_background = expected.background
+        t1 = time.perf_counter()
+        tiled = TiledBackground2D(image, box_size, nthreads=0, **kwargs)
+        background = tiled.background
+        t2 = time.perf_counter()
+        print(f'box_size {box_size}: Background2D {t1-t0:.2f} s, TiledBackground2D {t2-t1:.2f} s '
+              f'on {os.cpu_count()} cores, identical mesh: '
+              f'{np.array_equal(expected.background_mesh, tiled.background_mesh, equal_nan=True)}, '
+              f'identical background: {np.array_equal(expected_background, background, equal_nan=True)}')
@@ -0,0 +1,198 @@
+"""
+Worker pool that admits tasks only while their memory fits in a budget.
+
+The 1/f noise, wisp and background steps ran one worker per core (or a fixed
+wisp_nproc) whatever the memory of the node, and the background step, at
+several GB per exposure, is OOM-killed on the large nodes. MemoryAwarePool is
+a multiprocessing.Pool with
+
+    - recycling: workers are replaced after maxtasksperchild tasks, so that
+      memory kept by a worker (caches, fragmentation) stays bounded. This is on
+      by default (pool_maxtasksperchild: 20 in config.yaml); 0 keeps the
+      workers for the whole step, as a plain Pool does.
+    - admission, only with memory_aware (pool_memory_aware in config.yaml, off
+      by default): a task is started only while (running tasks + 1) x the peak
+      memory of a task stays within the memory budget (and a worker is free).
+      One task always runs, even if it alone is over the budget.
+      The peak memory of a task is either configured (pool_task_memory_gb),
+      and then used as given, or measured: every worker reports its peak RSS
+      with each result, and the largest one reported so far is the estimate.
+      Until a first task has finished, a step without a configured value runs
+      that one task alone. The peak RSS of a forked worker includes the pages
+      it shares with the parent, so the estimate errs on the safe side.
+      The budget is pool_memory_budget_gb, or 80% of the memory available when
+      the pool starts.
+
+Without memory_aware, all workers run tasks as soon as they are free.
+
+Use
+---
+    >>> with worker_pool.MemoryAwarePool.from_config(config, 'background_subtraction') as pool:
+    ...     for result in pool.imap_unordered(process_file, pool_args):
+    ...         ...
+"""
+import logging
+import os
+import queue
+import resource
+import sys
+from multiprocessing import Pool, cpu_count
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+log_file_path = 'pipeline.log'
+file_handler = logging.FileHandler(log_file_path, mode='a')
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+log.addHandler(file_handler)
+
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+RU_MAXRSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+
+def available_memory():
+    """Memory (bytes) currently available to new processes, from /proc/meminfo where possible."""
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+
+
+def peak_rss():
+    """Peak resident memory (bytes) of the calling process so far."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RU_MAXRSS_UNIT
+
+
+def run_task(func, item):
+    """func(item) and the peak RSS of the worker that ran it."""
+    return func(item), peak_rss()
+
+
+class MemoryAwarePool:
+    """multiprocessing.Pool running tasks only while their estimated memory fits in memory_budget.
+
+    Parameters
+    ----------
+    step : str
+        Name of the step, for the log.
+
+    processes : int
+        Number of workers, None or 0 for one per core.
+
+    memory_budget : float
+        Memory (bytes) all running tasks may use together, None or 0 for 80% of the available memory.
+
+    task_memory : float
+        Peak memory (bytes) of one task, None or 0 to measure it. A configured value is not changed
+        by the measured peaks.
+
+    maxtasksperchild : int
+        Tasks after which a worker is replaced, None or 0 to keep the workers.
+
+    memory_aware : bool
+        Admit tasks by memory_budget and task_memory. If False, every free worker runs a task.
+
+    initializer, initargs
+        As for multiprocessing.Pool.
+    """
+
+    def __init__(self, step, processes=None, memory_budget=None, task_memory=None, maxtasksperchild=None,
+                 memory_aware=False, initializer=None, initargs=()):
+        self.step = step
+        self.processes = processes or cpu_count()
+        self.memory_aware = memory_aware
+        self.memory_budget = memory_budget or 0.8 * available_memory()
+        self.task_memory = task_memory or 0
+        self.measure = not self.task_memory
+        self.warned = False
+        self.pool = Pool(processes=self.processes, initializer=initializer, initargs=initargs,
+                         maxtasksperchild=maxtasksperchild or None)
+        if memory_aware:
+            estimate = f'{self.task_memory/1e9:.1f} GB per task' if self.task_memory else 'task memory to be measured'
+            admission = f'{self.memory_budget/1e9:.1f} GB memory budget, {estimate}'
+        else:
+            admission = 'no memory admission'
+        log.info(f'{step}: {self.processes} workers, {admission}, workers replaced after {maxtasksperchild or "no"} tasks')
+
+    @classmethod
+    def from_config(cls, config, step, processes=None, **kwargs):
+        """Pool for step with the pool_* settings of config.yaml; processes overrides pool_processes."""
+        task_memory = (config.get('pool_task_memory_gb') or {}).get(step, 0)
+        return cls(step, processes=processes or config.get('pool_processes', 0),
+                   memory_budget=config.get('pool_memory_budget_gb', 0) * 1e9,
+                   task_memory=task_memory * 1e9,
+                   maxtasksperchild=config.get('pool_maxtasksperchild', 0),
+                   memory_aware=config.get('pool_memory_aware', False), **kwargs)
+
+    def admit(self, running):
+        """Whether one more task may start while running tasks are."""
+        if running == 0:
+            return True
+        if not self.memory_aware:
+            return running < self.processes
+        if running >= self.processes or not self.task_memory:
+            return False
+        return (running + 1) * self.task_memory <= self.memory_budget
+
+    def update_estimate(self, peak):
+        """Raise the measured task memory to peak, or warn once if peak is over the configured one."""
+        if not self.measure:
+            if peak > 1.1 * self.task_memory and not self.warned:
+                self.warned = True
+                log.warning(f'{self.step}: a task used {peak/1e9:.1f} GB, more than the configured '
+                            f'{self.task_memory/1e9:.1f} GB per task (pool_task_memory_gb)')
+        elif peak > self.task_memory:
+            previous, self.task_memory = self.task_memory, peak
+            if peak > self.memory_budget >= previous:
+                log.warning(f'{self.step}: a task used {peak/1e9:.1f} GB, more than the '
+                            f'{self.memory_budget/1e9:.1f} GB budget. Running one task at a time.')
+            elif peak > 1.1 * previous:
+                log.info(f'{self.step}: task peak memory {peak/1e9:.2f} GB, up to '
+                         f'{min(self.processes, int(self.memory_budget // peak))} tasks at a time')
+
+    def imap_unordered(self, func, iterable):
+        """Results of func on the items of iterable, in the order they finish, as Pool.imap_unordered.
+
+        An exception raised by func is raised here when its task finishes.
+        """
+        finished = queue.Queue()
+        items = iter(iterable)
+        running = 0
+        exhausted = False
+        while True:
+            while not exhausted and self.admit(running):
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                self.pool.apply_async(run_task, (func, item), callback=finished.put,
+                                      error_callback=lambda e: finished.put((e, None)))
+                running += 1
+            if running == 0:
+                return
+            result, peak = finished.get()
+            running -= 1
+            if peak is None:
+                raise result
+            if self.memory_aware:
+                self.update_estimate(peak)
+            yield result
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def terminate(self):
+        self.pool.terminate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        # Like Pool, which terminates the workers on exit
+        self.terminate()
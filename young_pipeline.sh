@@ -16,6 +16,10 @@ should_skip_step() {
 
 delete_directory_if_exists() {
     local dir=$1
+    if [ "$INCREMENTAL" == "true" ]; then
+        # Keep earlier outputs, only changed exposures are reprocessed
+        return
+    fi
     if [ -d "$dir" ]; then
         echo ""
         echo "[Directory $dir already exists. Deleting it to avoid conflicts.]"
@@ -30,8 +34,32 @@ export CRDS_SERVER_URL=$MY_CRDS_SERVER_URL
 
 UNCAL_PATH=$(get_yaml_value 'uncal_path' "$CONFIG_FILE")
 WISP_NPROC=$(get_yaml_value 'wisp_nproc' "$CONFIG_FILE")
+DAG_MODE=$(get_yaml_value 'dag_mode' "$CONFIG_FILE")
+DAG_NPROC=$(get_yaml_value 'dag_nproc' "$CONFIG_FILE")
+INCREMENTAL=$(get_yaml_value 'incremental' "$CONFIG_FILE")
+FUSED_STAGE2=$(get_yaml_value 'fused_stage2' "$CONFIG_FILE")
+SOURCE_MASK_DIR=$(get_yaml_value 'source_mask_dir' "$CONFIG_FILE")
+WISP_ARGS="--source_mask_dir=$SOURCE_MASK_DIR"
+if yq '.source_mask_refine[]' "$CONFIG_FILE" | grep -q "wisp_subtraction"; then
+    WISP_ARGS="$WISP_ARGS --refine_source_mask"
+fi
+if yq '.robust_stats_fast[]' "$CONFIG_FILE" | grep -q "wisp_subtraction"; then
+    WISP_ARGS="$WISP_ARGS --stats_mode=fast"
+fi
+WISP_ARGS="$WISP_ARGS --async_io_depth=$(get_yaml_value 'async_io_depth' "$CONFIG_FILE")"
+WISP_ARGS="$WISP_ARGS --compute_precision=$(get_yaml_value 'compute_precision' "$CONFIG_FILE")"
+if [ "$(get_yaml_value 'pool_memory_aware' "$CONFIG_FILE")" = "true" ]; then
+    WISP_ARGS="$WISP_ARGS --memory_aware"
+fi
+WISP_ARGS="$WISP_ARGS --memory_budget_gb=$(get_yaml_value 'pool_memory_budget_gb' "$CONFIG_FILE")"
+WISP_ARGS="$WISP_ARGS --task_memory_gb=$(get_yaml_value 'pool_task_memory_gb.wisp_subtraction' "$CONFIG_FILE")"
+WISP_ARGS="$WISP_ARGS --maxtasksperchild=$(get_yaml_value 'pool_maxtasksperchild' "$CONFIG_FILE")"
+PROFILE_EVERY=$(get_yaml_value 'profile_every' "$CONFIG_FILE")
+WISP_ARGS="$WISP_ARGS --profile=$PROFILE_EVERY"
 
 echo ""
+RUN_START=$(date +%s)
+
 echo "################################"
 echo "#                              #"
 echo "# JWST data reduction pipeline #"
@@ -53,85 +81,112 @@ else
     echo "[Download uncal references skipped]"
 fi
 
-if ! should_skip_step "stage1"; then
-    delete_directory_if_exists "$BASE_DIR/output/stage1_output"
-    echo ""
-    echo "==================="
-    echo " Pipeline: stage 1 "
-    echo "==================="
-    python "$BASE_DIR/utils/pipeline_stage1.py" --output_dir "$BASE_DIR/output/stage1_output"
-else
-    echo "[Pipeline Stage 1 skipped]"
-fi
-
-if ! should_skip_step "fnoise_correction"; then
-    echo ""
-    echo "« Correcting 1/f noise »"
-    echo "  ¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯  "
-    python "$BASE_DIR/utils/remstriping_update_parallel.py" --runall --output_dir "$BASE_DIR/output/stage1_output"
-else
-    echo "[1/f noise correction skipped]"
-fi
-
-if ! should_skip_step "download_rate_references"; then
+if [ "$DAG_MODE" = "true" ]; then
+    for stage in stage1 stage2 stage3; do
+        if ! should_skip_step "$stage"; then
+            delete_directory_if_exists "$BASE_DIR/output/${stage}_output"
+        fi
+    done
     echo ""
-    echo "« Downloading references for rate.fits files »"
-    echo "  ¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯  "
-    crds bestrefs --files $BASE_DIR/output/stage1_output/jw*rate.fits --sync-references=1
+    echo "=============================="
+    echo " Pipeline: per-exposure graph "
+    echo "=============================="
+    python "$BASE_DIR/utils/pipeline_dag.py" --output_dir "$BASE_DIR/output" --wisp_dir "$BASE_DIR/utils/wisp-templates" --nproc "$DAG_NPROC"
 else
-    echo "[Download rate references skipped]"
-fi
+    if ! should_skip_step "stage1"; then
+        delete_directory_if_exists "$BASE_DIR/output/stage1_output"
+        echo ""
+        echo "==================="
+        echo " Pipeline: stage 1 "
+        echo "==================="
+        python "$BASE_DIR/utils/pipeline_stage1.py" --output_dir "$BASE_DIR/output/stage1_output"
+    else
+        echo "[Pipeline Stage 1 skipped]"
+    fi
 
-if ! should_skip_step "stage2"; then
-    delete_directory_if_exists "$BASE_DIR/output/stage2_output"
-    echo ""
-    echo "===================="
-    echo " Pipeline - stage 2 "
-    echo "===================="
-    python "$BASE_DIR/utils/pipeline_stage2.py" --input_dir "$BASE_DIR/output/stage1_output" --output_dir "$BASE_DIR/output/stage2_output"
-else
-    echo "[Pipeline Stage 2 skipped]"
-fi
+    if ! should_skip_step "fnoise_correction"; then
+        echo ""
+        echo "« Correcting 1/f noise »"
+        echo "  ¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯  "
+        python "$BASE_DIR/utils/remstriping_update_parallel.py" --runall --output_dir "$BASE_DIR/output/stage1_output" --profile "$PROFILE_EVERY"
+    else
+        echo "[1/f noise correction skipped]"
+    fi
 
-if ! should_skip_step "wisp_subtraction"; then
-    echo ""
-    echo "« Subtracting wisps from exposures »"
-    echo "  ¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯  "
-    python "$BASE_DIR/utils/subtract_wisp.py" --files $BASE_DIR/output/stage2_output/jw*cal.fits --wisp_dir "$BASE_DIR/utils/wisp-templates" --suffix "_final" --nproc "$WISP_NPROC"
-else
-    echo "[Wisp subtraction skipped]"
-fi
+    if ! should_skip_step "download_rate_references"; then
+        echo ""
+        echo "« Downloading references for rate.fits files »"
+        echo "  ¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯  "
+        crds bestrefs --files $BASE_DIR/output/stage1_output/jw*rate.fits --sync-references=1
+    else
+        echo "[Download rate references skipped]"
+    fi
 
-if ! should_skip_step "background_subtraction"; then
-    echo ""
-    echo "« Subtracting background from exposures »"
-    echo "  ¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯  "
-    python "$BASE_DIR/utils/bkg_sub_parallel.py" --input_dir "$BASE_DIR/output/stage2_output" --output_dir "$BASE_DIR/output/stage2_output"
-else
-    echo "[Background subtraction skipped]"
-fi
+    if [ "$FUSED_STAGE2" = "true" ] && ! should_skip_step "stage2" && ! should_skip_step "wisp_subtraction" && ! should_skip_step "background_subtraction"; then
+        delete_directory_if_exists "$BASE_DIR/output/stage2_output"
+        echo ""
+        echo "================================================"
+        echo " Pipeline - stage 2 + wisp + background (fused) "
+        echo "================================================"
+        python "$BASE_DIR/utils/fused_stage2.py" --input_dir "$BASE_DIR/output/stage1_output" --output_dir "$BASE_DIR/output/stage2_output" --wisp_dir "$BASE_DIR/utils/wisp-templates"
+    else
+        if ! should_skip_step "stage2"; then
+            delete_directory_if_exists "$BASE_DIR/output/stage2_output"
+            echo ""
+            echo "===================="
+            echo " Pipeline - stage 2 "
+            echo "===================="
+            python "$BASE_DIR/utils/pipeline_stage2.py" --input_dir "$BASE_DIR/output/stage1_output" --output_dir "$BASE_DIR/output/stage2_output"
+        else
+            echo "[Pipeline Stage 2 skipped]"
+        fi
+
+        if ! should_skip_step "wisp_subtraction"; then
+            echo ""
+            echo "« Subtracting wisps from exposures »"
+            echo "  ¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯  "
+            python "$BASE_DIR/utils/subtract_wisp.py" --files $BASE_DIR/output/stage2_output/jw*cal.fits --wisp_dir "$BASE_DIR/utils/wisp-templates" --suffix "_final" --nproc "$WISP_NPROC" $WISP_ARGS
+        else
+            echo "[Wisp subtraction skipped]"
+        fi
+
+        if ! should_skip_step "background_subtraction"; then
+            echo ""
+            echo "« Subtracting background from exposures »"
+            echo "  ¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯  "
+            python "$BASE_DIR/utils/bkg_sub_parallel.py" --input_dir "$BASE_DIR/output/stage2_output" --output_dir "$BASE_DIR/output/stage2_output" --profile "$PROFILE_EVERY"
+        else
+            echo "[Background subtraction skipped]"
+        fi
+    fi
 
-if ! should_skip_step "download_cal_references"; then
-    echo ""
-    echo "« Downloading references for cal.fits files »"
-    echo "  ¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯  "
-    crds bestrefs --files $BASE_DIR/output/stage2_output/jw*cal_final.fits --sync-references=1
-else
-    echo "[Download cal references skipped]"
-fi
+    if ! should_skip_step "download_cal_references"; then
+        echo ""
+        echo "« Downloading references for cal.fits files »"
+        echo "  ¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯¯  "
+        crds bestrefs --files $BASE_DIR/output/stage2_output/jw*cal_final.fits --sync-references=1
+    else
+        echo "[Download cal references skipped]"
+    fi
 
-if ! should_skip_step "stage3"; then
-    delete_directory_if_exists "$BASE_DIR/output/stage3_output"
-    echo ""
-    echo "===================="
-    echo " Pipeline - stage 3"
-    echo "===================="
-    python "$BASE_DIR/utils/pipeline_stage3.py" --input_dir "$BASE_DIR/output/stage2_output" --output_dir "$BASE_DIR/output/stage3_output"
-else
-    echo "[Pipeline Stage 3 skipped]"
+    if ! should_skip_step "stage3"; then
+        delete_directory_if_exists "$BASE_DIR/output/stage3_output"
+        echo ""
+        echo "===================="
+        echo " Pipeline - stage 3"
+        echo "===================="
+        python "$BASE_DIR/utils/pipeline_stage3.py" --input_dir "$BASE_DIR/output/stage2_output" --output_dir "$BASE_DIR/output/stage3_output"
+    else
+        echo "[Pipeline Stage 3 skipped]"
+    fi
 fi
 
 echo ""
 echo "===================="
 echo " Pipeline completed "
 echo "===================="
+
+echo ""
+echo "« Run report »"
+echo "  ¯¯¯¯¯¯¯¯¯¯  "
+python "$BASE_DIR/utils/run_report.py" --since "$RUN_START"